@@ -0,0 +1,180 @@
+import os
+import time
+import logging
+from functools import lru_cache
+
+from sqlite_store import SQLiteStore
+
+# Local snapshot of the Active Directory users used to enrich documents.
+# The first run pulls every user; later runs only ask the domain controller for
+# entries whose uSNChanged is above the highest value already seen. uSNChanged is
+# local to one DC, so a different DC (told apart by its dsServiceName, not by the host name
+# that may point at any DC of the domain), or a snapshot older than AD_FULL_REFRESH_DAYS
+# (which also drops deleted accounts), triggers a full pull.
+
+AD_CACHE_PATH = os.getenv("AD_CACHE_PATH", "ad_cache.db")
+AD_FULL_REFRESH_DAYS = float(os.getenv("AD_FULL_REFRESH_DAYS", "7"))
+AD_LOOKUP_CACHE_SIZE = int(os.getenv("AD_LOOKUP_CACHE_SIZE", "100000"))
+
+AD_ATTRIBUTES = ['sAMAccountName', 'displayName', 'mail', 'manager', 'department', 'uSNChanged']
+
+
+def extract_cn(distinguished_name):
+    if distinguished_name and "CN=" in distinguished_name:
+        return distinguished_name.split("CN=")[1].split(",")[0]
+    return ""
+
+
+def _value(attr, name):
+    value = attr.get(name, '')
+    if isinstance(value, list):
+        value = value[0] if value else ''
+    return str(value or '')
+
+
+def server_identity(conn):
+    # The domain controller that answered, by the NTDS Settings DN its rootDSE gives
+    # (dsServiceName): a domain name is served by all of its DCs, and each DC has its own
+    # uSNChanged counter. None when the rootDSE was not read (Server get_info)
+    info = getattr(conn.server, "info", None)
+    other = getattr(info, "other", None) or {}
+    value = other.get("dsServiceName")
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return str(value) if value else None
+
+
+class DirectoryCache(SQLiteStore):
+    def __init__(self, path=AD_CACHE_PATH):
+        super().__init__(path)
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "email TEXT PRIMARY KEY, display_name TEXT NOT NULL, sam_account_name TEXT NOT NULL, "
+            "department TEXT NOT NULL, manager TEXT NOT NULL, usn INTEGER NOT NULL DEFAULT 0)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS users_display_name ON users (display_name COLLATE NOCASE)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._lookup = lru_cache(maxsize=AD_LOOKUP_CACHE_SIZE)(self._lookup_uncached)
+
+    def _meta(self, key, default=""):
+        row = self._connect().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, values):
+        self._executemany(
+            "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            [(k, str(v)) for k, v in values.items()],
+        )
+
+    def refresh(self, conn, search_base, page_size=1000):
+        # conn is a bound ldap3 Connection; returns the number of entries pulled
+        server = server_identity(conn)
+        highest = int(self._meta("highest_usn", "0") or 0)
+        full_refresh_at = float(self._meta("full_refresh_at", "0") or 0)
+        full = (
+            not highest
+            or not server
+            or self._meta("server") != server
+            or time.time() - full_refresh_at > AD_FULL_REFRESH_DAYS * 86400
+        )
+
+        search_filter = '(objectClass=user)' if full else f'(&(objectClass=user)(uSNChanged>={highest + 1}))'
+        entries = conn.extend.standard.paged_search(
+            search_base=search_base,
+            search_filter=search_filter,
+            search_scope='SUBTREE',
+            attributes=AD_ATTRIBUTES,
+            paged_size=page_size,
+            generator=True
+        )
+
+        rows = []
+        new_highest = 0 if full else highest
+        for entry in entries:
+            attr = entry.get('attributes', {})
+            email = _value(attr, 'mail').lower().strip()
+            usn = int(_value(attr, 'uSNChanged') or 0)
+            new_highest = max(new_highest, usn)
+            if email:
+                rows.append((
+                    email,
+                    _value(attr, 'displayName'),
+                    _value(attr, 'sAMAccountName'),
+                    _value(attr, 'department'),
+                    extract_cn(_value(attr, 'manager')),
+                    usn,
+                ))
+
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if full:
+                db.execute("DELETE FROM users")
+            db.executemany(
+                "INSERT INTO users (email, display_name, sam_account_name, department, manager, usn) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (email) DO UPDATE SET "
+                "display_name = excluded.display_name, sam_account_name = excluded.sam_account_name, "
+                "department = excluded.department, manager = excluded.manager, usn = excluded.usn",
+                rows,
+            )
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        meta = {"highest_usn": new_highest, "server": server or ""}
+        if full:
+            meta["full_refresh_at"] = time.time()
+        self._set_meta(meta)
+        self._lookup.cache_clear()
+        logging.info(f"AD cache {'full' if full else 'incremental'} refresh: {len(rows)} users")
+        return len(rows)
+
+    def _lookup_uncached(self, key):
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT email, display_name, sam_account_name, department, manager FROM users WHERE email = ?", (key,)
+        ).fetchone()
+        if row is None:
+            # Outlook often gives recipients as display names rather than addresses; a name two
+            # people share says nothing about which one it is
+            rows = conn.execute(
+                "SELECT email, display_name, sam_account_name, department, manager FROM users "
+                "WHERE display_name = ? COLLATE NOCASE LIMIT 2", (key,)
+            ).fetchall()
+            row = rows[0] if len(rows) == 1 else None
+        if row is None:
+            return None
+        return row[0], {"display_name": row[1], "sam_account_name": row[2], "department": row[3], "manager": row[4]}
+
+    def find(self, email_or_name):
+        # Returns (email, info) of the matching entry, the email identifying it, or None
+        key = str(email_or_name or "").strip().strip("'").lower()
+        if not key:
+            return None
+        return self._lookup(key)
+
+    def lookup(self, email_or_name):
+        # Returns display_name / sam_account_name / department / manager (CN), or None
+        entry = self.find(email_or_name)
+        return entry[1] if entry else None
+
+
+def lookup_recipients(directory, addresses):
+    # Directory entries of the To/CC recipients that are known users, once each. Entries are
+    # told apart by their email (the table key): contacts and some service entries have no
+    # sAMAccountName, and deduplicating on it would keep only the first of them
+    recipients = []
+    seen = set()
+    for address in addresses:
+        entry = directory.find(address)
+        if entry is None or entry[0] in seen:
+            continue
+        email, info = entry
+        seen.add(email)
+        recipients.append({
+            "display_name": info["display_name"],
+            "sam_account_name": info["sam_account_name"],
+            "department": info["department"],
+        })
+    return recipients
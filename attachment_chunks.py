@@ -0,0 +1,130 @@
+import os
+import logging
+
+# Attachment text outside the email document.
+# In "chunks" mode the text of each attachment is cut into ATTACHMENT_CHUNK_CHARS pieces and
+# indexed as separate documents that point back to the email _id, so the email document (and
+# every bulk request and search hit carrying it) stays small. "inline" keeps the text inside
+# attachments[].text. Either way an email carries at most ATTACHMENT_TEXT_MAX_CHARS characters
+# of attachment text in total.
+#
+# An email indexed again with fewer chunks (a smaller attachment, other chunk settings) would
+# keep the old higher numbered chunks; once it is acknowledged, delete_stale_chunks removes every
+# chunk of it the new version did not write.
+
+ATTACHMENT_TEXT_MODES = ("inline", "chunks")
+ATTACHMENT_TEXT_MODE = os.getenv("ATTACHMENT_TEXT_MODE", "inline")
+ATTACHMENT_CHUNK_CHARS = int(os.getenv("ATTACHMENT_CHUNK_CHARS", "16000"))
+ATTACHMENT_TEXT_MAX_CHARS = int(os.getenv("ATTACHMENT_TEXT_MAX_CHARS", "2000000"))
+
+# fields of the email copied onto its chunks, so chunk searches take the same filters
+CHUNK_EMAIL_FIELDS = ("user", "folder_name", "department", "date")
+
+
+def split_text(text, size):
+    # Cuts at the last whitespace in the second half of each window, so words stay whole
+    chunks = []
+    start = 0
+    while start < len(text):
+        stop = start + size
+        if stop < len(text):
+            cut = max(text.rfind(" ", start + size // 2, stop), text.rfind("\n", start + size // 2, stop))
+            if cut > start:
+                stop = cut
+        chunk = text[start:stop].strip()
+        if chunk:
+            chunks.append(chunk)
+        start = stop
+    return chunks
+
+
+def cap_attachment_text(actions, max_chars=ATTACHMENT_TEXT_MAX_CHARS):
+    # Inline mode: trims the attachment text of each email to max_chars in total
+    for action in actions:
+        budget = max_chars
+        for attachment in action.get("_source", {}).get("attachments", []):
+            text = attachment.get("text")
+            if not text:
+                continue
+            if budget <= 0:
+                attachment.pop("text")
+            elif len(text) > budget:
+                attachment["text"] = text[:budget]
+            budget -= len(text)
+    return actions
+
+
+class ChunkSplitter:
+    # BulkIndexer prepare step (after resolve_attachment_text): moves the attachment text of
+    # each email into chunk actions that follow it; index_for(date) names the chunk index
+    def __init__(self, index_for, chunk_chars=ATTACHMENT_CHUNK_CHARS, max_chars=ATTACHMENT_TEXT_MAX_CHARS):
+        self.index_for = index_for
+        self.chunk_chars = chunk_chars
+        self.max_chars = max_chars
+
+    def __call__(self, actions):
+        prepared = []
+        for action in actions:
+            prepared.append(action)
+            source = action.get("_source", {})
+            shared = {name: source[name] for name in CHUNK_EMAIL_FIELDS if source.get(name) is not None}
+            budget = self.max_chars
+            for position, attachment in enumerate(source.get("attachments", [])):
+                text = (attachment.pop("text", None) or "")[:max(0, budget)]
+                budget -= len(text)
+                chunks = split_text(text, self.chunk_chars)
+                attachment["text_chunks"] = len(chunks)
+                for number, chunk in enumerate(chunks):
+                    # deterministic ids: re-indexing an email overwrites its chunks
+                    prepared.append({
+                        "_index": self.index_for(source.get("date")),
+                        "_id": f"{action['_id']}:{position}:{number}",
+                        "_source": dict(
+                            shared,
+                            email_id=action["_id"],
+                            filename=attachment.get("filename"),
+                            sha256=attachment.get("sha256"),
+                            chunk=number,
+                            text=chunk,
+                        ),
+                    })
+        return prepared
+
+
+def chunk_ids(action):
+    # _ids of the chunk documents ChunkSplitter made for an email action; None for a --dedup copy
+    # that does not carry the attachments (see dedup.to_upserts) and so leaves the chunks alone
+    source = action.get("_source", {})
+    script = source.get("script")
+    if script is not None:
+        if not script["params"]["replace"]:
+            return None
+        source = script["params"]["doc"]
+    return [f"{action['_id']}:{position}:{number}"
+            for position, attachment in enumerate(source.get("attachments", []))
+            for number in range(attachment.get("text_chunks", 0))]
+
+
+def delete_stale_chunks(client, index, actions):
+    # BulkIndexer on_indexed step: one delete-by-query per acknowledged batch of emails
+    email_ids, current = [], []
+    for action in actions:
+        ids = chunk_ids(action)
+        if ids is not None:
+            email_ids.append(action["_id"])
+            current += ids
+    if not email_ids:
+        return 0
+    try:
+        response = client.delete_by_query(
+            index=index,
+            ignore_unavailable=True,
+            allow_no_indices=True,
+            conflicts="proceed",
+            query={"bool": {"filter": [{"terms": {"email_id": email_ids}}],
+                            "must_not": [{"ids": {"values": current}}]}},
+        )
+    except Exception as e:
+        logging.error(f"Failed to delete stale attachment chunks: {e}")
+        return 0
+    return response.get("deleted", 0)
@@ -1,43 +1,439 @@
 # Simple web server to serve email attachments
-from flask import Flask, send_file, abort, request, jsonify
+from flask import Flask, Response, send_file, abort, request, jsonify, url_for, redirect
 import os
+import re
+import stat as stat_module
+import uuid
 import mimetypes
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from urllib.parse import quote
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import http_date, is_resource_modified, quote_etag
 from werkzeug.security import safe_join
+from datetime import timedelta
+from attachment_store import BLOB_DIR_NAME
+from object_cache import DiskCache, OBJECT_CACHE_MAX_OBJECT
+from search_api import search_api
 
 app = Flask(__name__)
+app.register_blueprint(search_api)
 
 # Configuration
 ATTACHMENT_BASE_PATH = os.getenv("ATTACHMENT_STORE_PATH", r"D:\attachments")
+# Resolved once; only the requested path is resolved per request
+ATTACHMENT_BASE_REAL_PATH = os.path.realpath(ATTACHMENT_BASE_PATH)
 ALLOWED_EXTENSIONS = {'.pdf', '.docx', '.doc', '.xlsx', '.xls', '.txt', '.png', '.jpg', '.jpeg', '.gif', '.zip', '.rar'}
+# Attachments never change once written (each path is a hard link to a content addressed
+# blob), so browsers may keep them; "private" keeps shared proxies from caching mail content
+CACHE_MAX_AGE = int(os.getenv("ATTACHMENT_CACHE_MAX_AGE", str(365 * 24 * 3600)))
+# More ranges than this in one request are answered with the whole file
+MAX_RANGES = int(os.getenv("ATTACHMENT_MAX_RANGES", "32"))
+READ_CHUNK_SIZE = 256 * 1024
+# Behind Apache mod_xsendfile / lighttpd full files are handed to the front server
+# dev (Flask built in server), gunicorn (pre-fork, Linux) or waitress (Windows)
+SERVER = os.getenv("ATTACHMENT_SERVER", "waitress" if os.name == "nt" else "gunicorn")
+SERVER_HOST = os.getenv("ATTACHMENT_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("ATTACHMENT_PORT", "8080"))
+SERVER_WORKERS = int(os.getenv("ATTACHMENT_WORKERS", str(min(8, (os.cpu_count() or 1) * 2 + 1))))
+SERVER_THREADS = int(os.getenv("ATTACHMENT_THREADS", "32"))
+SERVER_WORKER_CLASS = os.getenv("ATTACHMENT_WORKER_CLASS", "gthread")
+SERVER_CONNECTION_LIMIT = int(os.getenv("ATTACHMENT_CONNECTION_LIMIT", "4000"))
+# Attachment listings of an email are reused for MANIFEST_TTL seconds, then revalidated
+# against the directory mtime (adding or removing a file changes it)
+MANIFEST_CACHE_SIZE = int(os.getenv("ATTACHMENT_MANIFEST_CACHE_SIZE", "50000"))
+MANIFEST_TTL = float(os.getenv("ATTACHMENT_MANIFEST_TTL", "30"))
+MANIFEST_MAX_EMAILS = int(os.getenv("ATTACHMENT_MANIFEST_MAX_EMAILS", "500"))
+# MinIO backed serving (/objects/<object_name>): cache (local LRU disk cache), stream
+# (proxy every request) or redirect (presigned URL, the bytes bypass this server)
+MINIO_ENDPOINT = os.getenv("MINIO_ENDPOINT", "127.0.0.1:9000")
+MINIO_ACCESS_KEY = os.getenv("MINIO_ACCESS_KEY", "minioadmin")
+MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY", "minioadmin")
+MINIO_SECURE = os.getenv("MINIO_SECURE", "false").lower() == "true"
+MINIO_BUCKET = os.getenv("MINIO_BUCKET", "email-attachments")
+MINIO_SERVE_MODE = os.getenv("MINIO_SERVE_MODE", "cache")
+# Endpoint the browsers can reach, used to sign redirect URLs
+MINIO_PUBLIC_ENDPOINT = os.getenv("MINIO_PUBLIC_ENDPOINT", MINIO_ENDPOINT)
+MINIO_PUBLIC_SECURE = os.getenv("MINIO_PUBLIC_SECURE", str(MINIO_SECURE)).lower() == "true"
+MINIO_REGION = os.getenv("MINIO_REGION", "us-east-1")
+MINIO_PRESIGN_EXPIRES = int(os.getenv("MINIO_PRESIGN_EXPIRES", "300"))
+# attachment_store.MinioAttachmentStore.object_name(): <aa>/<sha256><ext>
+OBJECT_NAME_RE = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{64}(\.[A-Za-z0-9]{1,16})?$')
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+app.config["USE_X_SENDFILE"] = os.getenv("ATTACHMENT_X_SENDFILE", "false").lower() == "true"
+
+_minio = {}
+_minio_lock = threading.Lock()
 
 def is_safe_path(path):
-    return os.path.commonpath([os.path.realpath(path), os.path.realpath(ATTACHMENT_BASE_PATH)]) == os.path.realpath(ATTACHMENT_BASE_PATH)
+    try:
+        return os.path.commonpath([os.path.realpath(path), ATTACHMENT_BASE_REAL_PATH]) == ATTACHMENT_BASE_REAL_PATH
+    except ValueError:
+        # different drives on Windows
+        return False
+
+def resolve_attachment(user_name, email_id, filename):
+    # Returns (file_path, stat) with one stat and one realpath per request, or aborts
+    file_path = safe_join(ATTACHMENT_BASE_PATH, user_name, email_id, filename)
+    if not file_path:
+        abort(404)
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        abort(404)
+    if not stat_module.S_ISREG(stat.st_mode):
+        abort(404)
+
+    # Security check
+    if not is_safe_path(file_path):
+        abort(403)
+    return file_path, stat
+
+def blob_digest(stat, digest):
+    # The content hash of a local store file when the link names it (?sha256=, added by
+    # search_api): the file is a hard link of _blobs/<aa>/<sha256>, which one stat of the blob
+    # confirms. None for an unknown or wrong digest, or a copied (not linked) file
+    if not digest or not SHA256_RE.match(digest):
+        return None
+    try:
+        blob = os.stat(os.path.join(ATTACHMENT_BASE_PATH, BLOB_DIR_NAME, digest[:2], digest))
+    except OSError:
+        return None
+    if (blob.st_dev, blob.st_ino) != (stat.st_dev, stat.st_ino):
+        return None
+    return digest
+
+def file_etag(stat):
+    # Fallback when the digest is not known: inode, size and mtime, shared by all hard links of
+    # one blob, and never a read of the file on the request thread
+    return f"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+def content_disposition(filename, as_attachment):
+    kind = 'attachment' if as_attachment else 'inline'
+    simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii').replace('"', '')
+    return f"{kind}; filename=\"{simple}\"; filename*=UTF-8''{quote(filename, safe='')}"
+
+def requested_ranges(etag, mtime, length):
+    # None: send the whole file; []: nothing satisfiable (416); otherwise sorted, merged (start, stop) spans
+    byte_range = request.range
+    if byte_range is None or byte_range.units != 'bytes' or len(byte_range.ranges) > MAX_RANGES:
+        return None
+    # If-Range: the client's partial copy is only extended if it is still the same content
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and (mtime is None or int(if_range.date.timestamp()) != int(mtime)):
+        return None
+
+    spans = []
+    for start, stop in byte_range.ranges:
+        if start < 0:
+            start, stop = max(0, length + start), length
+        else:
+            stop = length if stop is None else min(stop, length)
+        if start < stop:
+            spans.append((start, stop))
+    spans.sort()
+    merged = []
+    for start, stop in spans:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def read_span(f, length):
+    while length > 0:
+        chunk = f.read(min(READ_CHUNK_SIZE, length))
+        if not chunk:
+            break
+        length -= len(chunk)
+        yield chunk
+
+def file_span(file_path, start, stop):
+    f = open(file_path, 'rb')
+    f.seek(start)
+    # gunicorn (sendfile) and waitress send from the current position up to Content-Length,
+    # so the server's file wrapper still delivers a seeked file without copying it through Python
+    wrapper = request.environ.get('wsgi.file_wrapper')
+    if wrapper is not None:
+        return wrapper(f, READ_CHUNK_SIZE)
+
+    def body():
+        try:
+            yield from read_span(f, stop - start)
+        finally:
+            f.close()
+    return body()
+
+def multipart_ranges(file_path, parts, closing):
+    with open(file_path, 'rb') as f:
+        for header, start, stop in parts:
+            yield header
+            f.seek(start)
+            yield from read_span(f, stop - start)
+            yield b'\r\n'
+    yield closing
+
+def cache_headers(etag, mtime=None):
+    # without a known mtime there is no Last-Modified, the ETag alone validates
+    headers = {
+        'ETag': quote_etag(etag),
+        'Cache-Control': f'private, max-age={CACHE_MAX_AGE}, immutable',
+        'Accept-Ranges': 'bytes',
+    }
+    if mtime is not None:
+        headers['Last-Modified'] = http_date(int(mtime))
+    return headers
+
+def file_response(file_path, stat, mime_type, as_attachment=False, download_name=None, etag=None):
+    # Strong ETag (the content hash when known, otherwise file_etag), 304 on If-None-Match /
+    # If-Modified-Since, single and multi range 206
+    length = stat.st_size
+    etag = etag or file_etag(stat)
+    download_name = download_name or os.path.basename(file_path)
+    headers = cache_headers(etag, stat.st_mtime)
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=http_date(int(stat.st_mtime))):
+        return Response(status=304, headers=headers)
+
+    ranges = requested_ranges(etag, stat.st_mtime, length)
+    if ranges is None:
+        response = send_file(file_path, mimetype=mime_type, as_attachment=as_attachment,
+                             download_name=download_name, conditional=False, etag=False)
+        response.headers.update(headers)
+        return response
+
+    if not ranges:
+        headers['Content-Range'] = f'bytes */{length}'
+        return Response(status=416, headers=headers)
+
+    headers['Content-Disposition'] = content_disposition(download_name, as_attachment)
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{length}'
+        response = Response(file_span(file_path, start, stop), status=206, mimetype=mime_type,
+                            headers=headers, direct_passthrough=True)
+        response.content_length = stop - start
+        return response
+
+    boundary = uuid.uuid4().hex
+    parts = [
+        (f'--{boundary}\r\nContent-Type: {mime_type}\r\nContent-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n'.encode('ascii'),
+         start, stop)
+        for start, stop in ranges
+    ]
+    closing = f'--{boundary}--\r\n'.encode('ascii')
+    response = Response(multipart_ranges(file_path, parts, closing), status=206,
+                        content_type=f'multipart/byteranges; boundary={boundary}',
+                        headers=headers, direct_passthrough=True)
+    response.content_length = sum(len(header) + stop - start + 2 for header, start, stop in parts) + len(closing)
+    return response
+
+def get_minio():
+    # Pooled client (one connection per request thread) and disk cache, created per process
+    with _minio_lock:
+        if _minio.get('pid') != os.getpid():
+            from upload_stage import create_minio_client
+            _minio.clear()
+            _minio.update(
+                pid=os.getpid(),
+                client=create_minio_client(MINIO_ENDPOINT, MINIO_ACCESS_KEY, MINIO_SECRET_KEY,
+                                           secure=MINIO_SECURE, pool_size=SERVER_THREADS),
+                # signing is local; the region keeps it from asking the public endpoint for one
+                signer=create_minio_client(MINIO_PUBLIC_ENDPOINT, MINIO_ACCESS_KEY, MINIO_SECRET_KEY,
+                                           secure=MINIO_PUBLIC_SECURE, pool_size=1, region=MINIO_REGION),
+                cache=DiskCache() if MINIO_SERVE_MODE == 'cache' else None,
+            )
+        return _minio
+
+def download_object(client, object_name, file_path):
+    response = client.get_object(MINIO_BUCKET, object_name)
+    try:
+        with open(file_path, 'wb') as f:
+            for chunk in response.stream(READ_CHUNK_SIZE):
+                f.write(chunk)
+    finally:
+        response.close()
+        response.release_conn()
+
+def stream_object(client, object_name, info, mime_type, as_attachment, download_name, etag):
+    # Proxies the object; a single range is forwarded to MinIO, several ranges get the whole object
+    length = info.size
+    mtime = info.last_modified.timestamp() if info.last_modified else None
+    headers = cache_headers(etag, mtime)
+    headers['Content-Disposition'] = content_disposition(download_name, as_attachment)
+    ranges = requested_ranges(etag, mtime, length)
+    if ranges == []:
+        headers['Content-Range'] = f'bytes */{length}'
+        return Response(status=416, headers=headers)
+
+    status, offset, size = 200, 0, length
+    if ranges and len(ranges) == 1:
+        start, stop = ranges[0]
+        status, offset, size = 206, start, stop - start
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{length}'
+    minio_response = client.get_object(MINIO_BUCKET, object_name, offset=offset, length=size if status == 206 else 0)
+
+    def body():
+        try:
+            yield from minio_response.stream(READ_CHUNK_SIZE)
+        finally:
+            minio_response.close()
+            minio_response.release_conn()
+
+    response = Response(body(), status=status, mimetype=mime_type, headers=headers, direct_passthrough=True)
+    response.content_length = size
+    return response
+
+class ManifestCache:
+    # LRU of (user, email_id) -> (directory mtime, checked at, attachment list)
+    def __init__(self, max_size=MANIFEST_CACHE_SIZE, ttl=MANIFEST_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_name, email_id):
+        # Returns the attachments of one email, or None if the email has no directory
+        key = (user_name, email_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None and now - entry[1] < self.ttl:
+            return entry[2]
+
+        email_path = safe_join(ATTACHMENT_BASE_PATH, user_name, email_id)
+        if not email_path or not is_safe_path(email_path):
+            return None
+        try:
+            mtime = os.stat(email_path).st_mtime_ns
+        except OSError:
+            self.invalidate(user_name, email_id)
+            return None
+
+        if entry is not None and entry[0] == mtime:
+            items = entry[2]
+        else:
+            items = self._scan(email_path)
+        with self._lock:
+            self._entries[key] = (mtime, now, items)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return items
+
+    def invalidate(self, user_name, email_id):
+        with self._lock:
+            self._entries.pop((user_name, email_id), None)
+
+    @staticmethod
+    def _scan(email_path):
+        # scandir entries carry their stat on Windows, so a listing costs one directory read
+        items = []
+        with os.scandir(email_path) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                mime_type, _ = mimetypes.guess_type(entry.name)
+                items.append({
+                    'filename': entry.name,
+                    'size': stat.st_size,
+                    'mime_type': mime_type,
+                    'modified': stat.st_mtime,
+                    'viewable': os.path.splitext(entry.name)[1].lower() in ALLOWED_EXTENSIONS,
+                })
+        items.sort(key=lambda item: item['filename'])
+        return items
+
+manifest_cache = ManifestCache()
+
+def email_manifest(user_name, email_id):
+    items = local_manifest(user_name, email_id)
+    if items is None:
+        return object_manifests([(user_name, email_id)]).get((user_name, email_id))
+    return items
+
+def local_manifest(user_name, email_id):
+    # None when the email has no directory in the local store
+    items = manifest_cache.get(user_name, email_id)
+    if items is None:
+        return None
+    # copies, so the cached entries never carry request specific URLs
+    return [
+        dict(item,
+             url=url_for('serve_attachment', user_name=user_name, email_id=email_id, filename=item['filename']),
+             download_url=url_for('download_attachment', user_name=user_name, email_id=email_id, filename=item['filename']))
+        for item in items
+    ]
+
+def object_manifests(emails):
+    # (user, email_id) -> attachments, for emails ingested with --store minio: their attachments
+    # only exist as objects, and the email document (email_id is its _id, the search hit id)
+    # lists them. One search for all the emails; an email not found, or not in that user's
+    # mailbox, is left out
+    from search_api import get_es, SEARCH_INDEX
+    ids = sorted({email_id for _, email_id in emails})
+    if not ids:
+        return {}
+    response = get_es().search(
+        index=SEARCH_INDEX, query={"ids": {"values": ids}}, size=len(ids), ignore_unavailable=True,
+        _source={"includes": ["user", "owners", "attachments.filename", "attachments.size",
+                              "attachments.object_name"]},
+    )
+    documents = {}
+    for hit in response["hits"]["hits"]:
+        documents.setdefault(hit["_id"], hit.get("_source", {}))
+
+    manifests = {}
+    for user_name, email_id in emails:
+        source = documents.get(email_id)
+        if source is None or user_name not in {source.get("user"), *(source.get("owners") or [])}:
+            continue
+        items = []
+        for attachment in source.get("attachments") or []:
+            object_name, filename = attachment.get("object_name"), attachment.get("filename") or ""
+            if not object_name or not OBJECT_NAME_RE.match(object_name):
+                continue
+            mime_type, _ = mimetypes.guess_type(filename)
+            items.append({
+                'filename': filename,
+                'size': attachment.get('size'),
+                'mime_type': mime_type,
+                'modified': None,
+                'viewable': os.path.splitext(filename)[1].lower() in ALLOWED_EXTENSIONS,
+                'url': url_for('serve_object', object_name=object_name, filename=filename),
+                'download_url': url_for('serve_object', object_name=object_name, filename=filename, download=1),
+            })
+        items.sort(key=lambda item: item['filename'])
+        manifests[(user_name, email_id)] = items
+    return manifests
 
 @app.route('/attachments/<user_name>/<email_id>/<filename>')
 def serve_attachment(user_name, email_id, filename):
     try:
-        # Construct safe file path
-        file_path = safe_join(ATTACHMENT_BASE_PATH, user_name, email_id, filename)
-        
-        if not file_path or not os.path.exists(file_path):
-            abort(404)
-        
-        # Security check
-        if not is_safe_path(file_path):
-            abort(403)
-        
         # Check file extension
         _, ext = os.path.splitext(filename)
         if ext.lower() not in ALLOWED_EXTENSIONS:
             abort(403)
         
+        # Construct safe file path
+        file_path, stat = resolve_attachment(user_name, email_id, filename)
+        
         # Get MIME type
         mime_type, _ = mimetypes.guess_type(filename)
         if not mime_type:
             mime_type = 'application/octet-stream'
         
-        return send_file(file_path, mimetype=mime_type, as_attachment=False)
+        return file_response(file_path, stat, mime_type, etag=blob_digest(stat, request.args.get('sha256')))
         
+    except HTTPException:
+        raise
     except Exception as e:
         app.logger.error(f"Error serving attachment: {e}")
         abort(500)
@@ -45,16 +441,14 @@ def serve_attachment(user_name, email_id, filename):
 @app.route('/attachments/<user_name>/<email_id>/<filename>/download')
 def download_attachment(user_name, email_id, filename):
     try:
-        file_path = safe_join(ATTACHMENT_BASE_PATH, user_name, email_id, filename)
+        file_path, stat = resolve_attachment(user_name, email_id, filename)
         
-        if not file_path or not os.path.exists(file_path):
-            abort(404)
-        
-        if not is_safe_path(file_path):
-            abort(403)
-        
-        return send_file(file_path, as_attachment=True, download_name=filename)
+        mime_type, _ = mimetypes.guess_type(filename)
+        return file_response(file_path, stat, mime_type or 'application/octet-stream', as_attachment=True,
+                             download_name=filename, etag=blob_digest(stat, request.args.get('sha256')))
         
+    except HTTPException:
+        raise
     except Exception as e:
         app.logger.error(f"Error downloading attachment: {e}")
         abort(500)
@@ -62,15 +456,7 @@ def download_attachment(user_name, email_id, filename):
 @app.route('/attachments/<user_name>/<email_id>/<filename>/info')
 def attachment_info(user_name, email_id, filename):
     try:
-        file_path = safe_join(ATTACHMENT_BASE_PATH, user_name, email_id, filename)
-        
-        if not file_path or not os.path.exists(file_path):
-            abort(404)
-        
-        if not is_safe_path(file_path):
-            abort(403)
-        
-        stat = os.stat(file_path)
+        file_path, stat = resolve_attachment(user_name, email_id, filename)
         mime_type, _ = mimetypes.guess_type(filename)
         
         return jsonify({
@@ -80,17 +466,161 @@ def attachment_info(user_name, email_id, filename):
             'modified': stat.st_mtime
         })
         
+    except HTTPException:
+        raise
     except Exception as e:
         app.logger.error(f"Error getting attachment info: {e}")
         abort(500)
 
+@app.route('/attachments/<user_name>/<email_id>')
+def attachment_manifest(user_name, email_id):
+    # All attachments of one email in one response
+    try:
+        attachments = email_manifest(user_name, email_id)
+        if attachments is None:
+            abort(404)
+        return jsonify({'user': user_name, 'email_id': email_id, 'attachments': attachments})
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        app.logger.error(f"Error listing attachments: {e}")
+        abort(500)
+
+@app.route('/attachments/manifest', methods=['POST'])
+def attachment_manifests():
+    # Attachments of many emails (e.g. a page of search results) in one round trip.
+    # Body: {"emails": [{"user": ..., "email_id": ...}, ...]}; unknown emails map to null
+    try:
+        payload = request.get_json(silent=True) or {}
+        emails = payload.get('emails')
+        if not isinstance(emails, list):
+            abort(400)
+        if len(emails) > MANIFEST_MAX_EMAILS:
+            abort(413)
+
+        results = []
+        for email in emails:
+            if not isinstance(email, dict) or not email.get('user') or not email.get('email_id'):
+                abort(400)
+            user_name, email_id = str(email['user']), str(email['email_id'])
+            results.append({
+                'user': user_name,
+                'email_id': email_id,
+                'attachments': local_manifest(user_name, email_id),
+            })
+        # the emails without a local directory are looked up in the object store's documents at once
+        missing = [(r['user'], r['email_id']) for r in results if r['attachments'] is None]
+        if missing:
+            found = object_manifests(missing)
+            for result in results:
+                if result['attachments'] is None:
+                    result['attachments'] = found.get((result['user'], result['email_id']))
+        return jsonify({'emails': results})
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        app.logger.error(f"Error listing attachments: {e}")
+        abort(500)
+
+@app.route('/objects/<path:object_name>')
+def serve_object(object_name):
+    # Attachments ingested with --store minio; ?filename= names the file, ?download=1 forces a download
+    try:
+        if not OBJECT_NAME_RE.match(object_name):
+            abort(404)
+        download_name = request.args.get('filename') or os.path.basename(object_name)
+        as_attachment = request.args.get('download', '').lower() in ('1', 'true', 'yes')
+        _, ext = os.path.splitext(download_name)
+        if not as_attachment and ext.lower() not in ALLOWED_EXTENSIONS:
+            abort(403)
+        mime_type, _ = mimetypes.guess_type(download_name)
+        mime_type = mime_type or 'application/octet-stream'
+        # the object name is the content hash, so revalidation needs no MinIO round trip
+        etag = object_name.split('/')[1][:64]
+        if not is_resource_modified(request.environ, etag=etag):
+            return Response(status=304, headers=cache_headers(etag))
+
+        minio = get_minio()
+        if MINIO_SERVE_MODE == 'redirect':
+            url = minio['signer'].presigned_get_object(
+                MINIO_BUCKET, object_name, expires=timedelta(seconds=MINIO_PRESIGN_EXPIRES),
+                response_headers={
+                    'response-content-type': mime_type,
+                    'response-content-disposition': content_disposition(download_name, as_attachment),
+                },
+            )
+            response = redirect(url, code=302)
+            response.headers['Cache-Control'] = 'no-store'
+            return response
+
+        cache = minio['cache']
+        file_path = cache.lookup(object_name) if cache else None
+        if file_path is None:
+            from minio.error import S3Error
+            try:
+                info = minio['client'].stat_object(MINIO_BUCKET, object_name)
+            except S3Error as e:
+                if e.code in ('NoSuchKey', 'NoSuchObject'):
+                    abort(404)
+                raise
+            if cache is None or info.size > OBJECT_CACHE_MAX_OBJECT:
+                return stream_object(minio['client'], object_name, info, mime_type, as_attachment, download_name, etag)
+            file_path = cache.fetch(object_name, lambda tmp: download_object(minio['client'], object_name, tmp))
+        return file_response(file_path, os.stat(file_path), mime_type, as_attachment, download_name, etag=etag)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        app.logger.error(f"Error serving object {object_name}: {e}")
+        abort(500)
+
 @app.route('/health')
 def health_check():
     """Health check endpoint"""
     return jsonify({'status': 'healthy'})
 
+def run_gunicorn(host, port, workers, threads, worker_class):
+    # Pre-fork: each worker process serves up to `threads` requests at once (gthread) or
+    # thousands of connections (gevent); full files go out with sendfile()
+    from gunicorn.app.base import BaseApplication
+
+    class AttachmentApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'{host}:{port}')
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            self.cfg.set('worker_class', worker_class)
+            self.cfg.set('worker_connections', SERVER_CONNECTION_LIMIT)
+            self.cfg.set('keepalive', 5)
+            self.cfg.set('timeout', 300)
+
+        def load(self):
+            return app
+
+    AttachmentApplication().run()
+
+def run_waitress(host, port, threads):
+    # Windows has no fork; waitress multiplexes the sockets in one I/O loop and runs the
+    # handlers (stat, realpath, hashing) on its thread pool, so slow clients hold no thread
+    from waitress import serve
+    serve(app, host=host, port=port, threads=threads, connection_limit=SERVER_CONNECTION_LIMIT,
+          channel_timeout=300)
+
+def run(server=None, host=None, port=None, workers=None, threads=None, worker_class=None):
+    server = server or SERVER
+    host = host or SERVER_HOST
+    port = port or SERVER_PORT
+    if server == 'gunicorn':
+        run_gunicorn(host, port, workers or SERVER_WORKERS, threads or SERVER_THREADS, worker_class or SERVER_WORKER_CLASS)
+    elif server == 'waitress':
+        run_waitress(host, port, threads or SERVER_THREADS)
+    else:
+        app.run(host=host, port=port, debug=False, threaded=True)
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080, debug=False)
+    run()
 
 
 # minio.exe server C:\minio\data --address ":9000" --console-address ":9001" to run 9001 port
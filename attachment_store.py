@@ -0,0 +1,138 @@
+import os
+import mmap
+import shutil
+import hashlib
+import mimetypes
+import tempfile
+import threading
+import uuid
+
+# Content addressed attachment storage.
+# Blobs are keyed by the SHA-256 of their content, so an attachment that appears in
+# many messages or mailboxes is written (or uploaded) once.
+
+BLOB_DIR_NAME = "_blobs"
+
+_worker_temp = threading.local()
+
+
+def worker_temp_path(filename):
+    # Every worker thread writes into its own temp directory under a unique name,
+    # so attachments with the same filename never overwrite each other
+    temp_dir = getattr(_worker_temp, "path", None)
+    if temp_dir is None or not os.path.isdir(temp_dir):
+        temp_dir = tempfile.mkdtemp(prefix=f"mailsearch-{os.getpid()}-")
+        _worker_temp.path = temp_dir
+    return os.path.join(temp_dir, uuid.uuid4().hex + os.path.splitext(filename)[1].lower())
+
+
+def sha256_file(path):
+    if os.path.getsize(path) == 0:
+        return sha256_bytes(b"")
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return hashlib.sha256(mapped).hexdigest()
+
+
+def sha256_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class LocalAttachmentStore:
+    # Blobs live under <base>/_blobs/<aa>/<sha256>; the per message path
+    # <base>/<user>/<email_id>/<filename> served by attachment_server is a hard link to the blob.
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.blob_path = os.path.join(base_path, BLOB_DIR_NAME)
+        self.tmp_path = os.path.join(self.blob_path, "tmp")
+        os.makedirs(self.tmp_path, exist_ok=True)
+
+    def blob_file(self, digest):
+        return os.path.join(self.blob_path, digest[:2], digest)
+
+    def save(self, attachment, user_name, email_id, filename):
+        # Returns (sha256, path, size, is_new)
+        save_path = os.path.join(self.base_path, user_name, email_id)
+        os.makedirs(save_path, exist_ok=True)
+        file_path = os.path.join(save_path, filename)
+
+        tmp_file = os.path.join(self.tmp_path, uuid.uuid4().hex)
+        attachment.SaveAsFile(tmp_file)
+        digest = sha256_file(tmp_file)
+        blob = self.blob_file(digest)
+
+        is_new = not os.path.exists(blob)
+        if is_new:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.replace(tmp_file, blob)
+        else:
+            os.remove(tmp_file)
+
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        try:
+            os.link(blob, file_path)
+        except OSError:
+            # file systems without hard links still get a plain copy
+            shutil.copyfile(blob, file_path)
+
+        return digest, file_path, os.path.getsize(blob), is_new
+
+
+class MinioAttachmentStore:
+    # Objects are named <aa>/<sha256><ext>; existing objects are not uploaded again
+    def __init__(self, client, bucket_name):
+        self.client = client
+        self.bucket_name = bucket_name
+        self._known = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def object_name(digest, filename):
+        return f"{digest[:2]}/{digest}{os.path.splitext(filename)[1].lower()}"
+
+    def exists(self, object_name):
+        with self._lock:
+            if object_name in self._known:
+                return True
+        try:
+            self.client.stat_object(self.bucket_name, object_name)
+        except Exception:
+            return False
+        with self._lock:
+            self._known.add(object_name)
+        return True
+
+    def put_file(self, file_path, filename, digest=None):
+        # Hashes and uploads a file from one memory mapping: the pages are read once,
+        # and neither the hash nor the upload copies the whole file into Python memory.
+        # With a known digest an existing object is skipped without reading the file.
+        # Returns (sha256, object_name, size, is_new)
+        size = os.path.getsize(file_path)
+        if digest is not None and self.exists(self.object_name(digest, filename)):
+            return digest, self.object_name(digest, filename), size, False
+
+        with open(file_path, "rb") as f:
+            if size == 0:
+                digest = sha256_bytes(b"")
+                object_name, is_new = self.put(digest, filename, f, 0)
+                return digest, object_name, 0, is_new
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if digest is None:
+                    digest = hashlib.sha256(mapped).hexdigest()
+                    mapped.seek(0)
+                object_name, is_new = self.put(digest, filename, mapped, size)
+        return digest, object_name, size, is_new
+
+    def put(self, digest, filename, data, length):
+        # data is any object with read(n). The object is named by the content hash, so the
+        # content was read in full before and its length is always known. Returns (object_name, is_new)
+        object_name = self.object_name(digest, filename)
+        if self.exists(object_name):
+            return object_name, False
+
+        content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        self.client.put_object(self.bucket_name, object_name, data=data, length=length,
+                               content_type=content_type)
+        with self._lock:
+            self._known.add(object_name)
+        return object_name, True
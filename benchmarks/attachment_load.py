@@ -0,0 +1,173 @@
+import sys
+import time
+import json
+import random
+import asyncio
+import argparse
+from urllib.parse import urlsplit
+
+# Load test for attachment_server, standard library only.
+# Opens --concurrency keep-alive connections and issues --requests GETs spread over the
+# given URLs, then reports throughput and latency percentiles.
+#
+#   python benchmarks/attachment_load.py http://127.0.0.1:8080/attachments/u/e/a.pdf -c 1000 -n 20000
+#   python benchmarks/attachment_load.py --urls urls.txt -c 500 --range "bytes=0-65535"
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed")
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    size = 0
+    if status in (204, 304):
+        pass
+    elif "content-length" in headers:
+        size = int(headers["content-length"])
+        await reader.readexactly(size)
+    elif headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            chunk_size = int((await reader.readline()).split(b";")[0], 16)
+            await reader.readexactly(chunk_size + 2)
+            size += chunk_size
+            if chunk_size == 0:
+                break
+    else:
+        size = len(await reader.read())
+        headers["connection"] = "close"
+    return status, size, headers.get("connection", "").lower() != "close"
+
+
+class Connection:
+    def __init__(self, host, port, ssl):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.reader = None
+        self.writer = None
+
+    async def request(self, path, extra_headers):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+        head = f"GET {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n{extra_headers}\r\n"
+        self.writer.write(head.encode("latin-1"))
+        await self.writer.drain()
+        status, size, keep_alive = await read_response(self.reader)
+        if not keep_alive:
+            self.close()
+        return status, size
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def worker(targets, counter, total, extra_headers, results):
+    connections = {}
+    while counter[0] < total:
+        counter[0] += 1
+        url = random.choice(targets)
+        key = (url.hostname, url.port, url.scheme)
+        conn = connections.get(key)
+        if conn is None:
+            conn = connections[key] = Connection(url.hostname, url.port or (443 if url.scheme == "https" else 80),
+                                                 url.scheme == "https" or None)
+        path = url.path + (f"?{url.query}" if url.query else "")
+        started = time.perf_counter()
+        try:
+            status, size = await conn.request(path, extra_headers)
+            results.append((time.perf_counter() - started, status, size))
+        except Exception as e:
+            conn.close()
+            results.append((time.perf_counter() - started, type(e).__name__, 0))
+    for conn in connections.values():
+        conn.close()
+
+
+async def run(urls, concurrency, total, extra_headers):
+    targets = [urlsplit(u) for u in urls]
+    counter = [0]
+    results = []
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(targets, counter, total, extra_headers, results) for _ in range(concurrency)))
+    return results, time.perf_counter() - started
+
+
+def summarize(results, elapsed):
+    latencies = sorted(r[0] for r in results)
+    statuses = {}
+    for _, status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    transferred = sum(r[2] for r in results)
+    ok = sum(1 for r in results if isinstance(r[1], int) and r[1] < 400)
+    return {
+        "requests": len(results),
+        "ok": ok,
+        "errors": len(results) - ok,
+        "statuses": statuses,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(len(results) / elapsed, 1) if elapsed else 0,
+        "mb_per_s": round(transferred / elapsed / 1024 / 1024, 2) if elapsed else 0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p90": round(percentile(latencies, 90) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2) if latencies else 0,
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="attachment_server load test")
+    parser.add_argument("url", nargs="*", help="attachment URLs, requested in random order")
+    parser.add_argument("--urls", help="file with one URL per line")
+    parser.add_argument("-c", "--concurrency", type=int, default=100, help="open connections")
+    parser.add_argument("-n", "--requests", type=int, default=10000, help="total requests")
+    parser.add_argument("--range", help='Range header to send, e.g. "bytes=0-65535"')
+    parser.add_argument("--header", action="append", default=[], help='extra header, "Name: value"')
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON only")
+    opts = parser.parse_args(argv)
+
+    urls = list(opts.url)
+    if opts.urls:
+        with open(opts.urls, encoding="utf-8") as f:
+            urls += [line.strip() for line in f if line.strip()]
+    if not urls:
+        parser.error("no URLs given")
+
+    headers = list(opts.header)
+    if opts.range:
+        headers.append(f"Range: {opts.range}")
+    extra_headers = "".join(f"{h}\r\n" for h in headers)
+
+    results, elapsed = asyncio.run(run(urls, opts.concurrency, opts.requests, extra_headers))
+    summary = summarize(results, elapsed)
+    if opts.json:
+        print(json.dumps(summary))
+    else:
+        latency = summary["latency_ms"]
+        print(f"{summary['requests']} requests in {summary['elapsed_s']}s "
+              f"({summary['requests_per_s']} req/s, {summary['mb_per_s']} MB/s), {summary['errors']} errors")
+        print(f"latency p50 {latency['p50']} ms, p90 {latency['p90']} ms, p99 {latency['p99']} ms, max {latency['max']} ms")
+        print(f"statuses {summary['statuses']}")
+    return 0 if summary["errors"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
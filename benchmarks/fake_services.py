@@ -0,0 +1,336 @@
+import gzip
+import json
+import time
+import uuid
+import hashlib
+import threading
+from email.utils import formatdate
+from fnmatch import fnmatch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+# Local stand-ins for Elasticsearch and MinIO, so the ingest benchmark measures the ingester
+# and not a cluster. Both speak just enough HTTP for the official clients: the Elasticsearch
+# fake acknowledges every bulk item and the index management calls IndexManager makes, the
+# MinIO fake keeps object sizes (not contents) for stat/put and multipart uploads. Each runs
+# a threaded server in the calling process and counts what it received.
+#
+#   with FakeElasticsearch() as es, FakeMinio() as minio:
+#       os.environ["ELASTIC_HOST"] = es.url
+#       os.environ["MINIO_ENDPOINT"] = minio.endpoint
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # the clients keep a pool of connections each
+    request_queue_size = 256
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    service = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        self.service.count(request_bytes=len(body))
+        if self.headers.get("Content-Encoding", "").lower() == "gzip":
+            body = gzip.decompress(body)
+        return body
+
+    def reply(self, status, body=b"", headers=None, content_type="application/json"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body or self.command != "HEAD":
+            self.send_header("Content-Type", content_type)
+        if "Content-Length" not in (headers or {}):
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def handle_one_request(self):
+        self.service.count(requests=1)
+        super().handle_one_request()
+
+
+class FakeService:
+    handler = None
+
+    def __init__(self, host="127.0.0.1", port=0):
+        handler = type(self.handler.__name__, (self.handler,), {"service": self})
+        self._server = _Server((host, port), handler)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {}
+        self.reset()
+
+    @property
+    def endpoint(self):
+        host, port = self._server.server_address[:2]
+        return f"{host}:{port}"
+
+    @property
+    def url(self):
+        return f"http://{self.endpoint}"
+
+    def reset(self):
+        with self._lock:
+            self.stats = {"requests": 0, "request_bytes": 0}
+
+    def count(self, **values):
+        with self._lock:
+            for name, value in values.items():
+                self.stats[name] = self.stats.get(name, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+class _ElasticsearchHandler(_Handler):
+    def reply(self, status, body=b"", headers=None, content_type="application/json"):
+        # the client refuses servers that do not identify as Elasticsearch
+        super().reply(status, body, dict(headers or {}, **{"X-Elastic-Product": "Elasticsearch"}), content_type)
+
+    def do_HEAD(self):
+        name = unquote(urlsplit(self.path).path.strip("/").split("/")[0])
+        self.read_body()
+        self.reply(200 if name and self.service.index_exists(name) else 404)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path.strip("/")
+        self.read_body()
+        if not path:
+            self.reply(200, {"name": "fake", "cluster_name": "benchmark", "version": {"number": "8.15.0"},
+                             "tagline": "You Know, for Search"})
+        elif path.endswith("_settings") or "/_settings/" in path:
+            self.reply(200, {})
+        else:
+            self.reply(200, {"acknowledged": True})
+
+    def do_PUT(self):
+        path = unquote(urlsplit(self.path).path.strip("/"))
+        body = self.read_body()
+        if path.endswith("_bulk"):
+            return self.bulk(body, path)
+        if path and "/" not in path and not path.startswith("_"):
+            if not self.service.create_index(path):
+                return self.reply(400, {"error": {"type": "resource_already_exists_exception"}, "status": 400})
+            return self.reply(200, {"acknowledged": True, "shards_acknowledged": True, "index": path})
+        self.reply(200, {"acknowledged": True})
+
+    def do_POST(self):
+        path = unquote(urlsplit(self.path).path.strip("/"))
+        body = self.read_body()
+        if path.endswith("_bulk"):
+            return self.bulk(body, path)
+        if path.endswith("_delete_by_query"):
+            # stale attachment chunks; the fake keeps no documents, so there are never any
+            self.service.count(delete_by_query=1)
+            return self.reply(200, {"took": 0, "deleted": 0, "failures": []})
+        self.reply(200, {"acknowledged": True})
+
+    def do_DELETE(self):
+        self.read_body()
+        self.reply(200, {"acknowledged": True})
+
+    def bulk(self, body, path):
+        started = time.perf_counter()
+        default_index = path[:-len("_bulk")].strip("/") or None
+        items = []
+        lines = body.splitlines()
+        i = 0
+        while i < len(lines):
+            if not lines[i].strip():
+                i += 1
+                continue
+            operation, meta = next(iter(json.loads(lines[i]).items()))
+            i += 1 if operation == "delete" else 2
+            items.append({operation: {
+                "_index": meta.get("_index", default_index),
+                "_id": meta.get("_id") or uuid.uuid4().hex,
+                "status": 200 if operation in ("update", "delete") else 201,
+                "result": {"update": "updated", "delete": "deleted"}.get(operation, "created"),
+            }})
+        if self.service.latency:
+            time.sleep(self.service.latency)
+        self.service.count(bulk_requests=1, documents=len(items), bulk_bytes=len(body))
+        self.reply(200, {"took": int((time.perf_counter() - started) * 1000), "errors": False, "items": items})
+
+
+class FakeElasticsearch(FakeService):
+    handler = _ElasticsearchHandler
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        # latency: seconds added to every bulk request, a stand-in for the cluster's indexing time
+        self.latency = latency
+        self._indices = set()
+        super().__init__(host, port)
+
+    def reset(self):
+        super().reset()
+        with self._lock:
+            self._indices = set()
+
+    def create_index(self, name):
+        with self._lock:
+            if name in self._indices:
+                return False
+            self._indices.add(name)
+            return True
+
+    def index_exists(self, names):
+        # a comma separated list of names or wildcard patterns; aliases are not kept
+        with self._lock:
+            return all(any(fnmatch(index, name) for index in self._indices) for name in names.split(","))
+
+
+_S3_NS = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+
+class _MinioHandler(_Handler):
+    def target(self):
+        parts = urlsplit(self.path)
+        bucket, _, key = unquote(parts.path).lstrip("/").partition("/")
+        return bucket, key, parse_qs(parts.query, keep_blank_values=True)
+
+    def xml(self, status, body):
+        self.reply(status, f'<?xml version="1.0" encoding="UTF-8"?>{body}'.encode("utf-8"),
+                   content_type="application/xml")
+
+    def not_found(self, code):
+        if self.command == "HEAD":
+            return self.reply(404)
+        self.xml(404, f"<Error><Code>{code}</Code><Message>{code}</Message><Resource>{self.path}</Resource>"
+                      f"<RequestId>fake</RequestId><HostId>fake</HostId></Error>")
+
+    def do_HEAD(self):
+        bucket, key, _ = self.target()
+        self.read_body()
+        if not self.service.has_bucket(bucket):
+            return self.not_found("NoSuchBucket")
+        if not key:
+            return self.reply(200)
+        entry = self.service.get_object(bucket, key)
+        if entry is None:
+            return self.not_found("NoSuchKey")
+        size, etag = entry
+        self.reply(200, headers={"Content-Length": str(size), "ETag": f'"{etag}"',
+                                 "Last-Modified": formatdate(usegmt=True)}, content_type="application/octet-stream")
+
+    def do_GET(self):
+        bucket, key, query = self.target()
+        self.read_body()
+        if not key and "location" in query:
+            return self.xml(200, f'<LocationConstraint xmlns="{_S3_NS}"></LocationConstraint>')
+        self.not_found("NoSuchKey")
+
+    def do_PUT(self):
+        bucket, key, query = self.target()
+        body = self.read_body()
+        if not key:
+            self.service.add_bucket(bucket)
+            return self.reply(200, headers={"Location": f"/{bucket}"})
+        etag = hashlib.md5(body).hexdigest()
+        if "uploadId" in query:
+            self.service.add_part(query["uploadId"][0], len(body))
+        else:
+            self.service.put_object(bucket, key, len(body), etag)
+        self.reply(200, headers={"ETag": f'"{etag}"'})
+
+    def do_POST(self):
+        bucket, key, query = self.target()
+        self.read_body()
+        if "uploads" in query:
+            upload_id = self.service.start_upload()
+            return self.xml(200, f'<InitiateMultipartUploadResult xmlns="{_S3_NS}"><Bucket>{bucket}</Bucket>'
+                                 f'<Key>{key}</Key><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>')
+        if "uploadId" in query:
+            size = self.service.finish_upload(query["uploadId"][0])
+            etag = f"{uuid.uuid4().hex}-1"
+            self.service.put_object(bucket, key, size, etag)
+            return self.xml(200, f'<CompleteMultipartUploadResult xmlns="{_S3_NS}"><Location>/{bucket}/{key}</Location>'
+                                 f'<Bucket>{bucket}</Bucket><Key>{key}</Key><ETag>"{etag}"</ETag>'
+                                 f'</CompleteMultipartUploadResult>')
+        self.reply(400)
+
+    def do_DELETE(self):
+        bucket, key, _ = self.target()
+        self.read_body()
+        self.service.delete_object(bucket, key)
+        self.reply(204)
+
+
+class FakeMinio(FakeService):
+    handler = _MinioHandler
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self._buckets = set()
+        self._objects = {}
+        self._uploads = {}
+        super().__init__(host, port)
+
+    def reset(self):
+        super().reset()
+        with self._lock:
+            self._buckets = set()
+            self._objects = {}
+            self._uploads = {}
+
+    def has_bucket(self, bucket):
+        with self._lock:
+            return bucket in self._buckets
+
+    def add_bucket(self, bucket):
+        with self._lock:
+            self._buckets.add(bucket)
+
+    def get_object(self, bucket, key):
+        with self._lock:
+            return self._objects.get((bucket, key))
+
+    def put_object(self, bucket, key, size, etag):
+        with self._lock:
+            self._objects[(bucket, key)] = (size, etag)
+            self.stats["objects"] = self.stats.get("objects", 0) + 1
+            self.stats["object_bytes"] = self.stats.get("object_bytes", 0) + size
+
+    def delete_object(self, bucket, key):
+        with self._lock:
+            self._objects.pop((bucket, key), None)
+
+    def start_upload(self):
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._uploads[upload_id] = 0
+        return upload_id
+
+    def add_part(self, upload_id, size):
+        with self._lock:
+            self._uploads[upload_id] = self._uploads.get(upload_id, 0) + size
+
+    def finish_upload(self, upload_id):
+        with self._lock:
+            return self._uploads.pop(upload_id, 0)
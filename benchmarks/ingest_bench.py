@@ -0,0 +1,563 @@
+import os
+import sys
+import copy
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from argparse import Namespace
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from fake_services import FakeElasticsearch, FakeMinio  # noqa: E402
+from synthetic_mailbox import SyntheticMailbox, iter_messages, parse_mix  # noqa: E402
+
+# Ingest benchmark: synthetic mailboxes through the real ingest code, against local stand-ins
+# for Elasticsearch and MinIO (fake_services), so runs are reproducible on any machine.
+#
+# Stages, each measured on its own with mailbox 0:
+#   read       read_folder with saving and indexing cut off: message access, document building, AD lookups
+#   save       save_attachments into the configured store (uploads awaited), no text extraction
+#   extract    the extraction pool over every attachment, per --workers count
+#   index      BulkIndexer with the documents read above, per --bulk-docs size
+# and end_to_end: every mailbox through read_folder in a pool of ingest worker processes, as
+# `mailsearch ingest` runs them, for every --workers x --bulk-docs combination.
+#
+# Every row reports throughput and the peak resident memory seen while the stage ran
+# (this process and its children with psutil installed, this process alone otherwise).
+# The results are written as JSON; --compare prints the change against an earlier file.
+#
+#   python benchmarks/ingest_bench.py --messages 2000 --mailboxes 4 --workers 1,2,4 --bulk-docs 500,2000
+#   python benchmarks/ingest_bench.py --store minio --compare benchmarks/results/ingest-20240101-120000.json
+
+STAGES = ("read", "save", "extract", "index", "end_to_end")
+RATE_FIELDS = ("messages", "attachments", "documents")
+
+
+def parse_size(text):
+    text = str(text).strip().lower()
+    factor = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}.get(text[-1:], 1)
+    return int(float(text[:-1] if factor > 1 else text) * factor)
+
+
+def parse_ints(text):
+    return [int(value) for value in str(text).split(",") if value.strip()]
+
+
+def rss_bytes(children=False):
+    # Resident memory of this process (and its children), None when it cannot be read
+    try:
+        import psutil
+        process = psutil.Process()
+        total = process.memory_info().rss
+        if children:
+            for child in process.children(recursive=True):
+                try:
+                    total += child.memory_info().rss
+                except psutil.Error:
+                    pass
+        return total
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss_mb():
+    # peak of the calling process over its lifetime, used by the end_to_end workers
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 ** 2 if sys.platform == "darwin" else 1024), 1)
+
+
+class MemorySampler:
+    # Samples resident memory on a background thread while a stage runs
+    def __init__(self, interval=0.05, children=True):
+        self.interval = interval
+        self.children = children
+        self.start_bytes = None
+        self.peak_bytes = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        value = rss_bytes(self.children)
+        if value is not None:
+            self.peak_bytes = max(self.peak_bytes or 0, value)
+        return value
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self.start_bytes = self._sample()
+        self._thread = threading.Thread(target=self._run, name="memory-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def result(self):
+        if self.start_bytes is None:
+            return {"start_mb": None, "peak_mb": None}
+        return {"start_mb": round(self.start_bytes / 1024 ** 2, 1), "peak_mb": round(self.peak_bytes / 1024 ** 2, 1)}
+
+
+def with_rates(row, seconds):
+    row["seconds"] = round(seconds, 3)
+    for name in RATE_FIELDS:
+        if name in row:
+            row[f"{name}_per_s"] = round(row[name] / seconds, 1) if seconds else None
+    if "bytes" in row:
+        row["mb_per_s"] = round(row["bytes"] / 1024 ** 2 / seconds, 2) if seconds else None
+    return row
+
+
+def measure(stage, run, **fields):
+    # run() returns the counts of the stage
+    with MemorySampler() as sampler:
+        started = time.perf_counter()
+        counts = run()
+        seconds = time.perf_counter() - started
+    row = with_rates(dict({"stage": stage}, **fields, **counts), seconds)
+    row["memory"] = sampler.result()
+    print_row(row)
+    return row
+
+
+def print_row(row):
+    setting = " ".join(f"{name}={row[name]}" for name in ("workers", "bulk_docs") if name in row)
+    rates = ", ".join(f"{row[f'{name}_per_s']} {name}/s" for name in RATE_FIELDS if f"{name}_per_s" in row)
+    if "mb_per_s" in row:
+        rates += f", {row['mb_per_s']} MB/s"
+    peak = row.get("memory", {}).get("peak_mb")
+    print(f"{row['stage']:<11}{setting:<24}{row['seconds']:>9.2f}s  {rates}  peak {peak} MB")
+
+
+@contextmanager
+def patched(module, **attributes):
+    saved = {name: getattr(module, name) for name in attributes}
+    for name, value in attributes.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(module, name, value)
+
+
+class DocumentSink:
+    # Stands in for the BulkIndexer during the read stage and keeps what it was given
+    def __init__(self):
+        self.actions = []
+
+    def add(self, action, tag=None):
+        self.actions.append(action)
+
+
+class NoExtraction:
+    # Stands in for the ExtractionPool during the save stage
+    def submit(self, file_path, on_done=None, digest=None, data=None):
+        future = Future()
+        future.set_result("")
+        if on_done is not None:
+            future.add_done_callback(on_done)
+        return future
+
+
+def ingest_options(opts, attachments_path, workers=1):
+    # the namespace `mailsearch ingest` hands to ingest.configure()
+    return Namespace(source="", backend="synthetic", store=opts.store, attachments_path=attachments_path,
+                     workers=workers, attachment_text=opts.attachment_text, bulk_load=False, forcemerge=False,
+                     dedup=opts.dedup, spool=None)
+
+
+def mailbox_spec(opts):
+    return {
+        "messages": opts.messages,
+        "attachment_rate": opts.attachment_rate,
+        "mix": parse_mix(opts.mix) if opts.mix else None,
+        "attachment_size": parse_size(opts.attachment_size),
+        "body_size": parse_size(opts.body_size),
+        "duplicates": opts.duplicates,
+        "seed": opts.seed,
+    }
+
+
+def stage_read(root, user_name):
+    import ingest
+
+    sink = DocumentSink()
+    attachment_count = [0]
+
+    def read_attachments(message, user, email_id):
+        # the attachment bytes are read, their text is filled in by the index stage
+        attachments = []
+        for attachment in message.Attachments:
+            attachments.append({"filename": attachment.FileName, "size": len(attachment.read()),
+                                "text": attachment_count[0]})
+            attachment_count[0] += 1
+        return attachments
+
+    def run():
+        with patched(ingest, save_attachments=read_attachments, get_indexer=lambda: sink):
+            messages = ingest.read_folder(root, user_name)
+        return {"messages": messages, "attachments": attachment_count[0]}
+
+    return measure("read", run), sink.actions
+
+
+def stage_save(root, user_name, store):
+    import ingest
+
+    def run():
+        messages = attachments = size = 0
+        uploads = []
+        with patched(ingest, get_extraction_pool=NoExtraction):
+            for message in iter_messages(root):
+                saved = ingest.save_attachments(message, user_name, message.EntryID)
+                messages += 1
+                attachments += len(saved)
+                size += sum(a["size"] for a in saved)
+                uploads.extend(a["_upload"] for a in saved if "_upload" in a)
+            for upload in uploads:
+                upload.result()
+        return {"messages": messages, "attachments": attachments, "bytes": size}
+
+    return measure("save", run, store=store)
+
+
+def stage_extract(files, workers):
+    from extract_pool import ExtractionPool
+
+    texts = []
+
+    def run():
+        pool = ExtractionPool(max_workers=workers, text_cache=None)
+        try:
+            futures = [pool.submit(name, digest=digest, data=content) for name, content, digest in files]
+            texts.extend(future.result() for future in futures)
+        finally:
+            pool.shutdown()
+        return {"attachments": len(files), "bytes": sum(len(f[1]) for f in files),
+                "chars": sum(len(text) for text in texts)}
+
+    return measure("extract", run, workers=workers), texts
+
+
+def stage_index(actions, texts, bulk_docs, es):
+    import ingest
+    from bulk_indexer import BulkIndexer
+    from attachment_chunks import ChunkSplitter, cap_attachment_text
+
+    # the read stage left the attachment number in place of its text
+    documents = copy.deepcopy(actions)
+    for action in documents:
+        for attachment in action["_source"]["attachments"]:
+            attachment["text"] = texts[attachment["text"]] if texts else ""
+    steps = [ChunkSplitter(ingest.get_chunk_index_manager().index_for)
+             if ingest.options.attachment_text == "chunks" else cap_attachment_text]
+    if ingest.options.dedup != "off":
+        from dedup import to_upserts
+        steps.append(to_upserts)
+
+    def prepare(batch):
+        for step in steps:
+            batch = step(batch)
+        return batch
+
+    def run():
+        es.reset()
+        indexer = BulkIndexer(ingest.get_es(), prepare=prepare, min_docs=bulk_docs, max_docs=bulk_docs).start()
+        for action in documents:
+            indexer.add(action)
+        indexer.close()
+        received = es.snapshot()
+        return {"documents": len(documents), "indexed": indexer.indexed, "failed": indexer.failed,
+                "bulk_requests": received.get("bulk_requests", 0), "es_documents": received.get("documents", 0),
+                "bytes": received.get("bulk_bytes", 0)}
+
+    return measure("index", run, bulk_docs=bulk_docs)
+
+
+def _init_worker(options, environment):
+    # before ingest (and the modules reading their settings from the environment) is imported
+    os.environ.update(environment)
+    import ingest
+    ingest.configure(options)
+
+
+def _ingest_mailbox(task):
+    # One mailbox per task, like process_pst_file() handles one PST
+    import ingest
+    from checkpoint import SourceProgress
+
+    index, spec = task
+    mailbox = SyntheticMailbox(index=index, **spec)
+    root = mailbox.build()
+    progress = SourceProgress(ingest.get_checkpoint_store(), f"synthetic/{mailbox.user_name}")
+
+    started = time.time()
+    messages = ingest.read_folder(root, mailbox.user_name, progress)
+    indexer = ingest.get_indexer()
+    indexer.flush()
+    finished = time.time()
+
+    indexed = failed = 0
+    for tag in progress.folder_tags:
+        tag_indexed, tag_failed = indexer.pop_counts(tag)
+        indexed += tag_indexed
+        failed += tag_failed
+    return dict(mailbox.stats, messages=messages, indexed=indexed, failed=failed, errors=progress.errors,
+                started=started, finished=finished, peak_rss_mb=peak_rss_mb())
+
+
+def stage_end_to_end(opts, spec, workers, bulk_docs, workdir, es, minio):
+    import ingest
+
+    run_dir = os.path.join(workdir, f"end_to_end-{workers}-{bulk_docs}")
+    os.makedirs(run_dir, exist_ok=True)
+    options = ingest_options(opts, os.path.join(run_dir, "attachments"), workers)
+    environment = {
+        "BULK_MIN_DOCS": str(bulk_docs),
+        "BULK_MAX_DOCS": str(bulk_docs),
+        "CHECKPOINT_PATH": os.path.join(run_dir, "checkpoint.db"),
+        "DEDUP_PATH": os.path.join(run_dir, "dedup.db"),
+    }
+    if opts.extract_workers is not None:
+        environment["EXTRACT_WORKERS"] = str(opts.extract_workers)
+
+    es.reset()
+    minio.reset()
+    if opts.store == "minio":
+        ingest.ensure_bucket()
+
+    results = []
+
+    def run():
+        # spawn everywhere: fresh interpreters read the environment above, as on Windows
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(options, environment)) as pool:
+            results.extend(pool.map(_ingest_mailbox, [(index, spec) for index in range(opts.mailboxes)]))
+        return {}
+
+    with MemorySampler() as sampler:
+        started = time.perf_counter()
+        run()
+        wall = time.perf_counter() - started
+
+    # throughput over the time the workers spent ingesting, without start up and mailbox generation
+    seconds = max(r["finished"] for r in results) - min(r["started"] for r in results)
+    received = es.snapshot()
+    row = with_rates({
+        "stage": "end_to_end",
+        "workers": workers,
+        "bulk_docs": bulk_docs,
+        "store": opts.store,
+        "mailboxes": len(results),
+        "messages": sum(r["messages"] for r in results),
+        "indexed": sum(r["indexed"] for r in results),
+        "failed": sum(r["failed"] for r in results),
+        "errors": sum(r["errors"] for r in results),
+        "attachments": sum(r["attachments"] for r in results),
+        "bytes": sum(r["attachment_bytes"] for r in results),
+        "bulk_requests": received.get("bulk_requests", 0),
+        "es_documents": received.get("documents", 0),
+        "wall_seconds": round(wall, 3),
+    }, seconds)
+    worker_peaks = [r["peak_rss_mb"] for r in results if r["peak_rss_mb"] is not None]
+    row["memory"] = dict(sampler.result(), worker_peak_mb=max(worker_peaks) if worker_peaks else None)
+    print_row(row)
+    return row
+
+
+def row_key(row):
+    return (row["stage"], row.get("workers"), row.get("bulk_docs"), row.get("store"))
+
+
+def compare(previous, current):
+    # Throughput change of every row also present in the earlier results
+    earlier = {row_key(row): row for row in previous.get("results", [])}
+    print(f"Compared with {previous.get('meta', {}).get('started', 'earlier run')}:")
+    for row in current["results"]:
+        old = earlier.get(row_key(row))
+        if old is None:
+            continue
+        for name in RATE_FIELDS:
+            field = f"{name}_per_s"
+            if row.get(field) and old.get(field):
+                change = (row[field] - old[field]) / old[field] * 100
+                setting = " ".join(f"{k}={row[k]}" for k in ("workers", "bulk_docs") if k in row)
+                print(f"  {row['stage']:<11}{setting:<24}{old[field]:>10} -> {row[field]:<10} {name}/s ({change:+.1f}%)")
+                break
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ingest benchmark with synthetic mailboxes")
+    parser.add_argument("--messages", type=int, default=1000, help="messages per mailbox")
+    parser.add_argument("--mailboxes", type=int, default=4, help="mailboxes ingested by the end_to_end stage")
+    parser.add_argument("--attachment-rate", type=float, default=0.5, help="share of messages with attachments")
+    parser.add_argument("--mix", help='attachment kinds and weights, e.g. "pdf=2,docx=2,xlsx=1,txt=1,zip=1,bin=3"')
+    parser.add_argument("--attachment-size", default="64k", help="average attachment size")
+    parser.add_argument("--body-size", default="2k", help="average body size")
+    parser.add_argument("--duplicates", type=float, default=0.1,
+                        help="share of copied messages and of attachments drawn from a shared pool")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--store", choices=("local", "minio"), default="local")
+    parser.add_argument("--attachment-text", choices=("inline", "chunks"),
+                        help="default: chunks with --dedup, otherwise inline")
+    parser.add_argument("--dedup", choices=("off", "message", "near"), default="off",
+                        help="index copied messages once (see dedup.py)")
+    parser.add_argument("--workers", default="1,2,4", help="extraction pool sizes and ingest worker counts")
+    parser.add_argument("--extract-workers", type=int, help="extraction processes per ingest worker in end_to_end")
+    parser.add_argument("--bulk-docs", default="500,2000", help="documents per bulk request")
+    parser.add_argument("--es-latency", type=float, default=0.0, help="milliseconds added to every bulk request")
+    parser.add_argument("--stages", default=",".join(STAGES), help="stages to run")
+    parser.add_argument("--text-cache", action="store_true", help="keep the extracted text cache between stages")
+    parser.add_argument("--workdir", help="scratch directory, a temporary one is used and removed by default")
+    parser.add_argument("--output", help="results file, default benchmarks/results/ingest-<time>.json")
+    parser.add_argument("--compare", help="earlier results file to compare with")
+    opts = parser.parse_args(argv)
+    if opts.attachment_text is None:
+        opts.attachment_text = "chunks" if opts.dedup != "off" else "inline"
+    elif opts.dedup != "off" and opts.attachment_text != "chunks":
+        parser.error("--dedup needs --attachment-text chunks")
+
+    stages = [s.strip() for s in opts.stages.split(",") if s.strip()]
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error(f"unknown stage {stage}, expected one of {', '.join(STAGES)}")
+    worker_counts = parse_ints(opts.workers)
+    bulk_sizes = parse_ints(opts.bulk_docs)
+    started = datetime.now()
+    output = os.path.abspath(opts.output or os.path.join(
+        REPO_DIR, "benchmarks", "results", f"ingest-{started.strftime('%Y%m%d-%H%M%S')}.json"))
+    previous = None
+    if opts.compare:
+        with open(opts.compare, encoding="utf-8") as f:
+            previous = json.load(f)
+
+    workdir = os.path.abspath(opts.workdir or tempfile.mkdtemp(prefix="ingest-bench-"))
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    # ingest writes its logs/ and default databases relative to the working directory
+    os.chdir(workdir)
+
+    es = FakeElasticsearch(latency=opts.es_latency / 1000).start()
+    minio = FakeMinio().start()
+    try:
+        os.environ.update({
+            "ELASTIC_HOST": es.url,
+            "ELASTIC_USER": "benchmark",
+            "ELASTIC_PASSWORD": "benchmark",
+            "MINIO_ENDPOINT": minio.endpoint,
+            "MINIO_ACCESS_KEY": "benchmark",
+            "MINIO_SECRET_KEY": "benchmark",
+            "MINIO_SECURE": "false",
+            "MINIO_BUCKET": "benchmark-attachments",
+            "CHECKPOINT_PATH": os.path.join(workdir, "checkpoint.db"),
+            "DEDUP_PATH": os.path.join(workdir, "dedup.db"),
+            "AD_CACHE_PATH": os.path.join(workdir, "ad_cache.db"),
+            "TEXT_CACHE_PATH": os.path.join(workdir, "text_cache.db") if opts.text_cache else "",
+        })
+        import ingest
+        from attachment_store import sha256_bytes
+
+        ingest.configure(ingest_options(opts, os.path.join(workdir, "attachments")))
+        if opts.store == "minio":
+            ingest.ensure_bucket()
+        if opts.dedup != "off":
+            from dedup import install_merge_script
+            install_merge_script(ingest.get_es())
+
+        spec = mailbox_spec(opts)
+        mailbox = SyntheticMailbox(index=0, **spec)
+        generate_started = time.perf_counter()
+        root = mailbox.build()
+        generated = time.perf_counter() - generate_started
+        print(f"Mailbox: {mailbox.stats} generated in {generated:.2f}s")
+
+        results = []
+        actions, texts = [], []
+        if "read" in stages or "index" in stages:
+            row, actions = stage_read(root, mailbox.user_name)
+            if "read" in stages:
+                results.append(row)
+        if "save" in stages:
+            results.append(stage_save(root, mailbox.user_name, opts.store))
+        if "extract" in stages or "index" in stages:
+            files = []
+            for message in iter_messages(root):
+                for attachment in message.Attachments:
+                    content = attachment.read()
+                    files.append((attachment.FileName, content, sha256_bytes(content)))
+            for workers in (worker_counts if "extract" in stages else worker_counts[:1]):
+                row, texts = stage_extract(files, workers)
+                if "extract" in stages:
+                    results.append(row)
+        if "index" in stages:
+            for bulk_docs in bulk_sizes:
+                results.append(stage_index(actions, texts, bulk_docs, es))
+        if "end_to_end" in stages:
+            for workers in worker_counts:
+                for bulk_docs in bulk_sizes:
+                    results.append(stage_end_to_end(opts, spec, workers, bulk_docs, workdir, es, minio))
+    finally:
+        es.stop()
+        minio.stop()
+        os.chdir(cwd)
+        if not opts.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "started": started.isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "options": vars(opts),
+        },
+        "mailbox": dict(mailbox.stats, generate_seconds=round(generated, 3)),
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+    if previous is not None:
+        compare(previous, report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,336 @@
+import io
+import os
+import sys
+import random
+import zipfile
+import hashlib
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mail_sources import ItemCollection, MailAttachment, MailFolder, MailMessage  # noqa: E402
+
+# Deterministic synthetic mailboxes for the ingest benchmark.
+# A mailbox is built from the same MailFolder / MailMessage / MailAttachment stand-ins the
+# offline backends give read_folder, fully materialised in memory so reading it costs only
+# what read_folder itself does. Every message and attachment is derived from the seed and its
+# number alone: the same arguments always produce byte-identical mailboxes, and a duplicate
+# (a message copied from an earlier number, an attachment drawn from the shared pool) is
+# identical across mailboxes as well.
+#
+#   mailbox = SyntheticMailbox(index=0, messages=2000, attachment_rate=0.5, duplicates=0.2)
+#   root = mailbox.build()
+
+# attachment kind -> relative weight
+DEFAULT_MIX = {"pdf": 2, "docx": 2, "xlsx": 1, "txt": 2, "csv": 1, "html": 1, "zip": 1, "eml": 1, "bin": 3}
+KIND_EXTENSIONS = {
+    "pdf": ".pdf", "docx": ".docx", "xlsx": ".xlsx", "txt": ".txt", "csv": ".csv", "html": ".html",
+    "zip": ".zip", "eml": ".eml", "bin": ".jpg",
+}
+# read_folder target folders and the share of messages each one gets
+FOLDER_SHARES = (("Inbox", 0.6), ("Sent Items", 0.3), ("Deleted Items", 0.1))
+
+WORDS = (
+    "account budget contract delivery invoice meeting project report schedule review quarterly "
+    "approval customer supplier payment order shipment warehouse inventory forecast revenue "
+    "expense audit compliance policy training network server backup storage migration release "
+    "deadline update summary minutes agenda proposal estimate tender procurement logistics "
+    "maintenance incident request change ticket support license renewal installation upgrade "
+    "the of and to in for on with from by at as is are was be this that will please regards"
+).split()
+# the bodies and plain text attachments also carry some Persian text, like the real mailboxes
+PERSIAN_WORDS = "گزارش جلسه قرارداد پروژه پرداخت فاکتور بودجه تحویل سفارش بررسی".split()
+
+
+def parse_mix(spec):
+    # "pdf=2,docx=1,bin=3" -> {"pdf": 2.0, "docx": 1.0, "bin": 3.0}
+    mix = {}
+    for item in spec.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in KIND_EXTENSIONS:
+            raise ValueError(f"unknown attachment kind {name}, expected one of {', '.join(KIND_EXTENSIONS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def _words(rng, chars, persian=0.0):
+    parts = []
+    length = 0
+    while length < chars:
+        word = rng.choice(PERSIAN_WORDS) if persian and rng.random() < persian else rng.choice(WORDS)
+        parts.append(word)
+        length += len(word) + 1
+    return " ".join(parts)
+
+
+def _lines(rng, chars, width=80, persian=0.0):
+    text = _words(rng, chars, persian)
+    return [text[i:i + width] for i in range(0, len(text), width)]
+
+
+def _zip(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, data in files:
+            # a fixed timestamp, writestr(name) would stamp the current time
+            archive.writestr(zipfile.ZipInfo(name, (2020, 1, 1, 0, 0, 0)), data, zipfile.ZIP_DEFLATED)
+    return buffer.getvalue()
+
+
+_RELS_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+_DOC_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+
+
+def _content_types(overrides):
+    parts = "".join(f'<Override PartName="{name}" ContentType="{kind}"/>' for name, kind in overrides)
+    return ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            f'<Default Extension="xml" ContentType="application/xml"/>{parts}</Types>')
+
+
+def _relationships(relations):
+    parts = "".join(f'<Relationship Id="rId{i + 1}" Type="{kind}" Target="{target}"/>'
+                    for i, (kind, target) in enumerate(relations))
+    return f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><Relationships xmlns="{_RELS_NS}">{parts}</Relationships>'
+
+
+def make_docx(rng, chars):
+    paragraphs = "".join(f'<w:p><w:r><w:t xml:space="preserve">{escape(line)}</w:t></w:r></w:p>'
+                         for line in _lines(rng, chars, 400, persian=0.1))
+    document = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+                f'<w:body>{paragraphs}</w:body></w:document>')
+    return _zip([
+        ("[Content_Types].xml", _content_types([
+            ("/word/document.xml",
+             "application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"),
+        ])),
+        ("_rels/.rels", _relationships([(f"{_DOC_REL}/officeDocument", "word/document.xml")])),
+        ("word/document.xml", document),
+    ])
+
+
+def make_xlsx(rng, chars):
+    columns = "ABCDEF"
+    rows = []
+    length = 0
+    while length < chars:
+        number = len(rows) + 1
+        cells = []
+        for column in columns[:3]:
+            word = escape(rng.choice(WORDS))
+            cells.append(f'<c r="{column}{number}" t="inlineStr"><is><t>{word}</t></is></c>')
+            length += len(word) + 1
+        for column in columns[3:]:
+            cells.append(f'<c r="{column}{number}"><v>{rng.randint(0, 1000000) / 100}</v></c>')
+            length += 8
+        rows.append(f'<row r="{number}">{"".join(cells)}</row>')
+    main = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+    return _zip([
+        ("[Content_Types].xml", _content_types([
+            ("/xl/workbook.xml", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"),
+            ("/xl/worksheets/sheet1.xml", "application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"),
+        ])),
+        ("_rels/.rels", _relationships([(f"{_DOC_REL}/officeDocument", "xl/workbook.xml")])),
+        ("xl/workbook.xml", f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                            f'<workbook xmlns="{main}" xmlns:r="{_DOC_REL}"><sheets>'
+                            f'<sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>'),
+        ("xl/_rels/workbook.xml.rels", _relationships([(f"{_DOC_REL}/worksheet", "worksheets/sheet1.xml")])),
+        ("xl/worksheets/sheet1.xml", f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                                     f'<worksheet xmlns="{main}"><sheetData>{"".join(rows)}</sheetData></worksheet>'),
+    ])
+
+
+def make_pdf(rng, chars, lines_per_page=60):
+    # Helvetica text pages; only ASCII, the standard fonts have no Persian glyphs
+    lines = _lines(rng, chars, 90)
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[]]
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in pages:
+        # WORDS holds no parentheses or backslashes, so lines need no escaping
+        text = "".join(f"({line}) Tj T* " for line in page)
+        stream = f"BT /F1 9 Tf 12 TL 40 800 Td {text}ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1"))
+    xref = out.tell()
+    out.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1"))
+    for offset in offsets:
+        out.write(f"{offset:010d} 00000 n \n".encode("latin-1"))
+    out.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1"))
+    return out.getvalue()
+
+
+def make_csv(rng, chars):
+    rows = ["id,item,status,amount"]
+    length = 0
+    while length < chars:
+        row = f"{len(rows)},{rng.choice(WORDS)} {rng.choice(WORDS)},{rng.choice(WORDS)},{rng.randint(0, 100000)}"
+        rows.append(row)
+        length += len(row) + 1
+    return "\n".join(rows).encode("utf-8")
+
+
+def make_html(rng, chars):
+    paragraphs = "".join(f"<p>{escape(line)}</p>" for line in _lines(rng, chars, 300, persian=0.1))
+    return f"<html><head><style>p {{margin: 0}}</style></head><body>{paragraphs}</body></html>".encode("utf-8")
+
+
+def make_eml(rng, chars):
+    message = EmailMessage()
+    message["Subject"] = _words(rng, 40)
+    message["From"] = f"user{rng.randrange(500)}@example.com"
+    message["To"] = f"user{rng.randrange(500)}@example.com"
+    message.set_content(_words(rng, chars // 2, persian=0.1))
+    message.add_attachment(make_csv(rng, chars // 2), maintype="text", subtype="csv", filename="items.csv")
+    # the generated boundary is random
+    message.set_boundary(f"=={rng.getrandbits(64):016x}==")
+    return message.as_bytes()
+
+
+def make_attachment(kind, rng, size):
+    # Content of roughly size bytes of text (before any compression of the format)
+    if kind == "pdf":
+        return make_pdf(rng, size)
+    if kind == "docx":
+        return make_docx(rng, size)
+    if kind == "xlsx":
+        return make_xlsx(rng, size)
+    if kind == "txt":
+        return _words(rng, size, persian=0.2).encode("utf-8")
+    if kind == "csv":
+        return make_csv(rng, size)
+    if kind == "html":
+        return make_html(rng, size)
+    if kind == "eml":
+        return make_eml(rng, size)
+    if kind == "zip":
+        return _zip([("report.txt", _words(rng, size // 2)), ("items.csv", make_csv(rng, size // 2)),
+                     ("summary.docx", make_docx(rng, size // 4))])
+    return rng.randbytes(size)
+
+
+class SyntheticMailbox:
+    def __init__(self, index=0, messages=1000, attachment_rate=0.5, mix=None, attachment_size=64 * 1024,
+                 body_size=2048, duplicates=0.1, seed=1):
+        # index numbers the mailbox among others generated with the same arguments;
+        # duplicates is the share of messages copied from an earlier message and of
+        # attachments drawn from a pool shared by all mailboxes
+        self.index = index
+        self.messages = messages
+        self.attachment_rate = attachment_rate
+        self.mix = mix or DEFAULT_MIX
+        self.attachment_size = attachment_size
+        self.body_size = body_size
+        self.duplicates = duplicates
+        self.seed = seed
+        self.pool_size = max(1, messages // 20)
+        self.user_name = f"user{index:04d}"
+        self.stats = {}
+
+    def _rng(self, *key):
+        # str seeds are hashed with SHA-512, stable across runs and platforms
+        return random.Random(":".join(str(part) for part in (self.seed,) + key))
+
+    def _origin(self, number):
+        # the message a (possibly duplicated) message number was copied from
+        while number > 0:
+            rng = self._rng("copy", number)
+            if rng.random() >= self.duplicates:
+                break
+            number = rng.randrange(number)
+        return number
+
+    def _attachment(self, key):
+        rng = self._rng("attachment", *key)
+        kinds = [kind for kind, weight in self.mix.items() if weight > 0]
+        kind = rng.choices(kinds, [self.mix[k] for k in kinds])[0]
+        size = max(256, int(self.attachment_size * rng.uniform(0.25, 1.75)))
+        filename = f"{rng.choice(WORDS)}_{key[-1]}{KIND_EXTENSIONS[kind]}"
+        return filename, make_attachment(kind, rng, size)
+
+    def message(self, position):
+        number = self.index * self.messages + position
+        origin = self._origin(number)
+        rng = self._rng("message", origin)
+
+        attachments = []
+        if rng.random() < self.attachment_rate:
+            for i in range(rng.choice((1, 1, 1, 2, 2, 3))):
+                if rng.random() < self.duplicates:
+                    key = ("pool", rng.randrange(self.pool_size))
+                else:
+                    key = (origin, i)
+                filename, content = self._attachment(key)
+                attachments.append(MailAttachment(filename, lambda content=content: content))
+
+        received = datetime(2016, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=rng.randrange(10 * 365 * 86400))
+        sender = rng.randrange(500)
+        return MailMessage(
+            # unique per mailbox position, like an EntryID; a copy keeps the Message-ID of its origin
+            entry_id=hashlib.sha1(f"{self.seed}:{self.index}:{position}".encode()).hexdigest().upper(),
+            subject=_words(rng, rng.randint(20, 80)),
+            sender_name=f"User {sender}",
+            sender_email=f"user{sender}@example.com",
+            body=_words(rng, int(self.body_size * rng.uniform(0.5, 1.5)), persian=0.1),
+            received=received,
+            to="; ".join(f"user{rng.randrange(500)}@example.com" for _ in range(rng.randint(1, 3))),
+            cc="; ".join(f"user{rng.randrange(500)}@example.com" for _ in range(rng.randint(0, 2))),
+            message_id=f"<{origin}.{self.seed}@synthetic.example.com>",
+            attachments=attachments,
+        )
+
+    def build(self):
+        # Root folder with every message generated up front
+        folders = {name: [] for name, _ in FOLDER_SHARES}
+        names = [name for name, _ in FOLDER_SHARES]
+        shares = [share for _, share in FOLDER_SHARES]
+        seen = set()
+        attachments = duplicate_attachments = attachment_bytes = copies = 0
+        for position in range(self.messages):
+            message = self.message(position)
+            folder = self._rng("folder", self.index, position).choices(names, shares)[0]
+            folders[folder].append(message)
+            number = self.index * self.messages + position
+            if self._origin(number) != number:
+                copies += 1
+            for attachment in message.Attachments:
+                content = attachment.read()
+                digest = hashlib.sha256(content).digest()
+                attachments += 1
+                attachment_bytes += len(content)
+                if digest in seen:
+                    duplicate_attachments += 1
+                seen.add(digest)
+
+        self.stats = {
+            "messages": self.messages,
+            "copied_messages": copies,
+            "attachments": attachments,
+            "duplicate_attachments": duplicate_attachments,
+            "attachment_bytes": attachment_bytes,
+        }
+        sub_folders = [MailFolder(name, ItemCollection(len(items), items.__getitem__)) for name, items in folders.items()]
+        # a folder read_folder walks through without indexing
+        sub_folders.append(MailFolder("Calendar"))
+        return MailFolder(f"Mailbox - {self.user_name}", folders=ItemCollection(len(sub_folders), sub_folders.__getitem__))
+
+
+def iter_messages(root):
+    # every message of a built mailbox
+    for folder in root.Folders:
+        yield from folder.Items
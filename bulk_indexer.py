@@ -0,0 +1,321 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+from collections import defaultdict
+
+from elasticsearch import ApiError, ConnectionError as ESConnectionError, ConnectionTimeout
+from elasticsearch.helpers import expand_action
+
+import metrics
+
+# One indexer per process; every reader thread feeds it through a bounded queue.
+# Batches are cut by document count and by payload size, and both the batch size
+# and the number of concurrent bulk requests adapt to the latency and rejections
+# Elasticsearch reports. The _bulk call is made directly rather than through
+# streaming_bulk, whose 429 retries reorder the results and lose per item accounting.
+
+BULK_MIN_DOCS = int(os.getenv("BULK_MIN_DOCS", "100"))
+BULK_MAX_DOCS = int(os.getenv("BULK_MAX_DOCS", "2000"))
+BULK_MAX_BYTES = int(os.getenv("BULK_MAX_BYTES", str(10 * 1024 * 1024)))
+BULK_MAX_IN_FLIGHT = int(os.getenv("BULK_MAX_IN_FLIGHT", "4"))
+BULK_QUEUE_SIZE = int(os.getenv("BULK_QUEUE_SIZE", "5000"))
+# A bulk request slower than this counts as back pressure
+BULK_TARGET_LATENCY = float(os.getenv("BULK_TARGET_LATENCY", "2.0"))
+BULK_MAX_RETRIES = int(os.getenv("BULK_MAX_RETRIES", "8"))
+BULK_INITIAL_BACKOFF = float(os.getenv("BULK_INITIAL_BACKOFF", "1.0"))
+BULK_MAX_BACKOFF = float(os.getenv("BULK_MAX_BACKOFF", "60.0"))
+# A partial batch is sent after waiting this long for more documents
+BULK_FLUSH_INTERVAL = float(os.getenv("BULK_FLUSH_INTERVAL", "1.0"))
+
+RETRY_STATUSES = (429, 502, 503, 504)
+
+_STOP = object()
+
+
+class _Unit:
+    # One added document and the actions prepare() derived from it
+    __slots__ = ("action", "tag", "remaining", "ok")
+
+    def __init__(self, action, tag, parts):
+        self.action = action
+        self.tag = tag
+        self.remaining = parts
+        self.ok = True
+
+
+def action_size(action):
+    return len(json.dumps(action.get("_source", action), default=str, ensure_ascii=False).encode("utf-8"))
+
+
+class BulkIndexer:
+    def __init__(self, client, prepare=None, on_indexed=None, queue_size=BULK_QUEUE_SIZE, min_docs=BULK_MIN_DOCS,
+                 max_docs=BULK_MAX_DOCS, max_bytes=BULK_MAX_BYTES, max_in_flight=BULK_MAX_IN_FLIGHT):
+        self.client = client
+        # prepare(actions) runs on the collector thread before documents are sized and sent,
+        # e.g. to wait for attachment text that is still being extracted; it gets every document
+        # already queued at once, so their pending work is awaited together. It returns the
+        # actions it was given, in order, each followed by any actions derived from it
+        # (attachment text chunks); a document only counts as indexed once all of them are
+        # acknowledged, and one it leaves out (its attachment upload failed) counts as failed.
+        self.prepare = prepare
+        # on_indexed(tag, actions) is called with the documents Elasticsearch acknowledged
+        self.on_indexed = on_indexed
+        self.min_docs = min_docs
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_in_flight = max_in_flight
+
+        self.batch_docs = min(max_docs, max(min_docs, 500))
+        self.in_flight_limit = max(1, max_in_flight // 2)
+
+        self.indexed = 0
+        self.failed = 0
+        self._tag_counts = defaultdict(lambda: [0, 0])
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._pending = 0
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._flush_requested = threading.Event()
+        self._collector = None
+        self._senders = []
+
+    def start(self):
+        self._collector = threading.Thread(target=self._collect, name="bulk-collector", daemon=True)
+        self._collector.start()
+        return self
+
+    def add(self, action, tag=None):
+        # Blocks while the queue is full, which throttles the readers
+        with self._cond:
+            self._pending += 1
+        self._queue.put((action, tag))
+
+    def flush(self):
+        # Wait until every document added so far has been acknowledged or has failed
+        self._flush_requested.set()
+        with self._cond:
+            while self._pending:
+                self._cond.wait(BULK_FLUSH_INTERVAL)
+                self._flush_requested.set()
+
+    def close(self):
+        self.flush()
+        self._queue.put(_STOP)
+        if self._collector:
+            self._collector.join()
+        for sender in self._senders:
+            sender.join()
+
+    def pop_counts(self, tag):
+        # Returns (indexed, failed) for the documents added with this tag
+        with self._cond:
+            indexed, failed = self._tag_counts.pop(tag, (0, 0))
+        return indexed, failed
+
+    def _collect(self):
+        batch, units, batch_bytes = [], [], 0
+        stopping = False
+        while not stopping:
+            try:
+                item = self._queue.get(timeout=BULK_FLUSH_INTERVAL)
+            except queue.Empty:
+                item = None
+
+            # the documents already waiting, up to a batch, are prepared together
+            items = []
+            while item is not None:
+                if item is _STOP:
+                    stopping = True
+                    break
+                items.append(item)
+                if len(items) >= self.batch_docs:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    item = None
+
+            for unit, actions in self._prepare(items):
+                try:
+                    sizes = [action_size(a) for a in actions]
+                except Exception as e:
+                    logging.error(f"Failed to prepare document for indexing: {e}")
+                    self._finish([unit.action], [_Unit(unit.action, unit.tag, 1)], [False])
+                    continue
+                for part, size in zip(actions, sizes):
+                    if batch and batch_bytes + size > self.max_bytes:
+                        self._dispatch(batch, units, batch_bytes)
+                        batch, units, batch_bytes = [], [], 0
+                    batch.append(part)
+                    units.append(unit)
+                    batch_bytes += size
+
+            if stopping:
+                if batch:
+                    self._dispatch(batch, units, batch_bytes)
+                return
+            full = len(batch) >= self.batch_docs or batch_bytes >= self.max_bytes
+            idle = not items or (self._flush_requested.is_set() and self._queue.empty())
+            if batch and (full or idle):
+                self._dispatch(batch, units, batch_bytes)
+                batch, units, batch_bytes = [], [], 0
+            if idle:
+                self._flush_requested.clear()
+
+    def _prepare(self, items):
+        # (unit, actions) of each queued (action, tag) item that could be prepared. The prepare
+        # steps change the documents as they go, so a batch prepare raised on is not prepared
+        # again: all of its documents fail (a step that can fail for one document leaves it out)
+        if not items:
+            return []
+        if not self.prepare:
+            return [(_Unit(action, tag, 1), [action]) for action, tag in items]
+        try:
+            prepared = self.prepare([action for action, _ in items])
+        except Exception as e:
+            logging.error(f"Failed to prepare {len(items)} documents for indexing: {e}")
+            self._finish([action for action, _ in items], [_Unit(action, tag, 1) for action, tag in items],
+                         [False] * len(items))
+            return []
+
+        tags = {id(action): tag for action, tag in items}
+        groups = []
+        for action in prepared:
+            if id(action) in tags:
+                groups.append((action, tags.pop(id(action)), [action]))
+            elif groups:
+                groups[-1][2].append(action)
+        for action, tag in items:
+            if id(action) in tags:
+                logging.error(f"Document {action.get('_id')} was dropped while preparing it for indexing")
+                self._finish([action], [_Unit(action, tag, 1)], [False])
+        return [(_Unit(action, tag, len(actions)), actions) for action, tag, actions in groups]
+
+    def _dispatch(self, batch, units, batch_bytes):
+        with self._cond:
+            while self._in_flight >= self.in_flight_limit:
+                self._cond.wait()
+            self._in_flight += 1
+        self._senders = [s for s in self._senders if s.is_alive()]
+        sender = threading.Thread(target=self._send, args=(batch, units, batch_bytes), name="bulk-sender", daemon=True)
+        self._senders.append(sender)
+        sender.start()
+
+    def _send(self, batch, units, batch_bytes):
+        # Items rejected with 429/503 are resent with exponential backoff; results stay aligned
+        # with the batch so every document is counted exactly once
+        results = [False] * len(batch)
+        pressure = False
+        started = time.monotonic()
+        backoff = BULK_INITIAL_BACKOFF
+        remaining = list(range(len(batch)))
+        try:
+            for attempt in range(BULK_MAX_RETRIES + 1):
+                retry = []
+                operations = []
+                for i in remaining:
+                    meta, source = expand_action(batch[i])
+                    operations.append(meta)
+                    if source is not None:
+                        operations.append(source)
+
+                # batch_bytes is the size of the sources, the first attempt's payload less the metadata
+                if attempt == 0:
+                    metrics.observe("ingest_bulk_request_bytes", batch_bytes)
+                request_started = time.perf_counter()
+                try:
+                    response = self.client.bulk(operations=operations)
+                except (ApiError, ESConnectionError, ConnectionTimeout) as e:
+                    metrics.observe("ingest_bulk_request_seconds", time.perf_counter() - request_started)
+                    status = getattr(getattr(e, "meta", None), "status", None)
+                    if isinstance(e, ApiError) and status not in RETRY_STATUSES:
+                        metrics.inc("ingest_bulk_requests_total", result="failed")
+                        logging.error(f"Bulk request failed: {e}")
+                        break
+                    metrics.inc("ingest_bulk_requests_total", result="rejected")
+                    pressure = True
+                    retry = remaining
+                    logging.warning(f"Bulk request rejected ({status or e}), attempt {attempt + 1}")
+                else:
+                    metrics.observe("ingest_bulk_request_seconds", time.perf_counter() - request_started)
+                    metrics.inc("ingest_bulk_requests_total", result="ok")
+                    for i, item in zip(remaining, response["items"]):
+                        op_result = next(iter(item.values()), {})
+                        status = op_result.get("status", 500)
+                        if 200 <= status < 300:
+                            results[i] = True
+                            continue
+                        error = op_result.get("error")
+                        metrics.inc("ingest_bulk_item_failures_total", status=status,
+                                    reason=error.get("type", "unknown") if isinstance(error, dict) else "unknown")
+                        if status in RETRY_STATUSES:
+                            pressure = True
+                            retry.append(i)
+                        else:
+                            logging.error(f"Bulk item failed: {status} {error}")
+
+                if not retry:
+                    break
+                if attempt == BULK_MAX_RETRIES:
+                    logging.error(f"Giving up on {len(retry)} documents after {attempt + 1} attempts")
+                    break
+                remaining = retry
+                time.sleep(backoff)
+                backoff = min(backoff * 2, BULK_MAX_BACKOFF)
+        except Exception as e:
+            logging.error(f"Bulk index failed: {e}")
+        finally:
+            self._tune(time.monotonic() - started, pressure)
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+            self._finish(batch, units, results)
+
+    def _tune(self, latency, pressure):
+        # Additive increase while requests are fast, multiplicative decrease on rejections or slow requests
+        with self._cond:
+            if pressure or latency > BULK_TARGET_LATENCY:
+                self.batch_docs = max(self.min_docs, self.batch_docs // 2)
+                self.in_flight_limit = max(1, self.in_flight_limit - 1)
+            elif latency < BULK_TARGET_LATENCY / 2:
+                self.batch_docs = min(self.max_docs, self.batch_docs + self.min_docs)
+                self.in_flight_limit = min(self.max_in_flight, self.in_flight_limit + 1)
+
+    def _finish(self, batch, units, results):
+        # A document is complete once every action derived from it has a result
+        done = []
+        with self._cond:
+            for unit, ok in zip(units, results):
+                unit.ok = unit.ok and ok
+                unit.remaining -= 1
+                if unit.remaining == 0:
+                    done.append(unit)
+
+        if self.on_indexed:
+            acknowledged = defaultdict(list)
+            for unit in done:
+                if unit.ok:
+                    acknowledged[unit.tag].append(unit.action)
+            for tag, actions in acknowledged.items():
+                try:
+                    self.on_indexed(tag, actions)
+                except Exception as e:
+                    logging.error(f"on_indexed callback failed: {e}")
+
+        ok = sum(1 for unit in done if unit.ok)
+        metrics.inc("ingest_bulk_documents_total", ok, result="indexed")
+        metrics.inc("ingest_bulk_documents_total", len(done) - ok, result="failed")
+        with self._cond:
+            for unit in done:
+                if unit.ok:
+                    self.indexed += 1
+                else:
+                    self.failed += 1
+                if unit.tag is not None:
+                    self._tag_counts[unit.tag][0 if unit.ok else 1] += 1
+            self._pending -= len(done)
+            self._cond.notify_all()
@@ -0,0 +1,238 @@
+import os
+import math
+import hashlib
+import threading
+
+from sqlite_store import SQLiteStore
+
+# Resumable ingestion.
+# Documents get a deterministic _id, so re-indexing a message overwrites it instead of
+# creating a duplicate, and every acknowledged _id is recorded per source (PST) so a
+# re-run skips messages that are already in Elasticsearch without asking it.
+
+CHECKPOINT_PATH = os.getenv("CHECKPOINT_PATH", "ingest_checkpoint.db")
+BLOOM_ERROR_RATE = 0.001
+
+PR_INTERNET_MESSAGE_ID_W = "http://schemas.microsoft.com/mapi/proptag/0x1035001F"
+
+
+def internet_message_id(message):
+    # The offline backends expose it directly, Outlook only through the property accessor
+    message_id = getattr(message, "InternetMessageID", "") or ""
+    if not message_id:
+        try:
+            message_id = message.PropertyAccessor.GetProperty(PR_INTERNET_MESSAGE_ID_W) or ""
+        except Exception:
+            message_id = ""
+    return str(message_id).strip()
+
+
+def message_key(message):
+    # EntryID is stable for a message inside a store; the Internet Message-ID is the fallback
+    entry_id = getattr(message, "EntryID", "") or ""
+    if entry_id:
+        return str(entry_id)
+    message_id = internet_message_id(message)
+    if message_id:
+        return message_id
+    return "|".join(str(getattr(message, name, "") or "") for name in ("SenderEmailAddress", "Subject", "ReceivedTime"))
+
+
+def document_id(user_name, key):
+    return hashlib.sha1(f"{user_name}\0{key}".encode("utf-8")).hexdigest()
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        capacity = max(1000, capacity)
+        self.size = int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, value):
+        for pos in self._positions(value):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, value):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(value))
+
+
+class SeenSet:
+    # Bloom filter in front of the checkpoint table: a miss is answered from memory,
+    # a possible hit is confirmed in SQLite so false positives never skip a message
+    def __init__(self, store, source):
+        self.store = store
+        self.source = source
+        self.bloom = BloomFilter(store.indexed_count(source) * 2)
+        for doc_id in store.iter_indexed(source):
+            self.bloom.add(doc_id)
+
+    def add(self, doc_id):
+        self.bloom.add(doc_id)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.bloom and self.store.is_indexed(self.source, doc_id)
+
+
+class CheckpointStore(SQLiteStore):
+    def __init__(self, path=CHECKPOINT_PATH):
+        super().__init__(path)
+        conn = self._connect()
+        # one row per folder a message was acknowledged in: with dedup the copies of a message in
+        # two folders of one store share a doc_id, and each folder must count its own
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            columns = conn.execute("PRAGMA table_info(indexed)").fetchall()
+            # checkpoints written before folders counted separately have PRIMARY KEY (source, doc_id)
+            legacy = columns and not any(name == "folder_path" and pk for _, name, _, _, _, pk in columns)
+            if legacy:
+                conn.execute("DROP INDEX IF EXISTS indexed_folder")
+                conn.execute("ALTER TABLE indexed RENAME TO indexed_by_source")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS indexed ("
+                "source TEXT NOT NULL, folder_path TEXT NOT NULL, doc_id TEXT NOT NULL, "
+                "PRIMARY KEY (source, folder_path, doc_id)) WITHOUT ROWID"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS indexed_doc ON indexed (source, doc_id)")
+            if legacy:
+                conn.execute(
+                    "INSERT OR IGNORE INTO indexed (source, folder_path, doc_id) "
+                    "SELECT source, folder_path, doc_id FROM indexed_by_source"
+                )
+                conn.execute("DROP TABLE indexed_by_source")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        # items is the number of mail items found in the folder once it has been read to the end
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS folders ("
+            "source TEXT NOT NULL, folder_path TEXT NOT NULL, items INTEGER NOT NULL, "
+            "PRIMARY KEY (source, folder_path))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sources ("
+            "source TEXT PRIMARY KEY, done INTEGER NOT NULL DEFAULT 0)"
+        )
+
+    def indexed_count(self, source):
+        return self._connect().execute("SELECT COUNT(*) FROM indexed WHERE source = ?", (source,)).fetchone()[0]
+
+    def iter_indexed(self, source):
+        for (doc_id,) in self._connect().execute("SELECT DISTINCT doc_id FROM indexed WHERE source = ?", (source,)):
+            yield doc_id
+
+    def is_indexed(self, source, doc_id, folder_path=None):
+        # in any folder of the source, or in folder_path
+        if folder_path is None:
+            row = self._connect().execute(
+                "SELECT 1 FROM indexed WHERE source = ? AND doc_id = ? LIMIT 1", (source, doc_id)
+            ).fetchone()
+        else:
+            row = self._connect().execute(
+                "SELECT 1 FROM indexed WHERE source = ? AND folder_path = ? AND doc_id = ?",
+                (source, folder_path, doc_id),
+            ).fetchone()
+        return row is not None
+
+    def mark_indexed(self, source, folder_path, doc_ids):
+        self._executemany(
+            "INSERT OR IGNORE INTO indexed (source, folder_path, doc_id) VALUES (?, ?, ?)",
+            ((source, folder_path, doc_id) for doc_id in doc_ids),
+        )
+
+    def seen(self, source):
+        return SeenSet(self, source)
+
+    def is_folder_done(self, source, folder_path):
+        # A folder is done when it was read to the end and all of its items were acknowledged
+        row = self._connect().execute(
+            "SELECT f.items, (SELECT COUNT(*) FROM indexed i WHERE i.source = f.source AND i.folder_path = f.folder_path) "
+            "FROM folders f WHERE f.source = ? AND f.folder_path = ?",
+            (source, folder_path),
+        ).fetchone()
+        return bool(row and row[1] >= row[0])
+
+    def mark_folder_read(self, source, folder_path, items):
+        self._connect().execute(
+            "INSERT INTO folders (source, folder_path, items) VALUES (?, ?, ?) "
+            "ON CONFLICT (source, folder_path) DO UPDATE SET items = excluded.items",
+            (source, folder_path, items),
+        )
+
+    def is_source_done(self, source):
+        row = self._connect().execute("SELECT done FROM sources WHERE source = ?", (source,)).fetchone()
+        return bool(row and row[0])
+
+    def mark_source_done(self, source):
+        self._connect().execute(
+            "INSERT INTO sources (source, done) VALUES (?, 1) ON CONFLICT (source) DO UPDATE SET done = 1",
+            (source,),
+        )
+
+
+class SourceProgress:
+    # Checkpoint state of one source (PST) while it is being read.
+    # Documents are tagged (source, folder_path) so acknowledgements can be attributed per folder.
+    def __init__(self, store, source):
+        self.store = store
+        self.source = source
+        # what the store is reported as in the metrics; each part of a split store has its own
+        self.name = source
+        self.seen = store.seen(source)
+        self.folder_tags = []
+        # folders read to the end, recorded once the indexer acknowledged what was sent of them
+        self.folders_read = []
+        # messages or folders that could not be read; the source is not marked done while any remain
+        self.errors = 0
+        self._errors_lock = threading.Lock()
+
+    def tag(self, folder_path):
+        tag = (self.source, folder_path)
+        if tag not in self.folder_tags:
+            self.folder_tags.append(tag)
+        return tag
+
+    def add_error(self):
+        # called from every stage of the message pipeline
+        with self._errors_lock:
+            self.errors += 1
+
+    def is_folder_done(self, folder_path):
+        return self.store.is_folder_done(self.source, folder_path)
+
+    def is_indexed(self, doc_id, folder_path=None):
+        # With folder_path, a message acknowledged under another folder of the store (one of two
+        # copies sharing a dedup _id) is recorded for this folder as well, so both folders finish
+        if doc_id not in self.seen:
+            return False
+        if folder_path is not None and not self.store.is_indexed(self.source, doc_id, folder_path):
+            self.store.mark_indexed(self.source, folder_path, [doc_id])
+        return True
+
+    def folder_read(self, folder_path, items):
+        self.folders_read.append((folder_path, items))
+
+    def record_folders(self):
+        # called after the indexer was flushed
+        for folder_path, items in self.folders_read:
+            self.store.mark_folder_read(self.source, folder_path, items)
+        self.folders_read = []
+
+    def complete(self, all_indexed):
+        if all_indexed:
+            self.store.mark_source_done(self.source)
+
+
+def record_indexed(store, tag, actions):
+    # BulkIndexer on_indexed callback for documents tagged by SourceProgress.tag()
+    if tag is None:
+        return
+    source, folder_path = tag
+    store.mark_indexed(source, folder_path, [action["_id"] for action in actions])
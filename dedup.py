@@ -0,0 +1,191 @@
+import os
+import re
+import hashlib
+from datetime import datetime, timezone
+
+from checkpoint import internet_message_id
+from sqlite_store import SQLiteStore
+
+# Cross-mailbox deduplication (`mailsearch ingest --dedup`).
+# The same email sits in the sender's Sent Items and in every recipient's Inbox. With dedup
+# its _id comes from the Internet Message-ID (or, without one, a hash of the normalized
+# sender, date, subject and body) instead of the mailbox, so all copies land on one document.
+# Every copy is written as a scripted upsert that adds its mailbox to `owners` and its folder
+# to `folders`. Only the first mailbox to claim a message (in DEDUP_PATH) saves and extracts
+# its attachments; the other copies send the document without them, and the claimer's
+# document fills them in whichever arrives first.
+#
+# Updating a document rebuilds it from _source, which leaves out attachments.text, so with
+# dedup the attachment text always goes to chunk documents (attachment_chunks).
+#
+# "near" also stores a SimHash of the body and links an email whose body is within
+# SIMHASH_DISTANCE bits of an earlier one (a forward, a reply quoting it) through
+# near_duplicate_of; such emails stay separate documents.
+
+DEDUP_MODES = ("off", "message", "near")
+DEDUP_MODE = os.getenv("INGEST_DEDUP", "off")
+DEDUP_PATH = os.getenv("DEDUP_PATH", "ingest_dedup.db")
+SIMHASH_DISTANCE = int(os.getenv("SIMHASH_DISTANCE", "3"))
+# shorter bodies are too alike to tell apart by SimHash
+SIMHASH_MIN_WORDS = int(os.getenv("SIMHASH_MIN_WORDS", "30"))
+# 4 bands of 16 bits: two hashes within 3 bits of each other share at least one band
+SIMHASH_BANDS = 4
+
+MERGE_SCRIPT_ID = "email_dedup_merge"
+MERGE_SCRIPT = """
+Map s = ctx._source;
+boolean changed = false;
+for (entry in params.doc.entrySet()) {
+    if (params.replace || !s.containsKey(entry.getKey())) {
+        s[entry.getKey()] = entry.getValue();
+        changed = true;
+    }
+}
+for (pair in [['owners', params.owner], ['folders', params.folder]]) {
+    List values = s[pair[0]];
+    if (values == null) {
+        values = new ArrayList();
+        s[pair[0]] = values;
+    }
+    if (!values.contains(pair[1])) {
+        values.add(pair[1]);
+        changed = true;
+    }
+}
+if (!changed) {
+    ctx.op = 'none';
+}
+"""
+
+_WHITESPACE = re.compile(r"\s+")
+_WORDS = re.compile(r"\w+")
+
+
+def _normalize(text):
+    return _WHITESPACE.sub(" ", str(text or "")).strip().casefold()
+
+
+def _date_key(value):
+    # to the second, without the time zone spelling
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%dT%H:%M:%S")
+    return _normalize(value)[:19]
+
+
+def message_date(message):
+    # The send time is the same in every copy; the received time differs per mailbox. An aware
+    # time is turned into naive UTC, as the PST reader gives it, so copies read by different
+    # backends agree on the key and on the year index
+    value = getattr(message, "SentOn", None) or getattr(message, "ReceivedTime", None)
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def dedup_key(message, sender_email=None):
+    message_id = internet_message_id(message)
+    if message_id:
+        return "mid:" + message_id.strip("<>").strip().lower()
+    parts = (
+        sender_email if sender_email is not None else getattr(message, "SenderEmailAddress", ""),
+        _date_key(message_date(message)),
+        getattr(message, "Subject", ""),
+        getattr(message, "Body", ""),
+    )
+    return "hash:" + hashlib.sha1("\0".join(_normalize(p) for p in parts).encode("utf-8")).hexdigest()
+
+
+def dedup_document_id(key):
+    return hashlib.sha1(f"dedup\0{key}".encode("utf-8")).hexdigest()
+
+
+def simhash(text):
+    # 64-bit SimHash over word trigrams; None for bodies too short to compare
+    words = _WORDS.findall(_normalize(text))
+    if len(words) < SIMHASH_MIN_WORDS:
+        return None
+    weights = [0] * 64
+    for i in range(len(words) - 2):
+        h = int.from_bytes(hashlib.blake2b(" ".join(words[i:i + 3]).encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def _signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _bands(value):
+    width = 64 // SIMHASH_BANDS
+    return [(band, value >> (band * width) & ((1 << width) - 1)) for band in range(SIMHASH_BANDS)]
+
+
+class DedupStore(SQLiteStore):
+    def __init__(self, path=DEDUP_PATH):
+        super().__init__(path)
+        conn = self._connect()
+        # source: the store whose copy of the message carries the attachments
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "doc_id TEXT PRIMARY KEY, source TEXT NOT NULL) WITHOUT ROWID"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS simhashes ("
+            "band INTEGER NOT NULL, value INTEGER NOT NULL, doc_id TEXT NOT NULL, simhash INTEGER NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS simhashes_band ON simhashes (band, value)")
+
+    def claim(self, doc_id, source):
+        # True when this source is (or already was) the one to index the full message
+        conn = self._connect()
+        conn.execute("INSERT OR IGNORE INTO messages (doc_id, source) VALUES (?, ?)", (doc_id, source))
+        row = conn.execute("SELECT source FROM messages WHERE doc_id = ?", (doc_id,)).fetchone()
+        return row is not None and row[0] == source
+
+    def near_duplicate(self, doc_id, value):
+        # _id of an earlier email within SIMHASH_DISTANCE bits; otherwise value is remembered
+        # under doc_id for the emails that follow
+        conn = self._connect()
+        bands = _bands(value)
+        for band, band_value in bands:
+            for other_id, other in conn.execute(
+                "SELECT doc_id, simhash FROM simhashes WHERE band = ? AND value = ? ORDER BY rowid LIMIT 50",
+                (band, band_value),
+            ):
+                if other_id != doc_id and bin((other & (1 << 64) - 1) ^ value).count("1") <= SIMHASH_DISTANCE:
+                    return other_id
+        if conn.execute("SELECT 1 FROM simhashes WHERE doc_id = ? LIMIT 1", (doc_id,)).fetchone() is None:
+            self._executemany(
+                "INSERT INTO simhashes (band, value, doc_id, simhash) VALUES (?, ?, ?, ?)",
+                ((band, band_value, doc_id, _signed(value)) for band, band_value in bands),
+            )
+        return None
+
+
+def install_merge_script(client):
+    client.put_script(id=MERGE_SCRIPT_ID, script={"lang": "painless", "source": MERGE_SCRIPT})
+
+
+def to_upserts(actions):
+    # Indexer prepare step (last): emails read with dedup become scripted upserts of the
+    # shared document; chunk actions pass through
+    for action in actions:
+        dedup = action.pop("_dedup", None)
+        if dedup is None:
+            continue
+        action["_op_type"] = "update"
+        # concurrent copies of one message from other workers
+        action["retry_on_conflict"] = 10
+        action["_source"] = {
+            "scripted_upsert": True,
+            "upsert": {},
+            "script": {"id": MERGE_SCRIPT_ID, "params": {
+                "doc": action["_source"],
+                "replace": dedup["full"],
+                "owner": dedup["owner"],
+                "folder": dedup["folder"],
+            }},
+        }
+    return actions
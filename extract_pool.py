@@ -0,0 +1,191 @@
+import os
+import time
+import logging
+import sqlite3
+import threading
+import multiprocessing.util
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from extractors import extract_text_from_file, text_format
+from sqlite_store import SQLiteStore
+import metrics
+
+# Attachment text extraction runs in its own processes so large PDFs and workbooks
+# do not block message reading or hold the reader's GIL.
+# EXTRACT_WORKERS=0 extracts inline on the calling thread.
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(os.cpu_count() or 2)))
+# Maximum number of attachments submitted but not yet extracted; readers block above it
+EXTRACT_QUEUE_LIMIT = int(os.getenv("EXTRACT_QUEUE_LIMIT", "64"))
+# Persistent sha256 -> extracted text cache, shared by all workers and runs
+TEXT_CACHE_PATH = os.getenv("TEXT_CACHE_PATH", "attachment_text_cache.db")
+
+
+def timed_extract(file_path, data=None):
+    # Runs in the extraction process; the duration travels back with the text
+    started = time.perf_counter()
+    text = extract_text_from_file(file_path, data)
+    return text, time.perf_counter() - started
+
+
+class TextCache(SQLiteStore):
+    def __init__(self, path=TEXT_CACHE_PATH, timeout=30):
+        super().__init__(path, timeout)
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS attachment_text ("
+            "sha256 TEXT NOT NULL, mime_type TEXT NOT NULL, text TEXT NOT NULL, "
+            "PRIMARY KEY (sha256, mime_type))"
+        )
+
+    # keyed by extractors.text_format(); rows from before it (keyed by MIME type) are no longer
+    # read, so archives and messages cached as empty are extracted again
+    def get(self, digest, text_type):
+        row = self._connect().execute(
+            "SELECT text FROM attachment_text WHERE sha256 = ? AND mime_type = ?",
+            (digest, text_type or ""),
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, digest, text_type, text):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO attachment_text (sha256, mime_type, text) VALUES (?, ?, ?)",
+            (digest, text_type or "", text or ""),
+        )
+
+
+class ExtractionPool:
+    def __init__(self, max_workers=EXTRACT_WORKERS, queue_limit=EXTRACT_QUEUE_LIMIT, text_cache=None):
+        self._executor = ProcessPoolExecutor(max_workers=max_workers) if max_workers > 0 else None
+        self._slots = threading.BoundedSemaphore(max(1, queue_limit))
+        self._cache = text_cache
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+    def submit(self, file_path, on_done=None, digest=None, data=None):
+        # on_done(future) runs once the text is available, e.g. to remove a temp file.
+        # With a content digest the text cache is consulted first and identical
+        # attachments already being extracted share one future.
+        # data hands over content that is already in memory; file_path then only names the format.
+        text_type = text_format(file_path)
+        key = (digest, text_type) if digest and text_type else None
+        future = None
+
+        if text_type is None:
+            # nothing to extract, no need to ship the content to a worker
+            metrics.inc("ingest_extract_total", type="none", result="skipped")
+            future = Future()
+            future.set_result("")
+
+        if key is not None:
+            with self._pending_lock:
+                future = self._pending.get(key)
+            if future is None and self._cache is not None:
+                text = self._cache.get(*key)
+                if text is not None:
+                    metrics.inc("ingest_extract_total", type=text_type, result="cached")
+                    future = Future()
+                    future.set_result(text)
+
+        if future is None:
+            future = self._start(file_path, data, text_type)
+            if key is not None:
+                with self._pending_lock:
+                    self._pending[key] = future
+                future.add_done_callback(lambda f: self._finished(key, f))
+
+        if on_done is not None:
+            future.add_done_callback(on_done)
+        return future
+
+    def _start(self, file_path, data=None, text_type=None):
+        try:
+            size = len(data) if data is not None else os.path.getsize(file_path)
+        except OSError:
+            size = 0
+        metrics.inc("ingest_extract_bytes_total", size, type=text_type)
+        future = Future()
+
+        if self._executor is None:
+            try:
+                self._extracted(future, text_type, timed_extract(file_path, data))
+            except Exception as e:
+                self._extracted(future, text_type, error=e)
+            return future
+
+        self._slots.acquire()
+        try:
+            # a memoryview cannot cross the process boundary, the worker gets its bytes
+            if isinstance(data, memoryview):
+                data = data.tobytes()
+            extraction = self._executor.submit(timed_extract, file_path, data)
+        except Exception:
+            self._slots.release()
+            raise
+
+        def done(f):
+            self._slots.release()
+            if f.cancelled():
+                future.cancel()
+                return
+            error = f.exception()
+            self._extracted(future, text_type, None if error else f.result(), error)
+
+        extraction.add_done_callback(done)
+        return future
+
+    def _extracted(self, future, text_type, result=None, error=None):
+        if error is not None:
+            metrics.inc("ingest_extract_total", type=text_type, result="failed")
+            future.set_exception(error)
+            return
+        text, seconds = result
+        metrics.inc("ingest_extract_total", type=text_type, result="ok")
+        metrics.observe("ingest_extract_seconds", seconds, type=text_type)
+        future.set_result(text)
+
+    def _finished(self, key, future):
+        with self._pending_lock:
+            self._pending.pop(key, None)
+        if self._cache is not None and future.exception() is None:
+            try:
+                self._cache.put(key[0], key[1], future.result())
+            except sqlite3.Error as e:
+                logging.error(f"Failed to cache extracted text for {key[0]}: {e}")
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_extraction_pool():
+    # One pool per process, created on first use
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ExtractionPool(text_cache=TextCache() if TEXT_CACHE_PATH else None)
+            # an ingest worker process leaves through multiprocessing, which joins its children
+            # before atexit handlers run: the extraction processes have to be stopped first,
+            # and before the executor's queues close (their finalizers have priority 10)
+            multiprocessing.util.Finalize(_pool, _pool.shutdown, exitpriority=100)
+        return _pool
+
+
+def resolve_attachment_text(actions):
+    # Wait for the pending extractions of a batch of bulk actions and inline the text
+    for action in actions:
+        for attachment in action.get("_source", {}).get("attachments", []):
+            text = attachment.get("text")
+            if isinstance(text, Future):
+                try:
+                    text = text.result()
+                except Exception as e:
+                    logging.error(f"Attachment text extraction failed for {attachment.get('filename')}: {e}")
+                    text = ""
+                if text:
+                    attachment["text"] = text
+                else:
+                    attachment.pop("text", None)
+    return actions
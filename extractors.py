@@ -0,0 +1,461 @@
+import os
+import time
+import codecs
+import hashlib
+import logging
+import zipfile
+import mimetypes
+import traceback
+from io import BytesIO
+from html.parser import HTMLParser
+
+# The parser libraries are imported inside their branch, so a process only pays for
+# the formats it actually meets.
+# Every format is read by a generator that yields text piece by piece (a page, a paragraph,
+# a row), and extract_text_from_file() stops pulling as soon as the file's budget is spent:
+# EXTRACT_MAX_CHARS characters, EXTRACT_MAX_PAGES pages (PDF pages, worksheets) or
+# EXTRACT_MAX_SECONDS seconds. The budget is checked between pieces, so a single huge page
+# can still run to its end, but no file is read further than that.
+#
+# Containers (zip/rar archives, .eml and Outlook .msg messages) are opened in memory and their
+# members are read by the same generators, one member at a time and never unpacked to disk.
+# Nesting stops at EXTRACT_MAX_DEPTH, a member is skipped when it is larger than
+# EXTRACT_MAX_MEMBER_BYTES or compressed better than EXTRACT_MAX_RATIO : 1 (zip bombs), an
+# archive stops after EXTRACT_MAX_ARCHIVE_BYTES of members, and a member whose content was
+# already read during the same extraction (the same report zipped twice, the same attachment
+# forwarded in a chain) is read only once.
+
+EXTRACT_MAX_CHARS = int(os.getenv("EXTRACT_MAX_CHARS", "2000000"))
+EXTRACT_MAX_PAGES = int(os.getenv("EXTRACT_MAX_PAGES", "2000"))
+EXTRACT_MAX_SECONDS = float(os.getenv("EXTRACT_MAX_SECONDS", "60"))
+EXTRACT_MAX_DEPTH = int(os.getenv("EXTRACT_MAX_DEPTH", "3"))
+EXTRACT_MAX_RATIO = float(os.getenv("EXTRACT_MAX_RATIO", "100"))
+EXTRACT_MAX_MEMBER_BYTES = int(os.getenv("EXTRACT_MAX_MEMBER_BYTES", str(64 * 1024 ** 2)))
+EXTRACT_MAX_ARCHIVE_BYTES = int(os.getenv("EXTRACT_MAX_ARCHIVE_BYTES", str(512 * 1024 ** 2)))
+# tried in order on plain text without a BOM; the last one always decodes
+EXTRACT_TEXT_ENCODINGS = os.getenv("EXTRACT_TEXT_ENCODINGS", "utf-8,cp1256").split(",")
+READ_SIZE = 64 * 1024
+
+PDF_MIME = 'application/pdf'
+DOCX_MIME = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+XLSX_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+XLS_MIME = 'application/vnd.ms-excel'
+PPTX_MIME = 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
+
+MIME_FORMATS = {
+    PDF_MIME: "pdf",
+    DOCX_MIME: "docx",
+    XLSX_MIME: "xlsx",
+    XLS_MIME: "xls",
+    PPTX_MIME: "pptx",
+    'application/zip': "zip",
+    'application/x-zip-compressed': "zip",
+    'application/vnd.rar': "rar",
+    'application/x-rar-compressed': "rar",
+    'message/rfc822': "eml",
+    'application/vnd.ms-outlook': "msg",
+    'text/plain': "text",
+    'text/csv': "text",
+    'text/html': "html",
+}
+# checked before mimetypes, whose table differs per platform (and is read from the registry on Windows)
+EXTENSION_FORMATS = {
+    ".pdf": "pdf",
+    ".docx": "docx",
+    ".xlsx": "xlsx",
+    ".xls": "xls",
+    ".pptx": "pptx",
+    ".zip": "zip",
+    ".rar": "rar",
+    ".eml": "eml",
+    ".msg": "msg",
+    ".txt": "text",
+    ".csv": "text",
+    ".log": "text",
+    ".htm": "html",
+    ".html": "html",
+}
+CONTAINER_FORMATS = ("zip", "rar", "eml", "msg")
+
+# A generator yields text, or PAGE_BREAK before every page/sheet after the first
+PAGE_BREAK = object()
+
+
+def _cell_text(cell):
+    return str(cell) if cell is not None else ''
+
+
+def iter_pdf(source):
+    import PyPDF2
+    reader = PyPDF2.PdfReader(source)
+    for number, page in enumerate(reader.pages):
+        if number:
+            yield PAGE_BREAK
+        yield (page.extract_text() or "") + "\n"
+
+
+def iter_docx(source):
+    import docx
+    doc = docx.Document(source)
+    for paragraph in doc.paragraphs:
+        yield paragraph.text + "\n"
+
+
+def iter_xlsx(source):
+    import openpyxl
+    # read_only streams the sheet XML row by row instead of building the whole workbook
+    wb = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    try:
+        for number, sheet in enumerate(wb.worksheets):
+            if number:
+                yield PAGE_BREAK
+            for row in sheet.iter_rows(values_only=True):
+                yield " ".join(_cell_text(cell) for cell in row) + "\n"
+    finally:
+        wb.close()
+
+
+def iter_xls(file_path, data=None):
+    import xlrd
+    # on_demand loads one sheet at a time
+    if data is not None:
+        wb = xlrd.open_workbook(file_contents=bytes(data), on_demand=True)
+    else:
+        wb = xlrd.open_workbook(file_path, on_demand=True)
+    try:
+        for index in range(wb.nsheets):
+            if index:
+                yield PAGE_BREAK
+            sheet = wb.sheet_by_index(index)
+            for row_idx in range(sheet.nrows):
+                yield " ".join(str(cell) for cell in sheet.row_values(row_idx)) + "\n"
+            wb.unload_sheet(index)
+    finally:
+        wb.release_resources()
+
+
+def _guess_encoding(head):
+    if head.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if head.startswith(codecs.BOM_UTF16_LE) or head.startswith(codecs.BOM_UTF16_BE):
+        return "utf-16"
+    for encoding in EXTRACT_TEXT_ENCODINGS[:-1]:
+        try:
+            # not final: the head may end inside a multi-byte character
+            codecs.getincrementaldecoder(encoding)().decode(head, final=False)
+            return encoding
+        except (UnicodeDecodeError, LookupError):
+            continue
+    return EXTRACT_TEXT_ENCODINGS[-1]
+
+
+def iter_plain(source):
+    # .txt/.csv/.log, decoded READ_SIZE bytes at a time
+    stream = open(source, "rb") if isinstance(source, str) else source
+    try:
+        block = stream.read(READ_SIZE)
+        decoder = codecs.getincrementaldecoder(_guess_encoding(block))(errors="replace")
+        while block:
+            yield decoder.decode(block)
+            block = stream.read(READ_SIZE)
+        yield decoder.decode(b"", final=True)
+    finally:
+        if stream is not source:
+            stream.close()
+
+
+class _HTMLText(HTMLParser):
+    SKIP_TAGS = ("script", "style", "head")
+    BLOCK_TAGS = ("br", "p", "div", "tr", "li", "h1", "h2", "h3", "h4", "table")
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip += 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+        elif tag == "td":
+            self.parts.append(" ")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self._skip:
+            self._skip -= 1
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+    def take(self):
+        text = "".join(self.parts)
+        self.parts = []
+        return text
+
+
+def html_text(markup):
+    parser = _HTMLText()
+    parser.feed(markup)
+    parser.close()
+    return parser.take()
+
+
+def iter_html(source):
+    parser = _HTMLText()
+    for piece in iter_plain(source):
+        parser.feed(piece)
+        yield parser.take()
+    parser.close()
+    yield parser.take()
+
+
+def _shape_text(shape):
+    # group shapes nest further shapes; tables keep their text in cells
+    if getattr(shape, "shapes", None) is not None:
+        for child in shape.shapes:
+            yield from _shape_text(child)
+    elif shape.has_text_frame:
+        yield shape.text_frame.text + "\n"
+    elif shape.has_table:
+        for row in shape.table.rows:
+            yield " ".join(cell.text for cell in row.cells) + "\n"
+
+
+def iter_pptx(source):
+    import pptx
+    presentation = pptx.Presentation(source)
+    for number, slide in enumerate(presentation.slides):
+        if number:
+            yield PAGE_BREAK
+        for shape in slide.shapes:
+            yield from _shape_text(shape)
+        if slide.has_notes_slide:
+            yield slide.notes_slide.notes_text_frame.text + "\n"
+
+
+def _iter_member(name, data, depth, seen):
+    # Text of one file found inside a container, once per distinct content
+    digest = hashlib.sha256(data).digest()
+    if digest in seen:
+        return
+    seen.add(digest)
+    try:
+        yield f"\n{name}\n"
+        yield from iter_text(name, data, depth + 1, seen)
+    except Exception as e:
+        # a broken member does not cost the text of the rest of the container
+        logging.error(f"[!] Error extracting text from member {name}: {e}")
+
+
+def _iter_archive(archive, depth, seen):
+    # zipfile.ZipFile and rarfile.RarFile share this interface
+    total = 0
+    for info in archive.infolist():
+        if info.is_dir() or text_format(info.filename) is None:
+            continue
+        if info.file_size > EXTRACT_MAX_MEMBER_BYTES:
+            logging.info(f"Archive member {info.filename} skipped, {info.file_size} bytes")
+            continue
+        if info.file_size / max(info.compress_size, 1) > EXTRACT_MAX_RATIO:
+            logging.warning(f"Archive member {info.filename} skipped, compression ratio above {EXTRACT_MAX_RATIO}")
+            continue
+        if total + info.file_size > EXTRACT_MAX_ARCHIVE_BYTES:
+            logging.info(f"Archive budget reached, members after {info.filename} skipped")
+            break
+        try:
+            # never more than the declared size, whatever the compressed stream expands to
+            with archive.open(info) as member:
+                data = member.read(info.file_size)
+        except Exception as e:
+            logging.error(f"[!] Error reading archive member {info.filename}: {e}")
+            continue
+        total += len(data)
+        yield from _iter_member(info.filename, data, depth, seen)
+
+
+def iter_zip(source, depth, seen):
+    with zipfile.ZipFile(source) as archive:
+        yield from _iter_archive(archive, depth, seen)
+
+
+def iter_rar(source, depth, seen):
+    # optional: rarfile plus an unrar tool on the PATH
+    try:
+        import rarfile
+    except ImportError:
+        logging.info("rarfile is not installed, RAR attachments are not searchable")
+        return
+    with rarfile.RarFile(source) as archive:
+        yield from _iter_archive(archive, depth, seen)
+
+
+def _part_text(part):
+    try:
+        content = part.get_content()
+    except (LookupError, UnicodeError):
+        # unknown or wrong charset
+        content = (part.get_payload(decode=True) or b"").decode("utf-8", errors="replace")
+    return html_text(content) if part.get_content_type() == "text/html" else content
+
+
+def _iter_email(message, depth, seen):
+    for header in ("subject", "from", "to", "cc", "date"):
+        value = message.get(header)
+        if value:
+            yield f"{value}\n"
+    body = message.get_body(preferencelist=("plain", "html"))
+    if body is not None:
+        yield _part_text(body) + "\n"
+    for part in message.iter_attachments():
+        if part.get_content_type() == "message/rfc822":
+            # a forwarded message; its payload is the parsed message
+            inner = part.get_payload(0)
+            name = part.get_filename() or "message.eml"
+            if text_format(name) != "eml":
+                name += ".eml"
+            yield from _iter_member(name, inner.as_bytes(), depth, seen)
+            continue
+        data = part.get_payload(decode=True)
+        if not data:
+            continue
+        name = part.get_filename() or "attachment" + (mimetypes.guess_extension(part.get_content_type()) or "")
+        if text_format(name) is not None:
+            yield from _iter_member(name, data, depth, seen)
+
+
+def iter_eml(source, depth, seen):
+    from email import policy
+    from email.parser import BytesParser
+    parser = BytesParser(policy=policy.default)
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            message = parser.parse(f)
+    else:
+        message = parser.parse(source)
+    yield from _iter_email(message, depth, seen)
+
+
+def _iter_outlook(message, depth, seen):
+    # contacts, tasks and appointments are .msg files too and lack some of these fields
+    for field in ("subject", "sender", "to", "cc", "date"):
+        value = getattr(message, field, None)
+        if value:
+            yield f"{value}\n"
+    body = getattr(message, "body", None)
+    html_body = getattr(message, "htmlBody", None)
+    if not body and html_body:
+        body = html_text(html_body.decode("utf-8", errors="replace"))
+    if body:
+        yield body + "\n"
+    for attachment in getattr(message, "attachments", ()):
+        data = attachment.data
+        if data is None:
+            continue
+        if not isinstance(data, (bytes, bytearray)):
+            # an attached Outlook item, already opened by extract_msg
+            if depth + 1 < EXTRACT_MAX_DEPTH:
+                yield from _iter_outlook(data, depth + 1, seen)
+            continue
+        name = attachment.longFilename or attachment.shortFilename or ""
+        if text_format(name) is not None:
+            yield from _iter_member(name, data, depth, seen)
+
+
+def iter_msg(source, depth, seen):
+    import extract_msg
+    message = extract_msg.openMsg(source if isinstance(source, str) else source.getvalue(), strict=False)
+    try:
+        yield from _iter_outlook(message, depth, seen)
+    finally:
+        message.close()
+
+
+def text_format(file_path):
+    # Name of the reader for a file, or None when its text is not extracted
+    extension = os.path.splitext(file_path or "")[1].lower()
+    if extension in EXTENSION_FORMATS:
+        return EXTENSION_FORMATS[extension]
+    mime_type, _ = mimetypes.guess_type(file_path or "")
+    return MIME_FORMATS.get(mime_type)
+
+
+def iter_text(file_path, data=None, depth=0, seen=None):
+    # Text pieces of one file; an unsupported format yields nothing.
+    # depth counts the containers around the file, seen holds the sha256 of the container
+    # members already read during this extraction
+    text_type = text_format(file_path)
+    source = BytesIO(data) if data is not None else file_path
+
+    if text_type in CONTAINER_FORMATS:
+        if depth >= EXTRACT_MAX_DEPTH:
+            logging.info(f"Nesting limit reached, {file_path} not opened")
+            return iter(())
+        seen = set() if seen is None else seen
+        if text_type == "zip":
+            return iter_zip(source, depth, seen)
+        if text_type == "rar":
+            return iter_rar(source, depth, seen)
+        if text_type == "eml":
+            return iter_eml(source, depth, seen)
+        return iter_msg(source, depth, seen)
+
+    if text_type == "pdf":
+        return iter_pdf(source)
+    if text_type == "docx":
+        return iter_docx(source)
+    if text_type == "xlsx":
+        return iter_xlsx(source)
+    if text_type == "xls":
+        return iter_xls(file_path, data)
+    if text_type == "pptx":
+        return iter_pptx(source)
+    if text_type == "text":
+        return iter_plain(source)
+    if text_type == "html":
+        return iter_html(source)
+    return iter(())
+
+
+def extract_text_from_file(file_path, data=None, max_chars=EXTRACT_MAX_CHARS, max_pages=EXTRACT_MAX_PAGES,
+                           max_seconds=EXTRACT_MAX_SECONDS):
+    # file_path decides the format; when the content is already in memory it is passed
+    # as data and parsed from that buffer instead of reading the file
+    parts = []
+    chars = 0
+    pages = 1
+    deadline = time.monotonic() + max_seconds
+    pieces = None
+
+    try:
+        pieces = iter_text(file_path, data)
+        for piece in pieces:
+            if piece is PAGE_BREAK:
+                pages += 1
+                if pages > max_pages:
+                    logging.info(f"Page budget reached on {file_path}, text truncated after {max_pages} pages")
+                    break
+                continue
+            if chars + len(piece) >= max_chars:
+                parts.append(piece[:max_chars - chars])
+                logging.info(f"Character budget reached on {file_path}, text truncated at {max_chars} characters")
+                break
+            parts.append(piece)
+            chars += len(piece)
+            if time.monotonic() > deadline:
+                logging.info(f"Time budget reached on {file_path}, text truncated after {max_seconds}s")
+                break
+
+    except Exception as e:
+        logging.error(f"[!] Error extracting text from {file_path}: {e}")
+        traceback.print_exc()
+    finally:
+        # closes the workbook / file of a generator stopped early
+        if pieces is not None and hasattr(pieces, "close"):
+            try:
+                pieces.close()
+            except Exception as e:
+                logging.error(f"[!] Error closing {file_path}: {e}")
+
+    return "".join(parts).strip()
@@ -0,0 +1,275 @@
+import os
+import logging
+import threading
+
+# Explicit mapping and per-year indices for the email documents.
+# Documents are written to email_exchange-<year> (email_exchange-undated when the date is
+# unusable); the alias email_exchange spans all of them, so searches keep one name while
+# shards stay small and date-range queries skip whole years. A concrete index still named
+# email_exchange (dynamic mapping, from before the template) blocks the alias until it is
+# moved with `mailsearch index-setup --migrate-legacy`.
+#
+# Attachment text split into chunk documents (see attachment_chunks) goes to
+# email_attachment_chunks-<year> behind the email_attachment_chunks alias the same way.
+#
+# During a bulk load every index written to gets refresh_interval -1 and no replicas;
+# finish_bulk_load() restores both on every index still in that state (also after a crashed
+# run) and force-merges it.
+
+TEMPLATE_NAME = "email_exchange"
+INDEX_ALIAS = "email_exchange"
+INDEX_PREFIX = "email_exchange-"
+CHUNK_TEMPLATE_NAME = "email_attachment_chunks"
+CHUNK_INDEX_ALIAS = "email_attachment_chunks"
+CHUNK_INDEX_PREFIX = "email_attachment_chunks-"
+INDEX_SHARDS = int(os.getenv("INDEX_SHARDS", "1"))
+INDEX_REPLICAS = int(os.getenv("INDEX_REPLICAS", "1"))
+INDEX_REFRESH_INTERVAL = os.getenv("INDEX_REFRESH_INTERVAL", "1s")
+FORCEMERGE_TIMEOUT = int(os.getenv("FORCEMERGE_TIMEOUT", "7200"))
+
+BULK_LOAD_SETTINGS = {"index": {"refresh_interval": "-1", "number_of_replicas": 0}}
+
+DATE_FORMAT = "strict_date_optional_time||yyyy-MM-dd'T'HH:mm:ssZ||yyyy-MM-dd HH:mm:ss||epoch_millis"
+
+
+def _keyword_text(ignore_above=1024):
+    return {"type": "keyword", "ignore_above": ignore_above, "fields": {"text": {"type": "text"}}}
+
+
+def _text_keyword(ignore_above=512):
+    return {"type": "text", "fields": {"keyword": {"type": "keyword", "ignore_above": ignore_above}}}
+
+
+def _settings():
+    return {
+        "number_of_shards": INDEX_SHARDS,
+        "number_of_replicas": INDEX_REPLICAS,
+        "refresh_interval": INDEX_REFRESH_INTERVAL,
+        "codec": "best_compression",
+        "analysis": {"normalizer": {"address": {"type": "custom", "filter": ["lowercase", "trim"]}}},
+    }
+
+
+def template_body():
+    address = {"type": "keyword", "ignore_above": 512, "normalizer": "address",
+               "fields": {"text": {"type": "text"}}}
+    return {
+        "index_patterns": [INDEX_PREFIX + "*"],
+        "priority": 100,
+        "template": {
+            "settings": _settings(),
+            "mappings": {
+                # attachment text is searchable and highlightable from its stored field, but is
+                # kept out of _source so fetching a hit does not load it
+                "_source": {"excludes": ["attachments.text"]},
+                "dynamic_templates": [
+                    {"strings": {"match_mapping_type": "string",
+                                 "mapping": {"type": "keyword", "ignore_above": 1024}}},
+                ],
+                "properties": {
+                    "subject": _text_keyword(),
+                    "sender": _text_keyword(),
+                    # postings with offsets make highlighting long text cheap
+                    "body": {"type": "text", "index_options": "offsets"},
+                    "email": address,
+                    "to": address,
+                    "cc": address,
+                    "date": {"type": "date", "format": DATE_FORMAT, "ignore_malformed": True},
+                    "user": {"type": "keyword"},
+                    "folder_name": {"type": "keyword"},
+                    # every mailbox and folder holding a copy, for documents written with --dedup
+                    "owners": {"type": "keyword"},
+                    "folders": {"type": "keyword"},
+                    "simhash": {"type": "keyword", "index": False},
+                    "near_duplicate_of": {"type": "keyword"},
+                    "display_name": _keyword_text(),
+                    "sam_account_name": {"type": "keyword"},
+                    "department": {"type": "keyword"},
+                    "manager": {"type": "keyword"},
+                    "recipients": {
+                        "properties": {
+                            "display_name": {"type": "keyword"},
+                            "sam_account_name": {"type": "keyword"},
+                            "department": {"type": "keyword"},
+                        },
+                    },
+                    "attachments": {
+                        "properties": {
+                            "filename": _keyword_text(),
+                            "filepath": {"type": "keyword", "index": False, "doc_values": False},
+                            "size": {"type": "long"},
+                            "sha256": {"type": "keyword"},
+                            "object_name": {"type": "keyword", "index": False},
+                            "text": {"type": "text", "index_options": "offsets", "store": True},
+                            "text_chunks": {"type": "integer"},
+                        },
+                    },
+                },
+            },
+        },
+    }
+
+
+def chunk_template_body():
+    # one document per chunk of attachment text, linked to its email by email_id
+    return {
+        "index_patterns": [CHUNK_INDEX_PREFIX + "*"],
+        "priority": 100,
+        "template": {
+            "settings": _settings(),
+            "mappings": {
+                "dynamic": False,
+                "properties": {
+                    "email_id": {"type": "keyword"},
+                    "user": {"type": "keyword"},
+                    "folder_name": {"type": "keyword"},
+                    "department": {"type": "keyword"},
+                    "date": {"type": "date", "format": DATE_FORMAT, "ignore_malformed": True},
+                    "filename": _keyword_text(),
+                    "sha256": {"type": "keyword"},
+                    "chunk": {"type": "integer"},
+                    "text": {"type": "text", "index_options": "offsets"},
+                },
+            },
+        },
+    }
+
+
+def index_name(date_value, prefix=INDEX_PREFIX):
+    # <prefix><year> from the ISO date string written by the ingester
+    text = str(date_value or "")
+    year = text[:4] if len(text) >= 4 and text[:4].isdigit() else "undated"
+    return prefix + year
+
+
+def install_template(client):
+    client.indices.put_index_template(name=TEMPLATE_NAME, **template_body())
+    client.indices.put_index_template(name=CHUNK_TEMPLATE_NAME, **chunk_template_body())
+
+
+def has_legacy_index(client, alias=INDEX_ALIAS):
+    # a concrete index named like the alias, from before the template
+    return bool(client.indices.exists(index=alias)) and not client.indices.exists_alias(name=alias)
+
+
+def ensure_alias(client):
+    ok = True
+    for prefix, alias in ((INDEX_PREFIX, INDEX_ALIAS), (CHUNK_INDEX_PREFIX, CHUNK_INDEX_ALIAS)):
+        if has_legacy_index(client, alias):
+            logging.warning(f"Index {alias} predates the template; run `mailsearch index-setup --migrate-legacy`")
+            ok = False
+        elif client.indices.exists(index=prefix + "*", allow_no_indices=False):
+            client.indices.update_aliases(actions=[{"add": {"index": prefix + "*", "alias": alias}}])
+    return ok
+
+
+class IndexManager:
+    # Creates the per-year indices on first use, with the alias, and in bulk mode switches
+    # every index this process writes to over to bulk load settings
+    def __init__(self, client, bulk_load=False, prefix=INDEX_PREFIX, alias=INDEX_ALIAS):
+        self.client = client
+        self.bulk_load = bulk_load
+        self.prefix = prefix
+        self.alias = alias
+        self._ready = set()
+        self._lock = threading.Lock()
+        self._use_alias = None
+
+    def index_for(self, date_value):
+        name = index_name(date_value, self.prefix)
+        if name not in self._ready:
+            self._prepare(name)
+        return name
+
+    def _prepare(self, name):
+        with self._lock:
+            if name in self._ready:
+                return
+            if self._use_alias is None:
+                self._use_alias = not has_legacy_index(self.client, self.alias)
+            created = False
+            if not self.client.indices.exists(index=name):
+                try:
+                    self.client.indices.create(
+                        index=name,
+                        aliases={self.alias: {}} if self._use_alias else None,
+                        settings=BULK_LOAD_SETTINGS if self.bulk_load else None,
+                    )
+                    created = True
+                    logging.info(f"Created index {name}")
+                except Exception as e:
+                    # created by another worker in the meantime
+                    if not self.client.indices.exists(index=name):
+                        raise
+                    logging.info(f"Index {name} already created: {e}")
+            if self.bulk_load and not created:
+                self.client.indices.put_settings(index=name, settings=BULK_LOAD_SETTINGS)
+            self._ready.add(name)
+
+
+def finish_bulk_load(client, forcemerge=True):
+    # Restores refresh and replicas on every index left in bulk load state, then merges it
+    settings = client.indices.get_settings(index=f"{INDEX_PREFIX}*,{CHUNK_INDEX_PREFIX}*", name="index.refresh_interval",
+                                           flat_settings=True, allow_no_indices=True)
+    loaded = sorted(
+        name for name, value in settings.items()
+        if value.get("settings", {}).get("index.refresh_interval") == "-1"
+    )
+    for name in loaded:
+        client.indices.put_settings(index=name, settings={
+            "index": {"refresh_interval": INDEX_REFRESH_INTERVAL, "number_of_replicas": INDEX_REPLICAS},
+        })
+        client.indices.refresh(index=name)
+        if forcemerge:
+            print(f"Force merging {name}")
+            client.options(request_timeout=FORCEMERGE_TIMEOUT).indices.forcemerge(index=name, max_num_segments=1)
+    return loaded
+
+
+# Routes each legacy document to email_exchange-<year> by the first four characters of its date
+REINDEX_BY_YEAR = """
+String year = 'undated';
+def date = ctx._source.date;
+if (date instanceof String && date.length() >= 4) {
+    boolean digits = true;
+    for (int i = 0; i < 4; i++) {
+        if (!Character.isDigit(date.charAt(i))) {
+            digits = false;
+        }
+    }
+    if (digits) {
+        year = date.substring(0, 4);
+    }
+}
+ctx._index = params.prefix + year;
+"""
+
+
+def migrate_legacy_index(client):
+    # Copies the legacy email_exchange index into the per-year indices, deletes it once all
+    # documents arrived and puts the alias in its place
+    if not has_legacy_index(client):
+        print(f"No legacy {INDEX_ALIAS} index")
+        return True
+    long_client = client.options(request_timeout=FORCEMERGE_TIMEOUT)
+    result = long_client.reindex(
+        source={"index": INDEX_ALIAS},
+        dest={"index": INDEX_PREFIX + "undated", "op_type": "index"},
+        script={"lang": "painless", "source": REINDEX_BY_YEAR, "params": {"prefix": INDEX_PREFIX}},
+        wait_for_completion=True,
+        refresh=True,
+    )
+    if result.get("failures"):
+        logging.error(f"Legacy reindex failures: {result['failures'][:10]}")
+        return False
+
+    legacy_count = client.count(index=INDEX_ALIAS)["count"]
+    migrated_count = client.count(index=INDEX_PREFIX + "*")["count"]
+    if migrated_count < legacy_count:
+        logging.error(f"Legacy index has {legacy_count} documents but only {migrated_count} were migrated")
+        return False
+
+    client.indices.delete(index=INDEX_ALIAS)
+    ensure_alias(client)
+    print(f"Migrated {legacy_count} documents from {INDEX_ALIAS} into {INDEX_PREFIX}<year>")
+    return True
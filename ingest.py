@@ -0,0 +1,970 @@
+import os
+import json
+import time
+import logging
+import threading
+import multiprocessing
+import traceback
+from collections import Counter, deque
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from io import BytesIO
+
+from dotenv import load_dotenv
+
+import metrics
+from mail_sources import MailAttachment, MailMessage, SpooledAttachment, open_mail_source, find_mail_sources, source_size
+from extract_pool import get_extraction_pool, resolve_attachment_text
+from ad_cache import DirectoryCache, lookup_recipients
+from checkpoint import CheckpointStore, SourceProgress, document_id, internet_message_id, message_key, record_indexed
+from attachment_chunks import ChunkSplitter, cap_attachment_text, delete_stale_chunks
+from dedup import DedupStore, dedup_key, dedup_document_id, message_date, simhash, to_upserts
+from pipeline import PIPELINE_ENRICH_WORKERS, PIPELINE_SAVE_WORKERS, Pipeline, Stage
+from spool import SpoolWriter, read_segment, segments
+from scheduling import SPLIT_STORE_BYTES, Task, WorkerGate, folder_ranges, largest_first, split_store
+from work_queue import Heartbeat, WORK_QUEUE_LEASE, job_key, node_name, open_work_queue
+from attachment_store import LocalAttachmentStore, MinioAttachmentStore, sha256_bytes, sha256_file, worker_temp_path
+
+# Mailbox ingestion behind `mailsearch ingest`.
+# Importing this module has no side effects: Elasticsearch, LDAP and MinIO clients are
+# created on first use in each process, and worker processes receive the run options
+# through configure().
+
+load_dotenv()
+
+ELASTIC_HOST = os.getenv("ELASTIC_HOST")
+ELASTIC_USER = os.getenv("ELASTIC_USER")
+ELASTIC_PASSWORD = os.getenv("ELASTIC_PASSWORD")
+ACTIVE_ADDRESS = os.getenv("ACTIVE_ADDRESS")
+ACTIVE_USER = os.getenv("ACTIVE_USER", "alborz\\ldap.user")
+ACTIVE_PASSWORD = os.getenv("ACTIVE_PASSWORD")
+ACTIVE_SEARCH_BASE = os.getenv("ACTIVE_SEARCH_BASE")
+MINIO_ENDPOINT = os.getenv("MINIO_ENDPOINT", "127.0.0.1:9000")
+MINIO_ACCESS_KEY = os.getenv("MINIO_ACCESS_KEY", "minioadmin")
+MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY", "minioadmin")
+MINIO_SECURE = os.getenv("MINIO_SECURE", "false").lower() == "true"
+MINIO_BUCKET = os.getenv("MINIO_BUCKET", "email-attachments")
+MINIO_CONSOLE_URL = os.getenv("MINIO_CONSOLE_URL", "http://172.16.55.24:9001")
+
+TARGET_FOLDERS = ["inbox", "sent items", "deleted items"]
+LEGACY_PROCESSED_FILE = "processed_pst.txt"
+# seconds between looks at the queue while other nodes still hold jobs (--queue-wait)
+WORK_QUEUE_POLL = float(os.getenv("WORK_QUEUE_POLL", "30"))
+
+# Run options (argparse namespace from mailsearch.py), set in every process by configure()
+options = None
+
+_clients = {}
+_clients_lock = threading.RLock()
+
+
+def setup_logging():
+    log_dir = "logs"
+    os.makedirs(log_dir, exist_ok=True)
+    log_filename = os.path.join(log_dir, f"email_processor_{datetime.now().strftime('%Y-%m-%d')}.log")
+    logging.basicConfig(
+        filename=log_filename,
+        level=logging.INFO,
+        format='%(asctime)s [%(levelname)s] %(message)s',
+        encoding='utf-8'
+    )
+
+
+def configure(opts, metrics_updates=None):
+    # Also the initializer of worker processes, which send their metrics to the parent on metrics_updates
+    global options
+    options = opts
+    setup_logging()
+    if metrics_updates is not None:
+        metrics.start_push(metrics_updates)
+
+
+def _client(name, factory):
+    # One instance per process; a forked child builds its own instead of sharing sockets
+    with _clients_lock:
+        if _clients.get("pid") != os.getpid():
+            _clients.clear()
+            _clients["pid"] = os.getpid()
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
+
+
+def get_es():
+    def create():
+        from elasticsearch import Elasticsearch
+        return Elasticsearch(
+            hosts=[ELASTIC_HOST],
+            basic_auth=(ELASTIC_USER, ELASTIC_PASSWORD),
+            http_compress=True
+        )
+    return _client("es", create)
+
+
+def get_directory():
+    # read-only view of the on-disk AD snapshot, opened on first lookup
+    return _client("directory", DirectoryCache)
+
+
+def get_checkpoint_store():
+    return _client("checkpoint", CheckpointStore)
+
+
+def get_dedup_store():
+    return _client("dedup", DedupStore)
+
+
+def get_minio():
+    # client, content addressed store and upload stage for --store minio
+    def create():
+        from upload_stage import UploadStage, create_minio_client
+        client = create_minio_client(MINIO_ENDPOINT, MINIO_ACCESS_KEY, MINIO_SECRET_KEY, secure=MINIO_SECURE)
+        return {
+            "client": client,
+            "store": MinioAttachmentStore(client, MINIO_BUCKET),
+            "uploads": UploadStage(),
+        }
+    return _client("minio", create)
+
+
+def get_local_store():
+    return _client("local_store", lambda: LocalAttachmentStore(options.attachments_path))
+
+
+def get_indexer():
+    # one streaming indexer per process, shared by all reader threads
+    def create():
+        from bulk_indexer import BulkIndexer
+
+        store = get_checkpoint_store()
+        # run on the indexer thread before a document is sent: wait for uploads and extracted
+        # text, then cap the text or move it into chunk documents
+        steps = []
+        if options.store == "minio":
+            from upload_stage import resolve_uploads
+            steps.append(resolve_uploads)
+        steps.append(resolve_attachment_text)
+        if options.spool:
+            steps.append(get_spool())
+        if options.attachment_text == "chunks":
+            steps.append(ChunkSplitter(get_chunk_index_manager().index_for))
+        else:
+            steps.append(cap_attachment_text)
+        if options.dedup != "off":
+            steps.append(to_upserts)
+
+        def prepare(actions):
+            for step in steps:
+                actions = step(actions)
+            return actions
+
+        def on_indexed(tag, actions):
+            # spooled before the checkpoint, so a crash in between reads the emails again
+            if options.spool:
+                get_spool().acknowledged(actions)
+            record_indexed(store, tag, actions)
+            if options.attachment_text == "chunks":
+                from index_template import CHUNK_INDEX_PREFIX
+                delete_stale_chunks(get_es(), CHUNK_INDEX_PREFIX + "*", actions)
+
+        return BulkIndexer(
+            get_es(),
+            prepare=prepare,
+            on_indexed=on_indexed,
+        ).start()
+    return _client("indexer", create)
+
+
+def get_spool():
+    # this process's spool segment (--spool), closed when the process exits
+    def create():
+        import multiprocessing.util
+        writer = SpoolWriter(options.spool)
+        multiprocessing.util.Finalize(writer, writer.close, exitpriority=50)
+        return writer
+    return _client("spool", create)
+
+
+def get_work_queue():
+    # jobs shared with the other ingest nodes, see work_queue
+    def create():
+        client = get_es() if options.queue_backend == "elasticsearch" else None
+        return open_work_queue(options.queue_backend, options.queue_path, client)
+    return _client("work_queue", create)
+
+
+def get_index_manager():
+    # per-year indices behind the email_exchange alias, see index_template
+    def create():
+        from index_template import IndexManager
+        return IndexManager(get_es(), bulk_load=options.bulk_load)
+    return _client("index_manager", create)
+
+
+def get_chunk_index_manager():
+    def create():
+        from index_template import IndexManager, CHUNK_INDEX_PREFIX, CHUNK_INDEX_ALIAS
+        return IndexManager(get_es(), bulk_load=options.bulk_load, prefix=CHUNK_INDEX_PREFIX, alias=CHUNK_INDEX_ALIAS)
+    return _client("chunk_index_manager", create)
+
+
+def refresh_directory():
+    # pulls only the AD entries changed since the last run into the snapshot
+    try:
+        from ldap3 import Server, Connection, ALL
+
+        server = Server(ACTIVE_ADDRESS, get_info=ALL)
+        conn = Connection(
+            server,
+            user=ACTIVE_USER,
+            password=ACTIVE_PASSWORD,
+            auto_bind=True
+        )
+        try:
+            get_directory().refresh(conn, ACTIVE_SEARCH_BASE)
+        finally:
+            conn.unbind()
+    except Exception as e:
+        logging.error(f"AD refresh failed, using the existing snapshot: {e}")
+
+
+def ensure_bucket():
+    client = get_minio()["client"]
+    if not client.bucket_exists(MINIO_BUCKET):
+        client.make_bucket(MINIO_BUCKET)
+
+
+def remove_temp_file(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        logging.error(f"Failed to remove temp file {path}: {e}")
+
+
+def save_attachments_local(message, user_name, email_id):
+    attachments_info = []
+    if message.Attachments.Count > 0:
+        # identical attachments share one content addressed blob, see attachment_store
+        store = get_local_store()
+        for i in range(1, message.Attachments.Count + 1):
+            filename = ""
+            try:
+                attachment = message.Attachments.Item(i)
+                filename = attachment.FileName
+                digest, file_path, size, _ = store.save(attachment, user_name, email_id, filename)
+
+                attachment_data = {
+                    "filename": filename,
+                    "filepath": file_path,
+                    "size": size,
+                    "sha256": digest,
+                }
+
+                # اضافه کردن متن ضمیمه اگر قابل استخراج بود
+                # the text is extracted in the background (or read from the text cache) and resolved before indexing
+                attachment_data["text"] = get_extraction_pool().submit(file_path, digest=digest)
+
+                attachments_info.append(attachment_data)
+            except Exception as e:
+                logging.error(f"Error processing attachment {filename}: {e}")
+    return attachments_info
+
+
+def save_attachments_minio(message, user_name, email_id):
+    from upload_stage import when_all_done
+
+    attachments_info = []
+    minio = get_minio()
+    attachment_store = minio["store"]
+
+    for i in range(1, message.Attachments.Count + 1):
+        filename = ""
+        try:
+            attachment = message.Attachments.Item(i)
+            filename = attachment.FileName
+            read = getattr(attachment, "read", None)
+
+            # blobs are keyed by content hash, an attachment already in the bucket is not uploaded again;
+            # uploads run in the background and the document is only indexed once they are confirmed
+            if read is not None:
+                # offline mail sources already hold the attachment in memory: no temp file,
+                # the same buffer is hashed, uploaded and handed to the extractor
+                content = read()
+                digest = sha256_bytes(content)
+                size = len(content)
+                # a fresh stream per attempt, so retries resend the whole attachment
+                upload = minio["uploads"].submit(
+                    lambda d=digest, n=filename, c=content: attachment_store.put(d, n, BytesIO(c), len(c))
+                )
+                extracted_text = get_extraction_pool().submit(filename, digest=digest, data=content)
+            else:
+                temp_path = worker_temp_path(filename)
+                attachment.SaveAsFile(temp_path)
+                digest = sha256_file(temp_path)
+                size = os.path.getsize(temp_path)
+                upload = minio["uploads"].submit(attachment_store.put_file, temp_path, filename, digest)
+                extracted_text = get_extraction_pool().submit(temp_path, digest=digest)
+                # the temp file is removed once both the upload and the extraction have read it
+                when_all_done([upload, extracted_text], lambda p=temp_path: remove_temp_file(p))
+
+            object_name = attachment_store.object_name(digest, filename)
+            minio_url = f"{MINIO_CONSOLE_URL}/browser/{MINIO_BUCKET}/{object_name}"
+            attachments_info.append({
+                "filename": filename,
+                "filepath": minio_url,
+                "size": size,
+                "sha256": digest,
+                "object_name": object_name,
+                "text": extracted_text,
+                "_upload": upload,
+            })
+
+        except Exception as e:
+            logging.error(f"Error processing attachment {filename}: {e}")
+            continue
+
+    return attachments_info
+
+
+def save_attachments(message, user_name, email_id):
+    with metrics.timer("ingest_attachment_save_seconds", store=options.store):
+        if options.store == "minio":
+            attachments = save_attachments_minio(message, user_name, email_id)
+        else:
+            attachments = save_attachments_local(message, user_name, email_id)
+    if attachments:
+        metrics.inc("ingest_attachments_total", len(attachments), store=options.store)
+        metrics.inc("ingest_attachment_bytes_total", sum(a["size"] for a in attachments), store=options.store)
+    return attachments
+
+
+def clean_email_field(email_field):
+    if email_field:
+        return [email.strip("'").strip() for email in email_field.split(';') if email.strip()]
+    return []
+
+
+def folder_key(folder_path, start=None):
+    # checkpoint name of a folder, or of the range of its items from start of a split store
+    return folder_path if start is None else f"{folder_path}#{start}"
+
+
+class MessageRecord:
+    # One message on its way through the pipeline, detached from the store by the reader
+    __slots__ = ("message", "doc_id", "full", "folder_name", "tag", "index_date", "attachments", "action")
+
+    def __init__(self, message, doc_id, full, folder_name, tag, index_date):
+        self.message = message
+        self.doc_id = doc_id
+        self.full = full
+        self.folder_name = folder_name
+        self.tag = tag
+        self.index_date = index_date
+        self.attachments = []
+        self.action = None
+
+
+def detach_attachments(message):
+    # Attachment content taken out of the store on the reader thread: the bytes for the offline
+    # backends, a temp file for Outlook
+    attachments = []
+    for i in range(1, message.Attachments.Count + 1):
+        filename = ""
+        try:
+            attachment = message.Attachments.Item(i)
+            filename = attachment.FileName
+            read = getattr(attachment, "read", None)
+            if read is not None:
+                content = read()
+                attachments.append(MailAttachment(filename, lambda c=content: c))
+            else:
+                temp_path = worker_temp_path(filename)
+                attachment.SaveAsFile(temp_path)
+                attachments.append(SpooledAttachment(filename, temp_path))
+        except Exception as e:
+            logging.error(f"Error reading attachment {filename}: {e}")
+    return attachments
+
+
+def discard_attachments(attachments):
+    # Temp files of spooled attachments the save stage did not move away: the message failed or
+    # was dropped before its attachments were saved
+    for attachment in attachments:
+        if isinstance(attachment, SpooledAttachment):
+            try:
+                attachment.discard()
+            except OSError as e:
+                logging.error(f"Failed to remove temp file {attachment.path}: {e}")
+
+
+# document fields filled in from the AD snapshot, replaced by `reindex-from-spool --enrich`
+DIRECTORY_FIELDS = ("display_name", "sam_account_name", "department", "manager", "recipients")
+
+
+def enrich_document(email_doc):
+    directory = get_directory()
+    user_info = directory.lookup(str(email_doc["email"]).lower().strip())
+    if user_info:
+        email_doc.update(user_info)
+    recipients = lookup_recipients(directory, email_doc["to"] + email_doc["cc"])
+    if recipients:
+        email_doc["recipients"] = recipients
+    return email_doc
+
+
+def message_pipeline(user_name, progress=None):
+    # read (the caller, see read_items) -> save attachments -> enrich -> indexer
+    indexer = get_indexer()
+
+    def save(record):
+        try:
+            if record.full:
+                record.attachments = save_attachments(record.message, user_name, record.message.EntryID)
+        finally:
+            discard_attachments(record.message.Attachments)
+        return record
+
+    def enrich(record):
+        message = record.message
+        email_doc = {
+            "subject": message.Subject,
+            "sender": message.SenderName,
+            "body": message.Body,
+            "to": clean_email_field(message.To),
+            "cc": clean_email_field(message.CC),
+            "date": message.ReceivedTime,
+            "user": user_name,
+            "attachments": record.attachments,
+            "email": message.SenderEmailAddress,
+            "folder_name": record.folder_name,
+        }
+        enrich_document(email_doc)
+
+        action = {
+            "_index": get_index_manager().index_for(record.index_date),
+            "_id": record.doc_id,
+            "_source": email_doc
+        }
+        if options.dedup != "off":
+            action["_dedup"] = {"owner": user_name, "folder": record.folder_name, "full": record.full}
+            if options.dedup == "near" and record.full:
+                body_hash = simhash(message.Body)
+                if body_hash is not None:
+                    email_doc["simhash"] = f"{body_hash:016x}"
+                    original = get_dedup_store().near_duplicate(record.doc_id, body_hash)
+                    if original:
+                        email_doc["near_duplicate_of"] = original
+                        metrics.inc("ingest_dedup_total", result="near")
+        if options.spool:
+            action["_spool"] = {"store": progress.source if progress else user_name, "index_date": record.index_date}
+        record.action = action
+        return record
+
+    def index(record):
+        indexer.add(record.action, tag=record.tag)
+        return record
+
+    def failed(record, stage, error):
+        logging.error(f"Failed to process message ({stage}): {error}")
+        metrics.inc("ingest_messages_total", folder=record.folder_name, result="failed")
+        if progress:
+            progress.add_error()
+        discard_attachments(record.message.Attachments)
+
+    return Pipeline([
+        Stage("save", save, PIPELINE_SAVE_WORKERS),
+        Stage("enrich", enrich, PIPELINE_ENRICH_WORKERS),
+        Stage("index", index),
+    ], on_error=failed)
+
+
+def read_folder(folder, user_name, progress=None):
+    # Reads every target folder below folder through a message pipeline; returns the number of
+    # documents handed to the shared per-process indexer. progress is the checkpoint of the PST being read
+    with message_pipeline(user_name, progress) as pipeline:
+        feed_folder(pipeline, folder, user_name, progress)
+    return pipeline.count
+
+
+def feed_folder(pipeline, folder, user_name, progress=None, parent_path=""):
+    try:
+        folder_path = f"{parent_path}/{folder.Name}"
+        if folder.Name.lower() in TARGET_FOLDERS:
+            read_items(pipeline, folder, user_name, progress, folder_path)
+
+        sub_folders = folder.Folders
+        unreadable = getattr(sub_folders, "unreadable", 0)
+        for sub_folder in sub_folders:
+            feed_folder(pipeline, sub_folder, user_name, progress, folder_path)
+        # a sub folder the store could not open (see mail_sources.ItemCollection) keeps the store from being done
+        if progress and getattr(sub_folders, "unreadable", 0) > unreadable:
+            progress.add_error()
+
+    except Exception as e:
+        logging.error(f"Error reading folder {folder.Name}: {e}")
+        if progress:
+            progress.add_error()
+
+
+def read_items(pipeline, folder, user_name, progress, folder_path, start=None, stop=None):
+    # The reader: puts the mail items of one folder, or items start..stop-1 of it for a part of a
+    # split store, into the pipeline, with everything the later stages need copied out of the store
+    key = folder_key(folder_path, start)
+    if progress and progress.is_folder_done(key):
+        return
+    folder_name = folder.Name.lower()
+    tag = progress.tag(key) if progress else None
+    folder_items = 0
+    # with dedup a message can sit in one folder twice under one _id, and is acknowledged once
+    folder_ids = set()
+    items = folder.Items
+    unreadable = getattr(items, "unreadable", 0)
+    # False once an item failed before it was counted: the folder is then not recorded as read,
+    # so the next run reads it again instead of taking it as done without that item
+    complete = True
+    messages = items if start is None else items.slice(start, stop)
+    # read time: from asking the store for the item until its fields are read
+    read_started = time.perf_counter()
+    for message in messages:
+        attachments = []
+        try:
+            if progress:
+                metrics.registry.source_progress(progress.name)
+            if message.Class == 43:
+                folder_items += 1
+                # deterministic _id: re-runs overwrite instead of duplicating, and acknowledged messages are skipped;
+                # with dedup every mailbox's copy of a message shares it
+                if options.dedup != "off":
+                    doc_id = dedup_document_id(dedup_key(message))
+                else:
+                    doc_id = document_id(user_name, message_key(message))
+                if doc_id in folder_ids:
+                    folder_items -= 1
+                    metrics.inc("ingest_messages_total", folder=folder_name, result="skipped")
+                    continue
+                folder_ids.add(doc_id)
+                if progress and progress.is_indexed(doc_id, key):
+                    metrics.inc("ingest_messages_total", folder=folder_name, result="skipped")
+                    continue
+                subject = message.Subject or ""
+                sender = message.SenderName or ""
+                body = (message.Body or "").strip().replace('\n', '')
+                received = message.ReceivedTime
+                email_o = message.SenderEmailAddress
+                try:
+                    exch_user = message.Sender.GetExchangeUser()
+                    if exch_user:
+                        email_o = exch_user.PrimarySmtpAddress
+                except Exception as ex:
+                    pass
+                metrics.observe("ingest_message_read_seconds", time.perf_counter() - read_started,
+                                backend=options.backend)
+                metrics.inc("ingest_messages_total", folder=folder_name, result="read")
+                # only the copy that claims the message carries (and saves) the attachments
+                full = options.dedup == "off" or get_dedup_store().claim(
+                    doc_id, progress.source if progress else user_name)
+                if options.dedup != "off":
+                    metrics.inc("ingest_dedup_total", result="claimed" if full else "copy")
+                attachments = detach_attachments(message) if full else []
+
+                index_date = received
+                if options.dedup != "off":
+                    # the send time is the same in every copy, so they all go to one year index
+                    index_date = message_date(message) or received
+                if isinstance(received, datetime):
+                    received = received.strftime("%Y-%m-%dT%H:%M:%S%z")
+                if isinstance(index_date, datetime):
+                    index_date = index_date.strftime("%Y-%m-%dT%H:%M:%S%z")
+
+                detached = MailMessage(message.EntryID, subject, sender, email_o, body, received,
+                                       message.To, message.CC, internet_message_id(message), attachments=attachments)
+                record = MessageRecord(detached, doc_id, full, folder_name, tag, index_date)
+                # what the message holds in memory until it leaves the pipeline; spooled attachments are on disk
+                size = len(body) + sum(len(a.read()) for a in attachments if hasattr(a, "read"))
+                pipeline.put(record, size)
+        except Exception as e:
+            logging.error(f"Failed to process message: {e}")
+            metrics.inc("ingest_messages_total", folder=folder_name, result="failed")
+            complete = False
+            if progress:
+                progress.add_error()
+            discard_attachments(attachments)
+        finally:
+            read_started = time.perf_counter()
+
+    # items the store could not hand out were logged and skipped by the collection
+    unreadable = getattr(items, "unreadable", 0) - unreadable
+    if unreadable:
+        metrics.inc("ingest_messages_total", unreadable, folder=folder_name, result="failed")
+        complete = False
+        if progress:
+            progress.add_error()
+    if progress and complete:
+        progress.folder_read(key, folder_items)
+
+
+def count_pending(folder, progress=None, parent_path=""):
+    # Items left to read below folder, for the progress ETA; item counts are cheap in every backend
+    folder_path = f"{parent_path}/{folder.Name}"
+    total = 0
+    if folder.Name.lower() in TARGET_FOLDERS and not (progress and progress.is_folder_done(folder_path)):
+        total += folder.Items.Count
+    for sub_folder in folder.Folders:
+        total += count_pending(sub_folder, progress, folder_path)
+    return total
+
+
+def plan_ranges(folder, progress, parent_path="", indices=()):
+    # Item ranges (see scheduling.folder_ranges) of the target folders still to read, for splitting a store
+    folder_path = f"{parent_path}/{folder.Name}"
+    ranges = []
+    if folder.Name.lower() in TARGET_FOLDERS and not progress.is_folder_done(folder_path):
+        ranges += [r for r in folder_ranges(indices, folder_path, folder.Items.Count)
+                   if not progress.is_folder_done(folder_key(folder_path, r[2]))]
+    for i in range(folder.Folders.Count):
+        ranges += plan_ranges(folder.Folders.Item(i + 1), progress, folder_path, indices + (i,))
+    return ranges
+
+
+def read_ranges(root_folder, user_name, progress, ranges):
+    with message_pipeline(user_name, progress) as pipeline:
+        for indices, folder_path, start, stop in ranges:
+            try:
+                folder = root_folder
+                for i in indices:
+                    folder = folder.Folders.Item(i + 1)
+                read_items(pipeline, folder, user_name, progress, folder_path, start, stop)
+            except Exception as e:
+                logging.error(f"Error reading folder {folder_path}: {e}")
+                progress.add_error()
+    return pipeline.count
+
+
+def extract_emails_from_pst(pst_path, folder_name, task=None):
+    # task: one part of a split store (see scheduling), which reads only its ranges and leaves
+    # marking the store done to the parent
+    file_total = 0
+    progress = SourceProgress(get_checkpoint_store(), pst_path)
+    if task is not None:
+        progress.name = task.name
+
+    try:
+        with open_mail_source(pst_path, options.backend) as source:
+            root_folder = source.root_folder()
+            if task is not None:
+                metrics.registry.source_started(progress.name, task.items)
+                file_total = read_ranges(root_folder, folder_name, progress, task.ranges)
+            else:
+                try:
+                    expected = count_pending(root_folder, progress)
+                except Exception as e:
+                    logging.warning(f"Could not count the items of {pst_path}: {e}")
+                    expected = None
+                metrics.registry.source_started(pst_path, expected)
+                file_total = read_folder(root_folder, folder_name, progress)
+
+    except Exception as e:
+        logging.error(f"Error processing {pst_path}: {e}")
+        traceback.print_exc()
+        progress.add_error()
+
+    indexer = get_indexer()
+    indexer.flush()
+    # a folder's read count goes in only once the pipeline and the indexer are drained
+    progress.record_folders()
+    if options.spool:
+        get_spool().flush()
+    file_indexed, file_failed = 0, 0
+    for tag in progress.folder_tags:
+        indexed, failed = indexer.pop_counts(tag)
+        file_indexed += indexed
+        file_failed += failed
+    if task is None:
+        progress.complete(file_failed == 0 and progress.errors == 0)
+    metrics.registry.source_finished(progress.name, file_failed == 0 and progress.errors == 0)
+    metrics.push()
+    print(f"[{progress.name}] Total: {file_total}, Indexed: {file_indexed}, Failed: {file_failed}")
+    return file_total, file_indexed, file_failed
+
+
+def process_pst_file(pst_path):
+    folder_name = os.path.basename(os.path.dirname(pst_path))
+    print(f"Processing {pst_path}")
+    return extract_emails_from_pst(pst_path, folder_name)
+
+
+def process_task(task):
+    if task.ranges is None:
+        return process_pst_file(task.path)
+    print(f"Processing {task.name}, {task.items} items")
+    return extract_emails_from_pst(task.path, os.path.basename(os.path.dirname(task.path)), task)
+
+
+def pending_sources(base_dir, backend):
+    # processed_pst.txt from earlier runs is still honoured, progress is now kept in the checkpoint store
+    processed_files = set()
+    if os.path.exists(LEGACY_PROCESSED_FILE):
+        with open(LEGACY_PROCESSED_FILE, "r", encoding="utf-8") as f:
+            processed_files = set(line.strip() for line in f if line.strip())
+
+    checkpoint_store = get_checkpoint_store()
+    return [
+        p for p in find_mail_sources(base_dir, backend)
+        if p not in processed_files and not checkpoint_store.is_source_done(p)
+    ]
+
+
+def plan_tasks(sources, workers):
+    # Largest stores first; a store of SPLIT_STORE_BYTES or more is split into parts when the
+    # backend can open it in several processes at once (not Outlook, one MAPI session)
+    tasks = []
+    for path in sources:
+        size = source_size(path)
+        if workers > 1 and options.backend != "outlook" and size >= SPLIT_STORE_BYTES:
+            try:
+                with open_mail_source(path, options.backend) as source:
+                    ranges = plan_ranges(source.root_folder(), SourceProgress(get_checkpoint_store(), path))
+                tasks += split_store(path, size, ranges, workers) if ranges else [Task(path, size)]
+                continue
+            except Exception as e:
+                logging.warning(f"Could not split {path}, reading it whole: {e}")
+        tasks.append(Task(path, size))
+    return largest_first(tasks)
+
+
+def run_tasks(executor, tasks, gate, monitor):
+    # Submits the tasks in order while fewer than gate.limit run; yields (task, result) as they finish
+    pending = list(reversed(tasks))
+    running = {}
+    while pending or running:
+        while pending and len(running) < gate.limit:
+            task = pending.pop()
+            running[executor.submit(process_task, task)] = task
+        done, _ = wait(running, timeout=gate.interval, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield running.pop(future), future.result()
+        gate.adjust(monitor.snapshot())
+
+
+def finish_split_source(path, tasks):
+    # A split store is done once every range of every part was read and acknowledged
+    store = get_checkpoint_store()
+    if all(store.is_folder_done(path, folder_key(folder_path, start))
+           for task in tasks for _, folder_path, start, _ in task.ranges):
+        store.mark_source_done(path)
+        return True
+    return False
+
+
+def queue_sources(base_dir, backend):
+    # Coordinator side: adds the stores still to ingest to the shared queue
+    sources = pending_sources(base_dir, backend)
+    added = get_work_queue().add((job_key(base_dir, path), source_size(path)) for path in sources)
+    return added, len(sources)
+
+
+def work_from_queue(worker):
+    # One ingest worker of this node: claims stores from the queue until none is pending
+    # (with --queue-wait, until no other node holds one either)
+    queue = get_work_queue()
+    node = f"{node_name()}/{worker}"
+    totals = [0, 0, 0]
+    while True:
+        job = queue.claim(node)
+        if job is None:
+            if options.queue_wait and queue.status()["states"]["leased"]["jobs"]:
+                time.sleep(WORK_QUEUE_POLL)
+                continue
+            break
+        job.resolve(options.source)
+
+        def progress():
+            state = metrics.registry.source(job.path)
+            return (state["done"], state["expected"]) if state else None
+
+        result, error = (0, 0, 0), None
+        with Heartbeat(queue, job, WORK_QUEUE_LEASE, progress) as heartbeat:
+            try:
+                result = process_pst_file(job.path)
+            except Exception as e:
+                logging.error(f"Job {job.source} failed: {e}")
+                error = str(e)
+        ok = error is None and not heartbeat.lost and get_checkpoint_store().is_source_done(job.path)
+        if not ok and error is None:
+            error = "lease lost" if heartbeat.lost else f"{result[2]} documents failed or items unreadable"
+        queue.complete(job, ok, *result, error=error)
+        totals = [a + b for a, b in zip(totals, result)]
+    return tuple(totals)
+
+
+def finish_queue(opts):
+    # Coordinator step of `mailsearch queue finish`: the bulk load of the indices the nodes wrote
+    # is finished once, after no job is pending or leased any more
+    from index_template import finish_bulk_load
+
+    states = get_work_queue().status()["states"]
+    busy = states["pending"]["jobs"] + states["leased"]["jobs"]
+    if busy:
+        print(f"{busy} jobs are still pending or leased, the bulk load is not finished")
+        return False
+    loaded = finish_bulk_load(get_es(), forcemerge=opts.forcemerge)
+    print(f"Finished the bulk load of {len(loaded)} indices")
+    return True
+
+
+def prepare_cluster(opts):
+    from index_template import install_template, ensure_alias
+
+    install_template(get_es())
+    ensure_alias(get_es())
+    if opts.dedup != "off":
+        from dedup import install_merge_script
+        install_merge_script(get_es())
+
+
+def start_workers(opts):
+    # Outlook COM is single threaded per profile, the offline readers parse one store per process
+    # and send their metrics back to this one; returns (executor, monitor)
+    if opts.backend == "outlook":
+        metrics_updates = None
+        executor = ThreadPoolExecutor(max_workers=opts.workers)
+    else:
+        metrics_updates = multiprocessing.Queue()
+        executor = ProcessPoolExecutor(max_workers=opts.workers, initializer=configure,
+                                       initargs=(opts, metrics_updates))
+    monitor = metrics.Monitor(metrics_updates, port=opts.metrics_port, interval=opts.progress_interval).start()
+    return executor, monitor
+
+
+def finish_run(opts, monitor, total_emails, indexed_emails, failed_emails):
+    from index_template import finish_bulk_load
+
+    snapshot = monitor.stop()
+    if opts.progress_interval:
+        print(json.dumps(metrics.progress(snapshot), ensure_ascii=False))
+
+    if opts.bulk_load and opts.queue:
+        # other nodes may still be writing; `mailsearch queue finish` runs it once the queue is drained
+        print("Bulk load settings stay until `mailsearch queue finish` is run")
+    elif opts.bulk_load:
+        # refresh and replicas come back, and the written indices are merged, once all workers are done
+        finish_bulk_load(get_es(), forcemerge=opts.forcemerge)
+
+    print("=" * 40)
+    print(f"Total Emails Processed: {total_emails}")
+    print(f"Total Emails Indexed:   {indexed_emails}")
+    print(f"Total Emails Failed:    {failed_emails}")
+    print("=" * 40)
+    return failed_emails == 0
+
+
+def run_ingest(opts):
+    configure(opts)
+
+    refresh_directory()
+    if opts.store == "minio":
+        ensure_bucket()
+    prepare_cluster(opts)
+
+    if opts.queue:
+        # stores come from the shared queue (`mailsearch queue add`), every worker claims its own
+        get_work_queue()
+        tasks = None
+    else:
+        tasks = plan_tasks(pending_sources(opts.source, opts.backend), opts.workers)
+        # parts of split stores still running, per store
+        unfinished = Counter(task.path for task in tasks if task.ranges is not None)
+        for path, parts in unfinished.items():
+            print(f"Splitting {path} into {parts} parts")
+
+    executor, monitor = start_workers(opts)
+
+    total_emails = 0
+    indexed_emails = 0
+    failed_emails = 0
+    with executor:
+        if tasks is None:
+            results = executor.map(work_from_queue, range(opts.workers))
+        else:
+            results = []
+            gate = WorkerGate(opts.min_workers, opts.workers)
+            for task, result in run_tasks(executor, tasks, gate, monitor):
+                results.append(result)
+                if task.ranges is None:
+                    continue
+                unfinished[task.path] -= 1
+                if not unfinished[task.path] and not finish_split_source(
+                        task.path, [t for t in tasks if t.path == task.path]):
+                    logging.warning(f"{task.path} is not complete, its missing ranges are read on the next run")
+        for file_total, file_indexed, file_failed in results:
+            total_emails += file_total
+            indexed_emails += file_indexed
+            failed_emails += file_failed
+    return finish_run(opts, monitor, total_emails, indexed_emails, failed_emails)
+
+
+def reindex_segment(path):
+    # Sends the documents of one spool segment to the indexer, with fresh AD fields for --enrich
+    print(f"Reindexing {path}")
+    indexer = get_indexer()
+    metrics.registry.source_started(path, None)
+    total, before = 0, (indexer.indexed, indexer.failed)
+    for record in read_segment(path):
+        try:
+            email_doc = record["doc"]
+            if options.enrich:
+                for field in DIRECTORY_FIELDS:
+                    email_doc.pop(field, None)
+                enrich_document(email_doc)
+            action = {
+                "_index": get_index_manager().index_for(record["index_date"]),
+                "_id": record["_id"],
+                "_source": email_doc,
+            }
+            if options.dedup != "off" and "dedup" in record:
+                action["_dedup"] = record["dedup"]
+            metrics.registry.source_progress(path)
+            indexer.add(action)
+            total += 1
+        except Exception as e:
+            logging.error(f"Failed to reindex a record of {path}: {e}")
+    indexer.flush()
+    indexed, failed = indexer.indexed - before[0], indexer.failed - before[1]
+    metrics.registry.source_finished(path, failed == 0)
+    metrics.push()
+    print(f"[{path}] Total: {total}, Indexed: {indexed}, Failed: {failed}")
+    return total, indexed, failed
+
+
+def run_reindex(opts):
+    # `mailsearch reindex-from-spool`: the spooled documents go straight to the indexer, no store
+    # is opened and no attachment read again
+    configure(opts)
+    if opts.enrich:
+        refresh_directory()
+    prepare_cluster(opts)
+
+    paths = segments(opts.spool_dir)
+    print(f"{len(paths)} spool segments in {opts.spool_dir}")
+    executor, monitor = start_workers(opts)
+    total_emails = indexed_emails = failed_emails = 0
+    with executor:
+        for file_total, file_indexed, file_failed in reindex_in_order(executor, paths, opts.workers):
+            total_emails += file_total
+            indexed_emails += file_indexed
+            failed_emails += file_failed
+    return finish_run(opts, monitor, total_emails, indexed_emails, failed_emails)
+
+
+def reindex_in_order(executor, paths, workers):
+    # A window of workers segments, oldest first: a segment starts once the one workers places
+    # older has finished. Segments inside the window run at the same time and interleave, so a
+    # message spooled twice ends up as the later copy when its segments are at least workers
+    # apart; --workers 1 replays the spool strictly in order
+    window = deque()
+    for path in paths:
+        if len(window) >= workers:
+            yield window.popleft().result()
+        window.append(executor.submit(reindex_segment, path))
+    while window:
+        yield window.popleft().result()
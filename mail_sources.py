@@ -0,0 +1,423 @@
+import os
+import shutil
+import logging
+import threading
+import mailbox
+import email
+from email import policy
+from email.utils import getaddresses, parseaddr, parsedate_to_datetime
+
+# Mail source backends used by read_folder.
+# Every backend exposes the small part of the Outlook object model that
+# read_folder walks (folder.Name / Items / Folders, message.Subject,
+# message.Attachments.Item(i).SaveAsFile(...), ...), so the ingest code does
+# not care whether messages come from Outlook COM, an offline PST/OST reader,
+# an mbox file or a directory of .eml files.
+
+BACKENDS = ("outlook", "pff", "mbox", "eml")
+
+OL_MAIL_ITEM = 43
+
+# MAPI property tags read from PST/OST record sets
+PR_MESSAGE_CLASS = 0x001A
+PR_DISPLAY_NAME = 0x3001
+PR_DISPLAY_TO = 0x0E04
+PR_DISPLAY_CC = 0x0E03
+PR_SENDER_EMAIL_ADDRESS = 0x0C1F
+PR_SENDER_SMTP_ADDRESS = 0x5D01
+PR_INTERNET_MESSAGE_ID = 0x1035
+PR_ATTACH_FILENAME = 0x3704
+PR_ATTACH_LONG_FILENAME = 0x3707
+
+# Folder names used by other clients mapped to the Outlook names read_folder looks for
+WELL_KNOWN_FOLDERS = {
+    "inbox": "Inbox",
+    "sent": "Sent Items",
+    "sent mail": "Sent Items",
+    "sent messages": "Sent Items",
+    "sent items": "Sent Items",
+    "trash": "Deleted Items",
+    "deleted": "Deleted Items",
+    "deleted messages": "Deleted Items",
+    "deleted items": "Deleted Items",
+}
+
+# Outlook exposes a single MAPI session per process, AddStore/RemoveStore must not interleave
+outlook_lock = threading.Lock()
+
+
+def safe_filename(name, default="attachment"):
+    name = os.path.basename(str(name or "").replace("\\", "/")).strip()
+    return name or default
+
+
+def folder_display_name(name):
+    return WELL_KNOWN_FOLDERS.get(name.lower().strip(), name)
+
+
+class ItemCollection:
+    """1-based, lazily materialised collection, like Outlook's Items/Folders/Attachments."""
+
+    def __init__(self, count, getter):
+        self.Count = count
+        self._getter = getter
+        # items slice() could not read; the readers compare it before and after a pass, and
+        # neither mark the folder read nor the store done when it grew
+        self.unreadable = 0
+
+    def Item(self, index):
+        return self._getter(index - 1)
+
+    def __iter__(self):
+        return self.slice(0, self.Count)
+
+    def slice(self, start, stop):
+        # items start..stop-1 (0-based), for reading one range of a large folder
+        for i in range(start, min(stop, self.Count)):
+            try:
+                item = self._getter(i)
+            except Exception as e:
+                # a single unreadable item must not abort the whole folder
+                logging.error(f"Item {i + 1} of {self.Count} could not be read: {e}")
+                self.unreadable += 1
+                continue
+            yield item
+
+    def __len__(self):
+        return self.Count
+
+
+class MailFolder:
+    def __init__(self, name, items=None, folders=None):
+        self.Name = name
+        self.Items = items if items is not None else ItemCollection(0, None)
+        self.Folders = folders if folders is not None else ItemCollection(0, None)
+
+
+class MailAttachment:
+    def __init__(self, filename, loader):
+        self.FileName = safe_filename(filename)
+        self._loader = loader
+
+    def read(self):
+        return self._loader()
+
+    def SaveAsFile(self, path):
+        with open(path, "wb") as f:
+            f.write(self.read())
+
+
+class SpooledAttachment:
+    # Attachment content saved to a temp file on the thread that read the store, for stores
+    # that cannot be used from other threads (Outlook COM); SaveAsFile moves the file
+    def __init__(self, filename, path):
+        self.FileName = safe_filename(filename)
+        self.path = path
+
+    def SaveAsFile(self, path):
+        shutil.move(self.path, path)
+
+    def discard(self):
+        # removes the temp file unless SaveAsFile moved it away
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class MailMessage:
+    Class = OL_MAIL_ITEM
+    Sender = None
+
+    def __init__(self, entry_id, subject="", sender_name="", sender_email="", body="",
+                 received=None, to="", cc="", message_id="", attachments=None, sent=None):
+        self.EntryID = entry_id
+        self.Subject = subject
+        self.SenderName = sender_name
+        self.SenderEmailAddress = sender_email
+        self.Body = body
+        self.ReceivedTime = received
+        # the send time, the same in every copy of the message (see dedup.message_date)
+        self.SentOn = sent
+        self.To = to
+        self.CC = cc
+        self.InternetMessageID = message_id
+        self.Attachments = ItemCollection(len(attachments or []), (attachments or []).__getitem__)
+
+
+class MailSource:
+    """A mailbox store opened by one of the backends; use as a context manager."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def root_folder(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class OutlookSource(MailSource):
+    # Attaches the PST to the running Outlook profile, only works on Windows with Outlook installed
+    def __init__(self, path):
+        super().__init__(path)
+        self._outlook = None
+        self._root = None
+
+    def root_folder(self):
+        import pythoncom
+        import win32com.client
+
+        pythoncom.CoInitialize()
+        with outlook_lock:
+            self._outlook = win32com.client.Dispatch("Outlook.Application").GetNamespace("MAPI")
+            self._outlook.AddStore(self.path)
+
+            for i in range(self._outlook.Folders.Count):
+                if self._outlook.Folders.Item(i + 1).Name.lower() in os.path.basename(self.path).lower():
+                    self._root = self._outlook.Folders.Item(i + 1)
+                    break
+            if not self._root:
+                self._root = self._outlook.Folders.Item(self._outlook.Folders.Count)
+        return self._root
+
+    def close(self):
+        with outlook_lock:
+            if self._outlook and self._root:
+                found = False
+                for i in range(self._outlook.Folders.Count):
+                    if self._outlook.Folders.Item(i + 1).Name == self._root.Name:
+                        found = True
+                        break
+                if found:
+                    self._outlook.RemoveStore(self._root)
+
+
+def _pff_entry(item, entry_type):
+    for r in range(item.number_of_record_sets):
+        record_set = item.get_record_set(r)
+        for e in range(record_set.number_of_entries):
+            entry = record_set.get_entry(e)
+            if entry.entry_type == entry_type:
+                try:
+                    return entry.get_data_as_string() or ""
+                except Exception:
+                    return ""
+    return ""
+
+
+def _decode_body(data):
+    if not data:
+        return ""
+    if isinstance(data, str):
+        return data
+    return data.decode("utf-8", errors="replace")
+
+
+class PffSource(MailSource):
+    # Offline PST/OST reader on top of libpff (pypff), no Outlook or MAPI session needed
+    def __init__(self, path):
+        super().__init__(path)
+        self._file = None
+
+    def root_folder(self):
+        import pypff
+
+        self._file = pypff.file()
+        self._file.open(self.path)
+        return self._folder(self._file.get_root_folder(), os.path.basename(self.path))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _folder(self, pff_folder, default_name=""):
+        name = folder_display_name(pff_folder.name or default_name)
+        items = ItemCollection(pff_folder.number_of_sub_messages,
+                               lambda i: self._message(pff_folder.get_sub_message(i)))
+        folders = ItemCollection(pff_folder.number_of_sub_folders,
+                                 lambda i: self._folder(pff_folder.get_sub_folder(i)))
+        return MailFolder(name, items, folders)
+
+    def _message(self, pff_message):
+        message_class = _pff_entry(pff_message, PR_MESSAGE_CLASS)
+        sender_email = (_pff_entry(pff_message, PR_SENDER_SMTP_ADDRESS)
+                        or _pff_entry(pff_message, PR_SENDER_EMAIL_ADDRESS))
+        attachments = []
+        for i in range(pff_message.number_of_attachments):
+            pff_attachment = pff_message.get_attachment(i)
+            filename = (_pff_entry(pff_attachment, PR_ATTACH_LONG_FILENAME)
+                        or _pff_entry(pff_attachment, PR_ATTACH_FILENAME)
+                        or _pff_entry(pff_attachment, PR_DISPLAY_NAME)
+                        or f"attachment_{i + 1}")
+            attachments.append(MailAttachment(filename, self._attachment_loader(pff_attachment)))
+
+        message = MailMessage(
+            entry_id=str(pff_message.identifier),
+            subject=pff_message.subject or "",
+            sender_name=pff_message.sender_name or "",
+            sender_email=sender_email,
+            body=_decode_body(pff_message.plain_text_body),
+            received=pff_message.delivery_time or pff_message.client_submit_time,
+            sent=pff_message.client_submit_time,
+            to=_pff_entry(pff_message, PR_DISPLAY_TO),
+            cc=_pff_entry(pff_message, PR_DISPLAY_CC),
+            message_id=_pff_entry(pff_message, PR_INTERNET_MESSAGE_ID),
+            attachments=attachments,
+        )
+        # appointments, contacts, tasks, ... are skipped by read_folder just like with Outlook
+        if message_class and not message_class.upper().startswith("IPM.NOTE"):
+            message.Class = 0
+        return message
+
+    @staticmethod
+    def _attachment_loader(pff_attachment):
+        def load():
+            size = pff_attachment.get_size()
+            return pff_attachment.read_buffer(size) if size else b""
+        return load
+
+
+def _join_addresses(values):
+    return "; ".join(addr or name for name, addr in getaddresses(values) if addr or name)
+
+
+def message_from_email(msg, entry_id):
+    sender_name, sender_email = parseaddr(str(msg.get("from", "")))
+    # the Date header is set by the sender, so it is the send time as well
+    sent = None
+    try:
+        if msg.get("date"):
+            sent = parsedate_to_datetime(str(msg["date"]))
+    except (TypeError, ValueError):
+        pass
+
+    body = ""
+    try:
+        body_part = msg.get_body(preferencelist=("plain", "html"))
+        if body_part is not None:
+            body = body_part.get_content()
+    except Exception:
+        pass
+
+    attachments = []
+    for i, part in enumerate(msg.iter_attachments()):
+        filename = part.get_filename() or f"attachment_{i + 1}"
+        attachments.append(MailAttachment(filename, lambda part=part: part.get_payload(decode=True) or b""))
+
+    return MailMessage(
+        entry_id=entry_id,
+        subject=str(msg.get("subject", "") or ""),
+        sender_name=sender_name or sender_email,
+        sender_email=sender_email,
+        body=body,
+        received=sent,
+        to=_join_addresses(msg.get_all("to", [])),
+        cc=_join_addresses(msg.get_all("cc", [])),
+        message_id=str(msg.get("message-id", "") or "").strip(),
+        attachments=attachments,
+        sent=sent,
+    )
+
+
+class MboxSource(MailSource):
+    # A single mbox file is exposed as one folder named after the file
+    def __init__(self, path):
+        super().__init__(path)
+        self._mbox = None
+
+    def root_folder(self):
+        self._mbox = mailbox.mbox(self.path, factory=None, create=False)
+        keys = self._mbox.keys()
+
+        def load(i):
+            msg = email.message_from_bytes(self._mbox.get_bytes(keys[i]), policy=policy.default)
+            return message_from_email(msg, f"{os.path.basename(self.path)}:{keys[i]}")
+
+        stem = os.path.splitext(os.path.basename(self.path))[0]
+        folder = MailFolder(folder_display_name(stem), ItemCollection(len(keys), load))
+        return MailFolder(os.path.basename(self.path), folders=ItemCollection(1, lambda i: folder))
+
+    def close(self):
+        if self._mbox is not None:
+            self._mbox.close()
+            self._mbox = None
+
+
+class EmlSource(MailSource):
+    # A directory tree of .eml files, every sub directory is a folder
+    def root_folder(self):
+        return self._folder(self.path)
+
+    def _folder(self, path):
+        entries = sorted(os.listdir(path))
+        eml_files = [e for e in entries if e.lower().endswith(".eml") and os.path.isfile(os.path.join(path, e))]
+        sub_dirs = [e for e in entries if os.path.isdir(os.path.join(path, e))]
+
+        def load_message(i):
+            file_path = os.path.join(path, eml_files[i])
+            with open(file_path, "rb") as f:
+                msg = email.message_from_binary_file(f, policy=policy.default)
+            return message_from_email(msg, os.path.relpath(file_path, self.path))
+
+        return MailFolder(
+            folder_display_name(os.path.basename(path)),
+            ItemCollection(len(eml_files), load_message),
+            ItemCollection(len(sub_dirs), lambda i: self._folder(os.path.join(path, sub_dirs[i]))),
+        )
+
+
+SOURCE_CLASSES = {
+    "outlook": OutlookSource,
+    "pff": PffSource,
+    "mbox": MboxSource,
+    "eml": EmlSource,
+}
+
+
+def open_mail_source(path, backend="outlook"):
+    if backend not in SOURCE_CLASSES:
+        raise ValueError(f"Unknown mail source backend: {backend}")
+    return SOURCE_CLASSES[backend](path)
+
+
+def source_size(path):
+    # Bytes on disk of a store: the file, or every file under an EML directory
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def find_mail_sources(base_dir, backend="outlook"):
+    # Stores are returned with their parent directory named after the mailbox owner
+    sources = []
+    if backend == "eml":
+        for root, dirs, files in os.walk(base_dir):
+            if any(f.lower().endswith(".eml") for f in files):
+                store = os.path.dirname(root)
+                if store not in sources and os.path.normpath(store) != os.path.normpath(base_dir):
+                    sources.append(store)
+                dirs[:] = []
+        return [s for s in sources if not any(s != o and s.startswith(o + os.sep) for o in sources)]
+
+    extensions = {"outlook": (".pst",), "pff": (".pst", ".ost"), "mbox": (".mbox",)}[backend]
+    for root, dirs, files in os.walk(base_dir):
+        for file in files:
+            if file.lower().endswith(extensions):
+                sources.append(os.path.join(root, file))
+    return sources
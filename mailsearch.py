@@ -0,0 +1,194 @@
+import os
+import sys
+import argparse
+
+from dotenv import load_dotenv
+
+from mail_sources import BACKENDS
+from attachment_chunks import ATTACHMENT_TEXT_MODE, ATTACHMENT_TEXT_MODES
+from metrics import METRICS_PORT, PROGRESS_INTERVAL
+from dedup import DEDUP_MODE, DEDUP_MODES
+from spool import SPOOL_DIR
+from work_queue import WORK_QUEUE_BACKEND, WORK_QUEUE_BACKENDS, WORK_QUEUE_PATH
+
+# Command line entry point: python mailsearch.py <command> [options]
+# Every command imports its module on use, so `--help` or one command never pays for the others.
+
+load_dotenv()
+
+
+def resolve_attachment_text(opts):
+    # dedup updates documents in place, which would drop attachment text kept inline (see dedup)
+    if opts.attachment_text is None:
+        opts.attachment_text = "chunks" if opts.dedup != "off" else ATTACHMENT_TEXT_MODE
+    elif opts.dedup != "off" and opts.attachment_text != "chunks":
+        print("--dedup needs --attachment-text chunks", file=sys.stderr)
+        return False
+    return True
+
+
+def cmd_ingest(opts):
+    if not resolve_attachment_text(opts):
+        return 2
+    import ingest
+    return 0 if ingest.run_ingest(opts) else 1
+
+
+def cmd_reindex_from_spool(opts):
+    if not os.path.isdir(opts.spool_dir):
+        print(f"No spool directory {opts.spool_dir}", file=sys.stderr)
+        return 2
+    if not resolve_attachment_text(opts):
+        return 2
+    import ingest
+    return 0 if ingest.run_reindex(opts) else 1
+
+
+def cmd_queue(opts):
+    import json
+    import ingest
+    from work_queue import format_status
+    ingest.configure(opts)
+    queue = ingest.get_work_queue()
+    if opts.action == "add":
+        added, found = ingest.queue_sources(opts.source, opts.backend)
+        print(f"Queued {added} new of {found} stores still to ingest under {opts.source}")
+    elif opts.action == "requeue":
+        count = queue.requeue(states=opts.state or ("failed",))
+        print(f"Requeued {count} jobs")
+    elif opts.action == "finish":
+        return 0 if ingest.finish_queue(opts) else 1
+    else:
+        status = queue.status()
+        print(json.dumps(status, indent=2) if opts.json else format_status(status))
+    return 0
+
+
+def add_load_options(p):
+    # how documents are written, shared by ingest and reindex-from-spool
+    p.add_argument("--attachment-text", choices=ATTACHMENT_TEXT_MODES,
+                   help="keep attachment text in the email document or index it as chunk documents "
+                        f"(default: chunks with --dedup, otherwise {ATTACHMENT_TEXT_MODE})")
+    p.add_argument("--no-bulk-load", dest="bulk_load", action="store_false",
+                   help="keep refresh and replicas on while loading")
+    p.add_argument("--no-forcemerge", dest="forcemerge", action="store_false",
+                   help="skip the force merge after a bulk load")
+    p.add_argument("--dedup", choices=DEDUP_MODES, default=DEDUP_MODE,
+                   help="index each message once for all mailboxes holding it (message), and also link "
+                        "near duplicate bodies (near)")
+
+
+def add_monitor_options(p):
+    p.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                   help="serve Prometheus metrics on /metrics and JSON progress on /progress (0: off)")
+    p.add_argument("--progress-interval", type=float, default=PROGRESS_INTERVAL,
+                   help="seconds between JSON progress lines (0: off)")
+
+
+def add_queue_options(p):
+    p.add_argument("--queue-backend", choices=WORK_QUEUE_BACKENDS, default=WORK_QUEUE_BACKEND,
+                   help="sqlite: a file on storage all nodes share, elasticsearch: an index on the cluster")
+    p.add_argument("--queue-path", default=WORK_QUEUE_PATH, help="queue database for the sqlite backend")
+
+
+def cmd_index_setup(opts):
+    from ingest import get_es
+    from index_template import install_template, ensure_alias, migrate_legacy_index
+    es = get_es()
+    install_template(es)
+    if opts.migrate_legacy and not migrate_legacy_index(es):
+        return 1
+    return 0 if ensure_alias(es) else 1
+
+
+def cmd_serve(opts):
+    import attachment_server
+    attachment_server.run(opts.server, opts.host, opts.port, opts.workers, opts.threads, opts.worker_class)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="mailsearch", description="Mailbox archive search tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("ingest", help="index mailboxes into Elasticsearch")
+    p.add_argument("--source", default=os.getenv("INGEST_SOURCE", r"D:\test2"),
+                   help="directory searched for PST/OST/mbox/EML stores")
+    p.add_argument("--backend", choices=BACKENDS, default=os.getenv("MAIL_BACKEND", "outlook"),
+                   help="outlook (COM, Windows only), pff (offline PST/OST), mbox or eml")
+    p.add_argument("--store", choices=("local", "minio"), default=os.getenv("ATTACHMENT_STORE", "local"),
+                   help="where attachments are kept")
+    p.add_argument("--attachments-path", default=os.getenv("ATTACHMENT_STORE_PATH", r"D:\attachments"),
+                   help="attachment directory for --store local")
+    p.add_argument("--workers", type=int, default=int(os.getenv("MAX_WORKERS", str(os.cpu_count() or 4))),
+                   help="most stores (or parts of large stores) read in parallel")
+    p.add_argument("--min-workers", type=int, default=int(os.getenv("MIN_WORKERS", "1")),
+                   help="fewest stores read in parallel while the CPUs or Elasticsearch are overloaded "
+                        "(equal to --workers: a fixed number)")
+    add_load_options(p)
+    p.add_argument("--spool", default=SPOOL_DIR or None,
+                   help="also write every document, attachment text included, to compressed segments in "
+                        "this directory, for reindex-from-spool")
+    p.add_argument("--queue", action="store_true",
+                   help="take the stores from the shared work queue instead of searching --source")
+    p.add_argument("--queue-wait", action="store_true",
+                   help="with --queue, keep polling while other nodes hold jobs that may be requeued")
+    add_queue_options(p)
+    add_monitor_options(p)
+    p.set_defaults(handler=cmd_ingest)
+
+    p = commands.add_parser("reindex-from-spool", help="index the documents spooled by `ingest --spool` again, "
+                                                       "without reading the stores")
+    p.add_argument("--spool", dest="spool_dir", default=SPOOL_DIR or None, required=not SPOOL_DIR,
+                   help="spool directory")
+    p.add_argument("--enrich", action="store_true",
+                   help="replace the AD fields of every document from the current directory snapshot")
+    p.add_argument("--workers", type=int, default=int(os.getenv("MAX_WORKERS", str(os.cpu_count() or 4))),
+                   help="spool segments read in parallel (1: strictly oldest first)")
+    add_load_options(p)
+    add_monitor_options(p)
+    # get_indexer() reads these ingest options
+    p.set_defaults(handler=cmd_reindex_from_spool, backend=None, store="local", spool=None, queue=False)
+
+    p = commands.add_parser("queue", help="fill or inspect the work queue shared by ingest nodes")
+    p.add_argument("action", choices=("add", "status", "requeue", "finish"),
+                   help="add the stores under --source, show jobs and progress, requeue failed jobs, or "
+                        "finish the bulk load once no job is pending or leased")
+    p.add_argument("--source", default=os.getenv("INGEST_SOURCE", r"D:\test2"),
+                   help="directory searched for stores (add); job keys are relative to it")
+    p.add_argument("--backend", choices=BACKENDS, default=os.getenv("MAIL_BACKEND", "outlook"),
+                   help="kind of stores to add")
+    p.add_argument("--state", action="append", choices=("failed", "leased", "done"),
+                   help="states requeued (default failed; expired leases always are), repeatable")
+    p.add_argument("--json", action="store_true", help="status as JSON")
+    p.add_argument("--no-forcemerge", dest="forcemerge", action="store_false",
+                   help="skip the force merge when finishing the bulk load")
+    add_queue_options(p)
+    p.set_defaults(handler=cmd_queue)
+
+    p = commands.add_parser("index-setup", help="install the index template and the email_exchange alias")
+    p.add_argument("--migrate-legacy", action="store_true",
+                   help="move a pre-template email_exchange index into the per-year indices")
+    p.set_defaults(handler=cmd_index_setup)
+
+    # defaults of the serve options come from the ATTACHMENT_* variables read by attachment_server
+    p = commands.add_parser("serve", help="serve stored attachments over HTTP")
+    p.add_argument("--server", choices=("dev", "gunicorn", "waitress"),
+                   help="gunicorn (pre-fork, Linux) or waitress (Windows); dev is Flask's built in server")
+    p.add_argument("--host")
+    p.add_argument("--port", type=int)
+    p.add_argument("--workers", type=int, help="gunicorn worker processes")
+    p.add_argument("--threads", type=int, help="request threads per worker")
+    p.add_argument("--worker-class", choices=("gthread", "gevent"), help="gunicorn worker class")
+    p.set_defaults(handler=cmd_serve)
+
+    return parser
+
+
+def main(argv=None):
+    opts = build_parser().parse_args(argv)
+    return opts.handler(opts)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,397 @@
+import os
+import json
+import time
+import queue
+import bisect
+import logging
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Ingest metrics: counters and latency histograms kept per process, without dependencies.
+# Worker processes push a snapshot of their registry to the parent every
+# METRICS_PUSH_INTERVAL seconds (and when a store is finished); the parent merges them with
+# its own and serves the result on http://METRICS_HOST:METRICS_PORT/metrics in the
+# Prometheus text format and as JSON on /progress. Every PROGRESS_INTERVAL seconds the parent
+# also prints one JSON progress line: messages per second, the mean latency of each stage
+# over the interval, and every store being read with its progress and ETA.
+
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+# 0 disables the endpoint
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+METRICS_PUSH_INTERVAL = float(os.getenv("METRICS_PUSH_INTERVAL", "2"))
+# 0 disables the progress lines
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "30"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(11))
+
+# name -> (type, help, buckets)
+METRICS = {
+    "ingest_messages_total": ("counter", "Mail items taken from the stores, by folder and result", None),
+    "ingest_message_read_seconds": ("histogram", "Fetching a message from the store and reading its fields",
+                                    LATENCY_BUCKETS),
+    "ingest_dedup_total": ("counter", "Messages read with --dedup: claimed (indexed in full), copy of a claimed "
+                                      "message, or near duplicate of an earlier one", None),
+    "ingest_attachments_total": ("counter", "Attachments saved, by store", None),
+    "ingest_attachment_bytes_total": ("counter", "Attachment bytes saved, by store", None),
+    "ingest_attachment_save_seconds": ("histogram", "Saving (or queueing the upload of) the attachments of one message",
+                                       LATENCY_BUCKETS),
+    "ingest_upload_seconds": ("histogram", "MinIO upload of one attachment, including retries", LATENCY_BUCKETS),
+    "ingest_upload_attempts_total": ("counter", "MinIO upload attempts, by result", None),
+    "ingest_extract_total": ("counter", "Attachment text extractions, by type and result", None),
+    "ingest_extract_seconds": ("histogram", "Text extraction of one attachment, by type", LATENCY_BUCKETS),
+    "ingest_extract_bytes_total": ("counter", "Attachment bytes given to text extraction, by type", None),
+    "ingest_bulk_requests_total": ("counter", "Bulk requests sent to Elasticsearch, by result", None),
+    "ingest_bulk_request_seconds": ("histogram", "Bulk request latency", LATENCY_BUCKETS),
+    "ingest_bulk_request_bytes": ("histogram", "Bulk request payload size", SIZE_BUCKETS),
+    "ingest_bulk_documents_total": ("counter", "Documents acknowledged or given up, by result", None),
+    "ingest_bulk_item_failures_total": ("counter", "Bulk items Elasticsearch did not accept, by status and reason",
+                                        None),
+    "ingest_sources_total": ("counter", "Stores (or parts of split stores) finished, by result", None),
+}
+
+# progress line stage -> histogram
+STAGES = {
+    "read": "ingest_message_read_seconds",
+    "save": "ingest_attachment_save_seconds",
+    "upload": "ingest_upload_seconds",
+    "extract": "ingest_extract_seconds",
+    "bulk": "ingest_bulk_request_seconds",
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            # (name, labels) -> [count per bucket..., +Inf count, sum]
+            self._histograms = {}
+            self._sources = {}
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        key = _key(name, labels)
+        index = bisect.bisect_left(buckets, value)
+        with self._lock:
+            values = self._histograms.get(key)
+            if values is None:
+                values = self._histograms[key] = [0] * (len(buckets) + 2)
+            values[index] += 1
+            values[-1] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def source_started(self, source, expected):
+        # expected: messages still to read in the store, None when unknown
+        with self._lock:
+            self._sources[source] = {"expected": expected, "done": 0, "started": time.time(), "finished": None}
+
+    def source_progress(self, source, count=1):
+        with self._lock:
+            state = self._sources.get(source)
+            if state is not None:
+                state["done"] += count
+
+    def source_finished(self, source, ok):
+        self.inc("ingest_sources_total", result="done" if ok else "incomplete")
+        with self._lock:
+            state = self._sources.get(source)
+            if state is not None:
+                state["finished"] = time.time()
+
+    def source(self, source):
+        # progress state of one store, None when it is not being read in this process
+        with self._lock:
+            state = self._sources.get(source)
+            return dict(state) if state is not None else None
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "histograms": {key: list(values) for key, values in self._histograms.items()},
+                "sources": {source: dict(state) for source, state in self._sources.items()},
+            }
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+
+
+def merge(snapshots):
+    merged = {"counters": {}, "histograms": {}, "sources": {}}
+    for snapshot in snapshots:
+        for key, value in snapshot["counters"].items():
+            merged["counters"][key] = merged["counters"].get(key, 0) + value
+        for key, values in snapshot["histograms"].items():
+            current = merged["histograms"].get(key)
+            merged["histograms"][key] = [a + b for a, b in zip(current, values)] if current else list(values)
+        merged["sources"].update(snapshot["sources"])
+    return merged
+
+
+def counter_total(snapshot, name, **labels):
+    wanted = {(k, str(v)) for k, v in labels.items()}
+    return sum(value for (n, key), value in snapshot["counters"].items() if n == name and wanted <= set(key))
+
+
+def histogram_total(snapshot, name):
+    # (count, sum) over all label sets
+    count = total = 0
+    for (n, _), values in snapshot["histograms"].items():
+        if n == name:
+            count += sum(values[:-1])
+            total += values[-1]
+    return count, total
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def source_eta(state, now):
+    # Seconds left for a store at its rate so far, None when it cannot be told yet
+    elapsed = (state["finished"] or now) - state["started"]
+    if state["expected"] is None or not state["done"] or elapsed <= 0:
+        return None
+    return max(0.0, (state["expected"] - state["done"]) / (state["done"] / elapsed))
+
+
+def render_prometheus(snapshot):
+    now = time.time()
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            for (n, labels), value in sorted(snapshot["counters"].items()):
+                if n == name:
+                    lines.append(f"{name}{_labels(labels)} {value}")
+            continue
+        for (n, labels), values in sorted(snapshot["histograms"].items()):
+            if n != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, values):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', repr(float(bound))),))} {cumulative}")
+            cumulative += values[len(buckets)]
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {values[-1]}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+
+    # stores being read right now
+    active = {source: state for source, state in snapshot["sources"].items() if state["finished"] is None}
+    for name, help_text, value in (
+        ("ingest_source_messages_done", "Messages read so far from a store being ingested", lambda s: s["done"]),
+        ("ingest_source_messages_expected", "Messages to read from a store being ingested", lambda s: s["expected"]),
+        ("ingest_source_eta_seconds", "Estimated time left for a store being ingested", lambda s: source_eta(s, now)),
+    ):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for source, state in sorted(active.items()):
+            if value(state) is not None:
+                lines.append(f"{name}{_labels((('source', source),))} {value(state)}")
+    return "\n".join(lines) + "\n"
+
+
+def progress(snapshot, previous=None, interval=None):
+    # One progress record; stage latencies and the rate cover the time since previous
+    now = time.time()
+    messages = counter_total(snapshot, "ingest_messages_total", result="read")
+    record = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "messages": messages,
+        "indexed": counter_total(snapshot, "ingest_bulk_documents_total", result="indexed"),
+        "failed": counter_total(snapshot, "ingest_bulk_documents_total", result="failed"),
+        "sources_done": sum(1 for s in snapshot["sources"].values() if s["finished"] is not None),
+    }
+    if previous is not None and interval:
+        record["messages_per_s"] = round((messages - counter_total(previous, "ingest_messages_total",
+                                                                  result="read")) / interval, 1)
+    stages = {}
+    for stage, name in STAGES.items():
+        count, total = histogram_total(snapshot, name)
+        if previous is not None:
+            previous_count, previous_total = histogram_total(previous, name)
+            count, total = count - previous_count, total - previous_total
+        if count:
+            stages[stage] = {"count": count, "mean_ms": round(total / count * 1000, 1)}
+    record["stages"] = stages
+
+    active = []
+    for source, state in snapshot["sources"].items():
+        if state["finished"] is not None:
+            continue
+        eta = source_eta(state, now)
+        elapsed = now - state["started"]
+        active.append({
+            "source": source,
+            "done": state["done"],
+            "expected": state["expected"],
+            "messages_per_s": round(state["done"] / elapsed, 1) if elapsed > 0 else None,
+            "eta_s": round(eta) if eta is not None else None,
+        })
+    # the store that will take longest first
+    active.sort(key=lambda s: -1 if s["eta_s"] is None else s["eta_s"], reverse=True)
+    record["active"] = active
+    return record
+
+
+class _Handler(BaseHTTPRequestHandler):
+    monitor = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/metrics":
+            body = render_prometheus(self.monitor.snapshot()).encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif path == "/progress":
+            body = json.dumps(progress(self.monitor.snapshot())).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Monitor:
+    # Parent side: merges the worker snapshots arriving on updates (a multiprocessing queue,
+    # None when all work runs in this process), serves them and prints the progress lines
+    def __init__(self, updates=None, port=METRICS_PORT, host=METRICS_HOST, interval=PROGRESS_INTERVAL):
+        self.updates = updates
+        self.interval = interval
+        self._remote = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._server = None
+        if port:
+            try:
+                handler = type("MetricsHandler", (_Handler,), {"monitor": self})
+                self._server = ThreadingHTTPServer((host, port), handler)
+                self._server.daemon_threads = True
+            except OSError as e:
+                logging.warning(f"Metrics endpoint not started on {host}:{port}: {e}")
+
+    def snapshot(self):
+        with self._lock:
+            remote = list(self._remote.values())
+        return merge([registry.snapshot()] + remote)
+
+    def start(self):
+        if self._server is not None:
+            self._spawn(self._server.serve_forever, "metrics-http")
+            print(f"Metrics on http://{self._server.server_address[0]}:{self._server.server_address[1]}/metrics")
+        if self.updates is not None:
+            self._spawn(self._receive, "metrics-receiver")
+        if self.interval:
+            self._spawn(self._report, "progress-reporter")
+        return self
+
+    def _spawn(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _receive(self):
+        while not self._stop.is_set():
+            try:
+                pid, snapshot = self.updates.get(timeout=1)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                return
+            with self._lock:
+                self._remote[pid] = snapshot
+
+    def _drain(self):
+        while True:
+            try:
+                pid, snapshot = self.updates.get_nowait()
+            except (queue.Empty, EOFError, OSError):
+                return
+            with self._lock:
+                self._remote[pid] = snapshot
+
+    def _report(self):
+        previous = None
+        while not self._stop.wait(self.interval):
+            snapshot = self.snapshot()
+            print(json.dumps(progress(snapshot, previous, self.interval), ensure_ascii=False), flush=True)
+            previous = snapshot
+
+    def stop(self):
+        self._stop.set()
+        if self.updates is not None:
+            self._drain()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        return self.snapshot()
+
+
+_pusher = {}
+
+
+def start_push(updates, interval=METRICS_PUSH_INTERVAL):
+    # Worker side: sends this process's snapshot to the parent every interval seconds
+    if _pusher.get("pid") == os.getpid():
+        return
+    # a forked worker starts from a copy of the parent's registry, which the parent counts itself
+    registry.reset()
+    _pusher.clear()
+    _pusher.update(pid=os.getpid(), updates=updates)
+
+    def run():
+        while True:
+            time.sleep(interval)
+            push()
+
+    threading.Thread(target=run, name="metrics-push", daemon=True).start()
+
+
+def push():
+    updates = _pusher.get("updates") if _pusher.get("pid") == os.getpid() else None
+    if updates is None:
+        return
+    try:
+        updates.put((os.getpid(), registry.snapshot()))
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not send metrics to the parent process: {e}")
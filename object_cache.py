@@ -0,0 +1,130 @@
+import os
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+
+# Size bounded LRU of immutable objects on local disk, used by attachment_server to keep
+# hot MinIO objects close. Object names are content addressed, so a cached copy never goes
+# stale and entries are only ever added or evicted. The LRU order lives in memory and is
+# rebuilt from file mtimes on start; with several server processes each one evicts what it
+# considers cold, and a file evicted under another process is simply fetched again.
+
+OBJECT_CACHE_PATH = os.getenv("OBJECT_CACHE_PATH", "object_cache")
+OBJECT_CACHE_MAX_BYTES = int(os.getenv("OBJECT_CACHE_MAX_BYTES", str(10 * 1024 ** 3)))
+# Larger objects are streamed from MinIO instead of being cached
+OBJECT_CACHE_MAX_OBJECT = int(os.getenv("OBJECT_CACHE_MAX_OBJECT", str(512 * 1024 ** 2)))
+
+
+class DiskCache:
+    def __init__(self, path=OBJECT_CACHE_PATH, max_bytes=OBJECT_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.tmp_path = os.path.join(path, "tmp")
+        os.makedirs(self.tmp_path, exist_ok=True)
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._fetching = {}
+        self._load()
+
+    def _file(self, key):
+        return os.path.join(self.path, *key.split("/"))
+
+    def _load(self):
+        files = []
+        for root, dirs, names in os.walk(self.path):
+            if root == self.path and "tmp" in dirs:
+                dirs.remove("tmp")
+            for name in names:
+                file_path = os.path.join(root, name)
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                key = os.path.relpath(file_path, self.path).replace(os.sep, "/")
+                files.append((stat.st_mtime, key, stat.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._size += size
+        self._evict()
+
+    def lookup(self, key):
+        # Local path of a cached object, or None
+        file_path = self._file(key)
+        with self._lock:
+            known = key in self._entries
+            if known:
+                self._entries.move_to_end(key)
+        if known and os.path.exists(file_path):
+            return file_path
+        try:
+            # written (or evicted) by another server process
+            size = os.path.getsize(file_path)
+        except OSError:
+            if known:
+                self._forget(key)
+            return None
+        self._add(key, size)
+        return file_path
+
+    def fetch(self, key, download):
+        # download(tmp_path) writes the object; concurrent misses of one key download it once
+        with self._lock:
+            key_lock = self._fetching.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                file_path = self.lookup(key)
+                if file_path:
+                    return file_path
+                file_path = self._file(key)
+                tmp_path = os.path.join(self.tmp_path, uuid.uuid4().hex)
+                try:
+                    download(tmp_path)
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                    os.replace(tmp_path, file_path)
+                except Exception:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+                self._add(key, os.path.getsize(file_path))
+                return file_path
+        finally:
+            with self._lock:
+                self._fetching.pop(key, None)
+
+    def _add(self, key, size):
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries[key]
+            self._entries[key] = size
+            self._entries.move_to_end(key)
+            self._size += size
+        self._evict(keep=key)
+
+    def _forget(self, key):
+        with self._lock:
+            size = self._entries.pop(key, None)
+            if size is not None:
+                self._size -= size
+
+    def _evict(self, keep=None):
+        victims = []
+        with self._lock:
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                key, size = self._entries.popitem(last=False)
+                if key == keep:
+                    self._entries[key] = size
+                    continue
+                self._size -= size
+                victims.append(key)
+        for key in victims:
+            try:
+                os.remove(self._file(key))
+            except OSError as e:
+                # still open on Windows; it is counted again on the next start
+                logging.warning(f"Could not evict cached object {key}: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"objects": len(self._entries), "bytes": self._size, "max_bytes": self.max_bytes}
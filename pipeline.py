@@ -0,0 +1,127 @@
+import os
+import queue
+import logging
+import threading
+
+# Staged message pipeline used by read_folder.
+# The store is read on the calling thread (Outlook COM and libpff objects stay on the thread
+# that opened them), which puts one detached message at a time into the pipeline; every
+# further stage runs on its own threads and hands its result to the next stage through a
+# queue of PIPELINE_QUEUE_SIZE items. A full queue blocks the stage in front of it, down to the
+# reader, and the indexer's bounded queue blocks the last stage the same way.
+#
+# Besides the item count, the messages between the reader and the end of the pipeline are
+# limited to PIPELINE_MAX_BYTES of bodies and attachment content, so a run of large
+# attachments cannot pile up in memory. A single message above the limit still passes, alone.
+
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "64"))
+PIPELINE_MAX_BYTES = int(os.getenv("PIPELINE_MAX_BYTES", str(256 * 1024 * 1024)))
+PIPELINE_SAVE_WORKERS = int(os.getenv("PIPELINE_SAVE_WORKERS", "2"))
+PIPELINE_ENRICH_WORKERS = int(os.getenv("PIPELINE_ENRICH_WORKERS", "2"))
+
+_STOP = object()
+
+
+class Stage:
+    # function(item) returns the item for the next stage, or None to drop it
+    __slots__ = ("name", "function", "workers")
+
+    def __init__(self, name, function, workers=1):
+        self.name = name
+        self.function = function
+        self.workers = max(1, workers)
+
+
+class _Budget:
+    # Bytes held by the items in the pipeline
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size):
+        with self._cond:
+            while self.used and self.used + size > self.limit:
+                self._cond.wait()
+            self.used += size
+
+    def release(self, size):
+        with self._cond:
+            self.used -= size
+            self._cond.notify_all()
+
+
+class Pipeline:
+    # on_error(item, stage, error) is called for an item a stage raised on; the item is dropped
+    def __init__(self, stages, on_error=None, queue_size=PIPELINE_QUEUE_SIZE, max_bytes=PIPELINE_MAX_BYTES):
+        self.stages = stages
+        self.on_error = on_error
+        self.count = 0
+        self._budget = _Budget(max_bytes)
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        # workers of each stage still running; the last one to stop stops the next stage
+        self._running = [stage.workers for stage in stages]
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for index, stage in enumerate(self.stages):
+            for i in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(index,), name=f"pipeline-{stage.name}-{i}",
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def put(self, item, size=0):
+        # Blocks while the first queue is full or the pipeline holds PIPELINE_MAX_BYTES
+        self._budget.acquire(size)
+        self._queues[0].put((item, size))
+
+    def close(self):
+        # Waits until every item has left the pipeline
+        for _ in range(self.stages[0].workers):
+            self._queues[0].put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _work(self, index):
+        stage = self.stages[index]
+        last = index == len(self.stages) - 1
+        source = self._queues[index]
+        while True:
+            entry = source.get()
+            if entry is _STOP:
+                break
+            item, size = entry
+            try:
+                result = stage.function(item)
+            except Exception as e:
+                result = None
+                if self.on_error is not None:
+                    try:
+                        self.on_error(item, stage.name, e)
+                    except Exception as handler_error:
+                        logging.error(f"Pipeline error handler failed: {handler_error}")
+                else:
+                    logging.error(f"Pipeline stage {stage.name} failed: {e}")
+            if result is None or last:
+                if result is not None:
+                    with self._lock:
+                        self.count += 1
+                self._budget.release(size)
+            else:
+                self._queues[index + 1].put((result, size))
+
+        with self._lock:
+            self._running[index] -= 1
+            stopped = self._running[index] == 0
+        if stopped and not last:
+            for _ in range(self.stages[index + 1].workers):
+                self._queues[index + 1].put(_STOP)
@@ -0,0 +1,142 @@
+import os
+import time
+import logging
+
+import metrics
+
+# Order and size of the units of work handed to the ingest workers.
+# Stores run largest first, so a big mailbox found last does not keep one worker busy long
+# after the others ran out of work. A store of SPLIT_STORE_BYTES or more is split into up to
+# --workers parts: its target folders, and folders above SPLIT_RANGE_ITEMS items in ranges of
+# that many items, are packed into parts of about the same number of items, and every part
+# opens the store in its own worker. A range is checkpointed as a folder of its own (see
+# ingest.folder_key); the store is marked done once every part finished all of its ranges.
+#
+# The worker pool is started with --workers processes, but WorkerGate only lets as many parts
+# run as the machine and the cluster keep up with: it starts one less when the CPUs are busy or
+# Elasticsearch rejects or slows down bulk requests, and one more once both have room again.
+
+SPLIT_STORE_BYTES = int(os.getenv("SPLIT_STORE_BYTES", str(2 * 1024 ** 3)))
+SPLIT_RANGE_ITEMS = int(os.getenv("SPLIT_RANGE_ITEMS", "20000"))
+WORKER_ADJUST_INTERVAL = float(os.getenv("WORKER_ADJUST_INTERVAL", "15"))
+# share of the CPUs in use above which no further worker is started
+WORKER_MAX_CPU = float(os.getenv("WORKER_MAX_CPU", "0.9"))
+# mean bulk request latency over an interval that counts as cluster pressure
+WORKER_MAX_BULK_LATENCY = float(os.getenv("WORKER_MAX_BULK_LATENCY", os.getenv("BULK_TARGET_LATENCY", "2.0")))
+
+
+class Task:
+    # One unit of work: a whole store (ranges None) or part `part` of `parts` of a split one.
+    # ranges: (folder indices from the root, folder path, start, stop) of the items to read,
+    # start None for the whole folder; size: bytes of the store, or its share of them
+    __slots__ = ("path", "size", "ranges", "part", "parts")
+
+    def __init__(self, path, size, ranges=None, part=1, parts=1):
+        self.path = path
+        self.size = size
+        self.ranges = ranges
+        self.part = part
+        self.parts = parts
+
+    @property
+    def name(self):
+        return self.path if self.ranges is None else f"{self.path} [{self.part}/{self.parts}]"
+
+    @property
+    def items(self):
+        return sum(stop - (start or 0) for _, _, start, stop in self.ranges or ())
+
+
+def folder_ranges(indices, folder_path, items, range_items=SPLIT_RANGE_ITEMS):
+    # a folder as one range, or as ranges of range_items items when it is larger
+    if items <= range_items:
+        return [(indices, folder_path, None, items)]
+    return [(indices, folder_path, start, min(start + range_items, items)) for start in range(0, items, range_items)]
+
+
+def split_store(path, size, ranges, parts):
+    # Packs the ranges, largest first, into the part with the fewest items so far
+    bins = [[] for _ in range(max(1, min(parts, len(ranges))))]
+    loads = [0] * len(bins)
+    for item in sorted(ranges, key=lambda r: r[3] - (r[2] or 0), reverse=True):
+        i = loads.index(min(loads))
+        bins[i].append(item)
+        loads[i] += item[3] - (item[2] or 0)
+    if len(bins) == 1:
+        return [Task(path, size)]
+    total = sum(loads) or 1
+    return [Task(path, size * load / total, part_ranges, i + 1, len(bins))
+            for i, (part_ranges, load) in enumerate(zip(bins, loads))]
+
+
+def largest_first(tasks):
+    return sorted(tasks, key=lambda task: task.size, reverse=True)
+
+
+class _CpuMeter:
+    # Share of the machine's CPUs in use: the 1 minute load average per CPU where there is one,
+    # otherwise (Windows) the busy share of the system times since the last reading
+    def __init__(self):
+        self._last = None
+
+    def read(self):
+        if hasattr(os, "getloadavg"):
+            return os.getloadavg()[0] / (os.cpu_count() or 1)
+        try:
+            import ctypes
+            idle, kernel, user = ctypes.c_ulonglong(), ctypes.c_ulonglong(), ctypes.c_ulonglong()
+            if not ctypes.windll.kernel32.GetSystemTimes(ctypes.byref(idle), ctypes.byref(kernel), ctypes.byref(user)):
+                return None
+        except (ImportError, AttributeError, OSError):
+            return None
+        # kernel time includes the idle time
+        current = (idle.value, kernel.value + user.value)
+        last, self._last = self._last, current
+        if last is None or current[1] <= last[1]:
+            return None
+        return 1 - (current[0] - last[0]) / (current[1] - last[1])
+
+
+class WorkerGate:
+    # How many tasks may run at once, between minimum and maximum; adjust() is called with the
+    # merged metrics snapshot and moves the limit by one at most every interval seconds
+    def __init__(self, minimum, maximum, interval=WORKER_ADJUST_INTERVAL):
+        self.minimum = max(1, min(minimum, maximum))
+        self.maximum = max(1, maximum)
+        self.limit = self.maximum
+        self.interval = interval
+        self._cpu = _CpuMeter()
+        self._cpu.read()
+        self._checked = time.monotonic()
+        self._previous = None
+
+    def adjust(self, snapshot):
+        now = time.monotonic()
+        if self.minimum == self.maximum or now - self._checked < self.interval:
+            return self.limit
+        self._checked = now
+        previous, self._previous = self._previous, snapshot
+        if previous is None:
+            return self.limit
+
+        rejected = (metrics.counter_total(snapshot, "ingest_bulk_requests_total", result="rejected")
+                    - metrics.counter_total(previous, "ingest_bulk_requests_total", result="rejected"))
+        count, total = metrics.histogram_total(snapshot, "ingest_bulk_request_seconds")
+        previous_count, previous_total = metrics.histogram_total(previous, "ingest_bulk_request_seconds")
+        latency = (total - previous_total) / (count - previous_count) if count > previous_count else 0.0
+        cpu = self._cpu.read()
+
+        if rejected or latency > WORKER_MAX_BULK_LATENCY or (cpu is not None and cpu > WORKER_MAX_CPU):
+            limit = max(self.minimum, self.limit - 1)
+        elif latency < WORKER_MAX_BULK_LATENCY / 2 and (cpu is None or cpu < WORKER_MAX_CPU * 0.75):
+            limit = min(self.maximum, self.limit + 1)
+        else:
+            limit = self.limit
+        if limit != self.limit:
+            cpu_text = f"{cpu:.0%}" if cpu is not None else "n/a"
+            print(f"Workers: {self.limit} -> {limit} (cpu {cpu_text}, bulk {latency:.2f}s, {rejected} rejected)")
+            logging.info(f"Worker limit {self.limit} -> {limit}: cpu {cpu_text}, bulk latency {latency:.2f}s, "
+                         f"{rejected} bulk requests rejected")
+            self.limit = limit
+        return self.limit
+
@@ -0,0 +1,408 @@
+import os
+import re
+import json
+import time
+import base64
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from urllib.parse import quote
+
+from flask import Blueprint, jsonify, request, url_for
+
+# Query side of the email_exchange index, served by attachment_server.
+# Deep pages use a point in time plus search_after instead of from/size, so they neither
+# stop at 10k hits nor shift while documents are being indexed. The cursor handed to the
+# client carries the PIT id, the sort values of the last hit and the normalized query, so
+# the next page is requested with the cursor alone. The emails matched through attachment
+# text chunks are looked up once, for the first page, and their ids travel in the cursor too,
+# so every page ranks the same set (a long cursor can be sent in a POST body). The PIT is closed
+# with the last page, and a first page that has a cursor is not served from the result cache, so
+# no two clients share a PIT. Results carry the small fields and highlighted snippets; body and
+# attachment text never leave Elasticsearch.
+
+ELASTIC_HOST = os.getenv("ELASTIC_HOST")
+ELASTIC_USER = os.getenv("ELASTIC_USER")
+ELASTIC_PASSWORD = os.getenv("ELASTIC_PASSWORD")
+# the alias, plus the year indices written while a legacy email_exchange index still blocks it
+SEARCH_INDEX = os.getenv("SEARCH_INDEX", "email_exchange,email_exchange-*")
+# attachment text indexed as chunk documents (attachment_chunks)
+SEARCH_CHUNK_INDEX = os.getenv("SEARCH_CHUNK_INDEX", "email_attachment_chunks")
+# most emails a search finds through attachment text alone; the first page of a search that
+# reached it says so with attachment_matches_truncated
+SEARCH_CHUNK_MATCHES = int(os.getenv("SEARCH_CHUNK_MATCHES", "500"))
+SEARCH_PIT_KEEP_ALIVE = os.getenv("SEARCH_PIT_KEEP_ALIVE", "2m")
+SEARCH_DEFAULT_SIZE = 20
+SEARCH_MAX_SIZE = int(os.getenv("SEARCH_MAX_SIZE", "100"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "30"))
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "2000"))
+SEARCH_FRAGMENT_SIZE = 150
+SEARCH_FRAGMENTS = 3
+
+SEARCH_FIELDS = ["subject^3", "sender^2", "email^2", "display_name.text", "to.text", "cc.text", "body",
+                 "attachments.filename.text^2", "attachments.text"]
+# request parameter -> keyword fields it filters on (see index_template); a document matches
+# when any of them does. owners/folders list every copy of a message ingested with --dedup.
+FILTER_FIELDS = {
+    "user": ("user", "owners"),
+    "department": ("department",),
+    "folder_name": ("folder_name", "folders"),
+}
+# filters chunk documents cannot apply: they only carry the mailbox that indexed the
+# attachments, the email query filters the emails they point to again
+CHUNK_UNFILTERED = ("user", "folder_name")
+RESULT_FIELDS = [
+    "subject", "sender", "email", "date", "user", "folder_name", "owners", "folders", "near_duplicate_of",
+    "display_name", "department", "to", "cc",
+    "attachments.filename", "attachments.size", "attachments.sha256", "attachments.object_name",
+    "attachments.filepath",
+]
+HIGHLIGHT_FIELDS = ["subject", "body", "attachments.text"]
+
+search_api = Blueprint("search_api", __name__)
+
+_es = {}
+_es_lock = threading.Lock()
+
+
+class SearchError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def get_es():
+    with _es_lock:
+        if _es.get("pid") != os.getpid():
+            from elasticsearch import Elasticsearch
+            _es.clear()
+            _es["pid"] = os.getpid()
+            _es["client"] = Elasticsearch(
+                hosts=[ELASTIC_HOST],
+                basic_auth=(ELASTIC_USER, ELASTIC_PASSWORD),
+                http_compress=True
+            )
+        return _es["client"]
+
+
+class TTLCache:
+    # Small LRU whose entries expire after ttl seconds
+    def __init__(self, max_size=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+result_cache = TTLCache()
+
+
+def encode_cursor(state):
+    data = json.dumps(state, separators=(",", ":"), sort_keys=True).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        state = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        if not isinstance(state, dict) or "pit" not in state or "after" not in state or "query" not in state:
+            raise ValueError("incomplete cursor")
+        if not (isinstance(state["pit"], str) and isinstance(state["after"], list)
+                and isinstance(state["query"], dict)):
+            raise ValueError("malformed cursor")
+        chunks = state.setdefault("chunks", [])
+        if not (isinstance(chunks, list) and len(chunks) <= SEARCH_CHUNK_MATCHES
+                and all(isinstance(email_id, str) for email_id in chunks)):
+            raise ValueError("malformed cursor")
+        return state
+    except Exception:
+        raise SearchError("invalid cursor")
+
+
+def normalize_query(params):
+    # The same search always produces the same dict, whatever the spacing or parameter order
+    query = {"q": re.sub(r"\s+", " ", str(params.get("q") or "")).strip()}
+    for name in FILTER_FIELDS:
+        values = params.get(name)
+        if values is None or values == "":
+            continue
+        if not isinstance(values, list):
+            values = str(values).split(",")
+        values = sorted({str(v).strip() for v in values if str(v).strip()})
+        if values:
+            query[name] = values
+    for name in ("date_from", "date_to"):
+        value = str(params.get(name) or "").strip()
+        if value:
+            query[name] = value
+    try:
+        size = int(params.get("size") or SEARCH_DEFAULT_SIZE)
+    except (TypeError, ValueError):
+        raise SearchError("size must be a number")
+    query["size"] = max(1, min(SEARCH_MAX_SIZE, size))
+    return query
+
+
+def build_filters(query, skip=()):
+    filters = []
+    for name, fields in FILTER_FIELDS.items():
+        if name not in query or name in skip:
+            continue
+        if len(fields) == 1:
+            filters.append({"terms": {fields[0]: query[name]}})
+        else:
+            filters.append({"bool": {"should": [{"terms": {field: query[name]}} for field in fields],
+                                     "minimum_should_match": 1}})
+    if "date_from" in query or "date_to" in query:
+        date_range = {}
+        if "date_from" in query:
+            date_range["gte"] = query["date_from"]
+        if "date_to" in query:
+            date_range["lte"] = query["date_to"]
+        filters.append({"range": {"date": date_range}})
+    return filters
+
+
+def build_query(query, chunk_email_ids=()):
+    if query["q"]:
+        text_query = {"simple_query_string": {"query": query["q"], "fields": SEARCH_FIELDS, "default_operator": "and"}}
+        if chunk_email_ids:
+            # emails matched only through their attachment text chunks
+            text_query = {"bool": {"should": [text_query, {"ids": {"values": list(chunk_email_ids)}}],
+                                   "minimum_should_match": 1}}
+        must = [text_query]
+    else:
+        must = [{"match_all": {}}]
+    return {"bool": {"must": must, "filter": build_filters(query)}}
+
+
+def chunk_matches(query, email_ids=None):
+    # (email _id -> best attachment text snippets, for the emails whose chunks match q, True when
+    # more than SEARCH_CHUNK_MATCHES emails matched); email_ids: only for these emails (the
+    # snippets of a later page)
+    if not query["q"]:
+        return {}, False
+    filters = build_filters(query, skip=CHUNK_UNFILTERED)
+    if email_ids is not None:
+        filters.append({"terms": {"email_id": list(email_ids)}})
+    response = get_es().search(
+        index=SEARCH_CHUNK_INDEX,
+        ignore_unavailable=True,
+        allow_no_indices=True,
+        query={"bool": {
+            "must": [{"simple_query_string": {"query": query["q"], "fields": ["text", "filename.text"],
+                                              "default_operator": "and"}}],
+            "filter": filters,
+        }},
+        # one (best) chunk per email
+        collapse={"field": "email_id"},
+        size=SEARCH_CHUNK_MATCHES + 1 if email_ids is None else len(email_ids),
+        _source=["email_id"],
+        highlight={"encoder": "html", "fragment_size": SEARCH_FRAGMENT_SIZE,
+                   "number_of_fragments": SEARCH_FRAGMENTS, "fields": {"text": {}}},
+    )
+    hits = response["hits"]["hits"]
+    truncated = email_ids is None and len(hits) > SEARCH_CHUNK_MATCHES
+    return {
+        hit["_source"]["email_id"]: hit.get("highlight", {}).get("text", [])
+        for hit in hits[:SEARCH_CHUNK_MATCHES]
+    }, truncated
+
+
+def build_sort(query):
+    date_sort = {"date": {"order": "desc", "unmapped_type": "date"}}
+    sort = [{"_score": "desc"}, date_sort] if query["q"] else [date_sort]
+    # tiebreaker of the point in time, makes search_after exact
+    sort.append({"_shard_doc": "asc"})
+    return sort
+
+
+def attachment_url(attachment, user_name):
+    filename = attachment.get("filename") or ""
+    if attachment.get("object_name"):
+        return url_for("serve_object", object_name=attachment["object_name"]) + f"?filename={quote(filename)}"
+    # local store: <base>/<user>/<email_id>/<filename>; the digest makes the content hash the ETag
+    filepath = attachment.get("filepath") or ""
+    email_id = os.path.basename(os.path.dirname(filepath.replace("\\", "/")))
+    if not email_id or not filename or not user_name:
+        return None
+    extra = {"sha256": attachment["sha256"]} if attachment.get("sha256") else {}
+    return url_for("serve_attachment", user_name=user_name, email_id=email_id, filename=filename, **extra)
+
+
+def format_hit(hit, chunk_snippets=None):
+    source = hit.get("_source", {})
+    attachments = []
+    for attachment in source.pop("attachments", None) or []:
+        attachments.append({
+            "filename": attachment.get("filename"),
+            "size": attachment.get("size"),
+            "sha256": attachment.get("sha256"),
+            "url": attachment_url(attachment, source.get("user")),
+        })
+    source["attachments"] = attachments
+    highlight = hit.get("highlight", {})
+    if chunk_snippets and "attachments.text" not in highlight:
+        highlight["attachments.text"] = chunk_snippets
+    return {
+        "id": hit["_id"],
+        "index": hit.get("_index"),
+        "score": hit.get("_score"),
+        "source": source,
+        "highlight": highlight,
+    }
+
+
+def close_pit(es, pit_id):
+    try:
+        es.close_point_in_time(id=pit_id)
+    except Exception as e:
+        logging.warning(f"Closing point in time failed: {e}")
+
+
+def run_search(query, pit_id=None, search_after=None, chunk_ids=None):
+    # chunk_ids: the emails the first page found through their attachment chunks (from the cursor).
+    # The point in time is closed once no cursor refers to it: on the last page, or when the
+    # first page opened it and failed
+    es = get_es()
+    opened = pit_id is None
+    if opened:
+        pit_id = es.open_point_in_time(index=SEARCH_INDEX, keep_alive=SEARCH_PIT_KEEP_ALIVE,
+                                       ignore_unavailable=True)["id"]
+    try:
+        result, next_pit = _search_page(es, query, pit_id, search_after, chunk_ids)
+    except Exception:
+        if opened:
+            close_pit(es, pit_id)
+        raise
+    if result["cursor"] is None:
+        close_pit(es, next_pit)
+    return result
+
+
+def _search_page(es, query, pit_id, search_after, chunk_ids):
+    matches = None
+    truncated = False
+    if chunk_ids is None:
+        matches, truncated = chunk_matches(query)
+        chunk_ids = sorted(matches)
+    body = {
+        "pit": {"id": pit_id, "keep_alive": SEARCH_PIT_KEEP_ALIVE},
+        "query": build_query(query, chunk_ids),
+        "sort": build_sort(query),
+        "size": query["size"],
+        "_source": {"includes": RESULT_FIELDS},
+        "track_total_hits": True if search_after is None else False,
+        "highlight": {
+            "encoder": "html",
+            "fragment_size": SEARCH_FRAGMENT_SIZE,
+            "number_of_fragments": SEARCH_FRAGMENTS,
+            "fields": {field: {} for field in HIGHLIGHT_FIELDS},
+        },
+    }
+    if search_after is not None:
+        body["search_after"] = search_after
+
+    response = es.search(**body)
+    hits = response["hits"]["hits"]
+    next_pit = response.get("pit_id", pit_id)
+
+    if matches is None:
+        # snippets only for the chunk matched emails on this page that have no other attachment highlight
+        chunk_set = set(chunk_ids)
+        page_ids = [hit["_id"] for hit in hits
+                    if hit["_id"] in chunk_set and "attachments.text" not in hit.get("highlight", {})]
+        matches = chunk_matches(query, page_ids)[0] if page_ids else {}
+
+    result = {"hits": [format_hit(hit, matches.get(hit["_id"])) for hit in hits], "cursor": None}
+    if search_after is None:
+        total = response["hits"].get("total") or {}
+        result["total"] = total.get("value", 0)
+        # total then leaves out emails matched only by attachment text beyond SEARCH_CHUNK_MATCHES
+        result["attachment_matches_truncated"] = truncated
+    if len(hits) == query["size"]:
+        result["cursor"] = encode_cursor({"pit": next_pit, "after": hits[-1]["sort"], "query": query,
+                                          "chunks": chunk_ids})
+    return result, next_pit
+
+
+def cache_key(query, cursor):
+    data = json.dumps({"query": query, "cursor": cursor}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+@search_api.route("/search", methods=["GET", "POST"])
+def search():
+    # GET /search?q=...&user=a,b&department=...&folder_name=inbox&date_from=2024-01-01&size=20
+    # next page: GET /search?cursor=<cursor from the previous response>
+    cursor = None
+    try:
+        params = request.get_json(silent=True) if request.method == "POST" else None
+        params = params or request.args.to_dict()
+        cursor = params.get("cursor")
+        if cursor:
+            state = decode_cursor(cursor)
+            # the cursor comes back from the client: its query gets the same checks as a new one
+            query = normalize_query(state["query"])
+        else:
+            state = None
+            query = normalize_query(params)
+
+        key = cache_key(query, cursor)
+        result = result_cache.get(key)
+        if result is None:
+            if state:
+                result = run_search(query, state["pit"], state["after"], state["chunks"])
+            else:
+                result = run_search(query)
+            # a first page with a cursor is not shared: every client gets its own point in time,
+            # which DELETE /search/cursor closes
+            if state or result["cursor"] is None:
+                result_cache.put(key, result)
+        return jsonify(result)
+
+    except SearchError as e:
+        return jsonify({"error": str(e)}), e.status
+    except Exception as e:
+        status = getattr(getattr(e, "meta", None), "status", None)
+        if status == 404 and cursor:
+            # the point in time expired; the client starts over without a cursor
+            return jsonify({"error": "cursor expired"}), 410
+        if status == 400:
+            return jsonify({"error": "invalid query"}), 400
+        logging.error(f"Search failed: {e}")
+        return jsonify({"error": "search failed"}), 502
+
+
+@search_api.route("/search/cursor", methods=["DELETE"])
+def close_cursor():
+    # Releases the point in time of a cursor before its keep alive runs out
+    try:
+        state = decode_cursor(request.args.get("cursor") or "")
+        get_es().close_point_in_time(id=state["pit"])
+        return jsonify({"closed": True})
+    except SearchError as e:
+        return jsonify({"error": str(e)}), e.status
+    except Exception as e:
+        logging.error(f"Closing search cursor failed: {e}")
+        return jsonify({"closed": False}), 502
@@ -0,0 +1,157 @@
+import os
+import gzip
+import json
+import zlib
+import time
+import socket
+import logging
+import threading
+
+# Spool of the documents written by `mailsearch ingest --spool DIR`, read back by
+# `mailsearch reindex-from-spool`, so a mapping or enrichment change does not mean reading
+# every PST and parsing every attachment again.
+#
+# Every ingest process appends to its own segment, DIR/<host>-<pid>-<time>.ndjson.zst (or .gz
+# without the zstandard package): one JSON record per email, with the attachment text already
+# extracted. The record is taken just before the email is chunked and sent, and written once
+# Elasticsearch acknowledged the email, so a rejected one is not spooled. A segment is a series of
+# compressed frames (gzip members); a frame is closed whenever a store is finished, so a
+# crash loses at most the store being read, and a torn last frame is skipped on reading.
+#
+# Record: {"_id", "store", "index_date", "doc": the email document, "dedup": the --dedup
+# owner/folder/full of the copy, when there was one}
+
+SPOOL_DIR = os.getenv("SPOOL_DIR", "")
+SPOOL_LEVEL = int(os.getenv("SPOOL_LEVEL", "3"))
+SPOOL_READ_SIZE = 1024 * 1024
+
+EXTENSIONS = {"zstd": ".ndjson.zst", "gzip": ".ndjson.gz"}
+
+
+def spool_compression():
+    # zstd when the optional zstandard package is installed
+    try:
+        import zstandard
+    except ImportError:
+        return "gzip"
+    return "zstd"
+
+
+class SpoolWriter:
+    def __init__(self, directory, compression=None):
+        self.compression = compression or spool_compression()
+        os.makedirs(directory, exist_ok=True)
+        name = f"{socket.gethostname()}-{os.getpid()}-{time.strftime('%Y%m%dT%H%M%S')}{EXTENSIONS[self.compression]}"
+        self.path = os.path.join(directory, name)
+        self.count = 0
+        self._file = open(self.path, "ab")
+        self._stream = None
+        self._lock = threading.Lock()
+
+    def _open_frame(self):
+        if self.compression == "zstd":
+            import zstandard
+            return zstandard.ZstdCompressor(level=SPOOL_LEVEL).stream_writer(self._file, closefd=False)
+        # gzip levels run 1-9 and cost more per level than zstd's
+        return gzip.GzipFile(fileobj=self._file, mode="wb", compresslevel=min(9, max(1, SPOOL_LEVEL)))
+
+    @staticmethod
+    def encode(record):
+        return json.dumps(record, ensure_ascii=False, default=str).encode("utf-8") + b"\n"
+
+    def write(self, record):
+        self.write_line(self.encode(record))
+
+    def write_line(self, line):
+        with self._lock:
+            if self._stream is None:
+                self._stream = self._open_frame()
+            self._stream.write(line)
+            self.count += 1
+
+    def flush(self):
+        # ends the current frame, everything written so far is readable after a crash
+        with self._lock:
+            if self._stream is not None:
+                self._stream.close()
+                self._stream = None
+            self._file.flush()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __call__(self, actions):
+        # Indexer prepare step, after the attachment text is resolved and before it is chunked
+        # or capped: the record of every email read in this run (actions carrying _spool) is
+        # encoded while the email is still whole, and kept on the action for acknowledged()
+        for action in actions:
+            spool = action.pop("_spool", None)
+            if spool is None:
+                continue
+            record = {"_id": action["_id"], "store": spool["store"], "index_date": spool["index_date"],
+                      "doc": action["_source"]}
+            if "_dedup" in action:
+                record["dedup"] = action["_dedup"]
+            action["_spool_line"] = self.encode(record)
+        return actions
+
+    def acknowledged(self, actions):
+        # Indexer on_indexed step: writes the records of the emails Elasticsearch accepted
+        for action in actions:
+            line = action.pop("_spool_line", None)
+            if line is not None:
+                self.write_line(line)
+
+
+def segments(directory):
+    # Segments oldest first, so a message spooled again by a later run is indexed last
+    names = [name for name in os.listdir(directory) if name.endswith(tuple(EXTENSIONS.values()))]
+    paths = [os.path.join(directory, name) for name in names]
+    return sorted(paths, key=lambda path: (os.path.getmtime(path), path))
+
+
+def _decompressor(path):
+    # one per frame (gzip member)
+    if path.endswith(EXTENSIONS["zstd"]):
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(wbits=31)
+
+
+def _frames(raw, path):
+    # Decompressed data of the frames in turn; a torn or corrupt frame ends it, after everything
+    # before it was returned
+    decompressor, started = _decompressor(path), False
+    while True:
+        chunk = raw.read(SPOOL_READ_SIZE)
+        if not chunk:
+            break
+        while chunk:
+            started = True
+            try:
+                data = decompressor.decompress(chunk)
+            except Exception as e:
+                logging.warning(f"Spool segment {path} is damaged, its last records are skipped: {e}")
+                return
+            if data:
+                yield data
+            chunk = b""
+            if decompressor.eof:
+                chunk, decompressor, started = decompressor.unused_data, _decompressor(path), False
+    if started:
+        logging.warning(f"Spool segment {path} ends in an incomplete frame, its last records are skipped")
+
+
+def read_segment(path):
+    # Yields the records of one segment; a torn frame at the end (a crashed writer) is skipped
+    with open(path, "rb") as raw:
+        pending = b""
+        for data in _frames(raw, path):
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                if line:
+                    yield json.loads(line)
+        if pending:
+            logging.warning(f"Spool segment {path} ends in an incomplete record, skipped")
@@ -0,0 +1,38 @@
+import os
+import sqlite3
+import threading
+
+# Base for the small SQLite files the ingester keeps next to itself (text cache,
+# checkpoints, directory snapshot). Each thread gets its own connection; WAL mode
+# lets worker processes read while another one writes.
+
+
+class SQLiteStore:
+    # WAL needs shared memory between the processes, which network file systems do not offer
+    journal_mode = "WAL"
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        # a connection inherited through fork() must not be used by the child
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute(f"PRAGMA journal_mode={self.journal_mode}")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _executemany(self, sql, rows):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(sql, rows)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
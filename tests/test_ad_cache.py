@@ -0,0 +1,85 @@
+from types import SimpleNamespace
+
+from ad_cache import DirectoryCache, lookup_recipients
+
+
+def directory(tmp_path, users):
+    cache = DirectoryCache(str(tmp_path / "ad.db"))
+    cache._executemany(
+        "INSERT INTO users (email, display_name, sam_account_name, department, manager) VALUES (?, ?, ?, ?, ?)",
+        users,
+    )
+    return cache
+
+
+def test_lookup_by_email_and_display_name(tmp_path):
+    cache = directory(tmp_path, [("ann@example.com", "Ann Lee", "alee", "Sales", "Bob")])
+    info = {"display_name": "Ann Lee", "sam_account_name": "alee", "department": "Sales", "manager": "Bob"}
+    assert cache.lookup(" ANN@example.com ") == info
+    assert cache.lookup("'ann lee'") == info
+    assert cache.lookup("nobody@example.com") is None
+    assert cache.lookup("") is None
+
+
+def test_recipients_without_sam_account_name_are_kept(tmp_path):
+    cache = directory(tmp_path, [
+        ("ann@example.com", "Ann Lee", "alee", "Sales", ""),
+        ("room1@example.com", "Room 1", "", "", ""),
+        ("room2@example.com", "Room 2", "", "", ""),
+    ])
+    recipients = lookup_recipients(cache, ["room1@example.com", "room2@example.com", "ann@example.com"])
+    assert [r["display_name"] for r in recipients] == ["Room 1", "Room 2", "Ann Lee"]
+
+
+def test_recipient_given_twice_is_listed_once(tmp_path):
+    cache = directory(tmp_path, [("ann@example.com", "Ann Lee", "alee", "Sales", "")])
+    recipients = lookup_recipients(cache, ["ann@example.com", "Ann Lee", "unknown@example.com"])
+    assert recipients == [{"display_name": "Ann Lee", "sam_account_name": "alee", "department": "Sales"}]
+
+
+def test_shared_display_name_is_not_enriched(tmp_path):
+    cache = directory(tmp_path, [
+        ("ann.lee@example.com", "Ann Lee", "alee", "Sales", ""),
+        ("ann.lee2@example.com", "Ann Lee", "alee2", "Legal", ""),
+    ])
+    assert cache.lookup("Ann Lee") is None
+    assert cache.lookup("ann.lee2@example.com")["department"] == "Legal"
+    assert lookup_recipients(cache, ["Ann Lee"]) == []
+
+
+class FakeConnection:
+    def __init__(self, dc, entries=()):
+        info = SimpleNamespace(other={"dsServiceName": [f"CN=NTDS Settings,CN={dc},CN=Servers"]} if dc else {})
+        self.server = SimpleNamespace(host="corp.example.com", info=info)
+        self.entries = list(entries)
+        self.filters = []
+        self.extend = SimpleNamespace(standard=SimpleNamespace(paged_search=self.paged_search))
+
+    def paged_search(self, search_filter, **kwargs):
+        self.filters.append(search_filter)
+        return iter(self.entries)
+
+
+def entry(email, usn):
+    return {"attributes": {"mail": email, "displayName": email, "sAMAccountName": email.split("@")[0],
+                           "uSNChanged": usn}}
+
+
+def test_incremental_pull_only_from_the_same_dc(tmp_path):
+    cache = DirectoryCache(str(tmp_path / "ad.db"))
+    assert cache.refresh(FakeConnection("DC1", [entry("a@example.com", 100)]), "dc=example") == 1
+
+    same = FakeConnection("DC1", [entry("b@example.com", 120)])
+    cache.refresh(same, "dc=example")
+    assert same.filters == ["(&(objectClass=user)(uSNChanged>=101))"]
+    assert cache.lookup("a@example.com") is not None
+
+    # the same host name answered by another DC of the domain
+    other = FakeConnection("DC2", [entry("c@example.com", 40)])
+    cache.refresh(other, "dc=example")
+    assert other.filters == ["(objectClass=user)"]
+    assert cache.lookup("a@example.com") is None
+
+    unknown = FakeConnection(None, [entry("c@example.com", 45)])
+    cache.refresh(unknown, "dc=example")
+    assert unknown.filters == ["(objectClass=user)"]
@@ -0,0 +1,61 @@
+from attachment_chunks import ChunkSplitter, chunk_ids, delete_stale_chunks, split_text
+from dedup import to_upserts
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls = []
+
+    def delete_by_query(self, **kwargs):
+        self.calls.append(kwargs)
+        return {"deleted": 2}
+
+
+def email(doc_id, *texts):
+    return {"_index": "email_exchange-2024", "_id": doc_id, "_source": {
+        "date": "2024-05-01T10:00:00", "user": "alice",
+        "attachments": [{"filename": f"a{i}.txt", "text": text} for i, text in enumerate(texts)],
+    }}
+
+
+def test_split_text_keeps_words_whole():
+    text = "alpha beta gamma delta epsilon"
+    chunks = split_text(text, 12)
+    assert all(len(chunk) <= 12 for chunk in chunks)
+    assert " ".join(chunks).split() == text.split()
+
+
+def test_chunk_ids_follow_the_split():
+    splitter = ChunkSplitter(lambda date: "email_attachment_chunks-2024", chunk_chars=10)
+    actions = splitter([email("e1", "one two three four", "", "five")])
+    assert [a["_id"] for a in actions[1:]] == chunk_ids(actions[0]) == ["e1:0:0", "e1:0:1", "e1:0:2", "e1:2:0"]
+
+
+def test_dedup_copy_without_attachments_keeps_the_chunks():
+    splitter = ChunkSplitter(lambda date: "email_attachment_chunks-2024")
+    full = email("e1", "text")
+    full["_dedup"] = {"owner": "alice", "folder": "inbox", "full": True}
+    copy = email("e1")
+    copy["_dedup"] = {"owner": "bob", "folder": "inbox", "full": False}
+    full_action = to_upserts(splitter([full]))[0]
+    copy_action = to_upserts(splitter([copy]))[0]
+    assert chunk_ids(full_action) == ["e1:0:0"]
+    assert chunk_ids(copy_action) is None
+
+
+def test_stale_chunks_are_deleted_by_parent_id():
+    client = FakeClient()
+    actions = ChunkSplitter(lambda date: "chunks", chunk_chars=10)([email("e1", "one two three"), email("e2")])
+    parents = [a for a in actions if ":" not in a["_id"]]
+    assert delete_stale_chunks(client, "email_attachment_chunks-*", parents) == 2
+    query = client.calls[0]["query"]["bool"]
+    assert query["filter"] == [{"terms": {"email_id": ["e1", "e2"]}}]
+    assert query["must_not"] == [{"ids": {"values": ["e1:0:0", "e1:0:1"]}}]
+
+
+def test_nothing_to_delete_without_chunked_emails():
+    client = FakeClient()
+    copy = email("e1")
+    copy["_dedup"] = {"owner": "bob", "folder": "inbox", "full": False}
+    assert delete_stale_chunks(client, "email_attachment_chunks-*", to_upserts([copy])) == 0
+    assert client.calls == []
@@ -0,0 +1,129 @@
+import hashlib
+import os
+
+import pytest
+
+import attachment_server
+import search_api
+
+DIGEST = "ab" * 32
+OBJECT = f"/objects/{DIGEST[:2]}/{DIGEST}.pdf"
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    monkeypatch.setattr(attachment_server, "ATTACHMENT_BASE_PATH", str(tmp_path))
+    monkeypatch.setattr(attachment_server, "ATTACHMENT_BASE_REAL_PATH", str(tmp_path.resolve()))
+    return attachment_server.app.test_client()
+
+
+def test_object_revalidation_has_no_epoch_last_modified(client, monkeypatch):
+    def no_minio():
+        raise AssertionError("a matching If-None-Match needs no MinIO round trip")
+    monkeypatch.setattr(attachment_server, "get_minio", no_minio)
+    response = client.get(OBJECT, headers={"If-None-Match": f'"{DIGEST}"'})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == f'"{DIGEST}"'
+    assert "Last-Modified" not in response.headers
+
+
+def test_cache_headers_last_modified_only_with_mtime():
+    assert "Last-Modified" not in attachment_server.cache_headers("x")
+    assert attachment_server.cache_headers("x", 86400)["Last-Modified"] == "Fri, 02 Jan 1970 00:00:00 GMT"
+
+
+def test_local_file_revalidates_on_last_modified(client, tmp_path):
+    (tmp_path / "user" / "email").mkdir(parents=True)
+    (tmp_path / "user" / "email" / "a.pdf").write_bytes(b"%PDF-1.4 content")
+    response = client.get("/attachments/user/email/a.pdf")
+    assert response.status_code == 200
+    assert response.data == b"%PDF-1.4 content"
+    last_modified = response.headers["Last-Modified"]
+    assert not last_modified.startswith("Thu, 01 Jan 1970")
+    response = client.get("/attachments/user/email/a.pdf", headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+
+
+def test_local_etag_from_stat_shared_by_hard_links(client, tmp_path):
+    (tmp_path / "user" / "one").mkdir(parents=True)
+    (tmp_path / "user" / "two").mkdir(parents=True)
+    (tmp_path / "user" / "one" / "a.pdf").write_bytes(b"%PDF-1.4 content")
+    os.link(tmp_path / "user" / "one" / "a.pdf", tmp_path / "user" / "two" / "b.pdf")
+    first = client.get("/attachments/user/one/a.pdf")
+    etag = first.headers["ETag"]
+    stat = (tmp_path / "user" / "one" / "a.pdf").stat()
+    assert etag == f'"{attachment_server.file_etag(stat)}"'
+    assert client.get("/attachments/user/two/b.pdf").headers["ETag"] == etag
+    response = client.get("/attachments/user/two/b.pdf", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    response = client.get("/attachments/user/one/a.pdf", headers={"Range": "bytes=0-3", "If-Range": etag})
+    assert response.status_code == 206
+    assert response.data == b"%PDF"
+
+
+def test_local_etag_is_the_blob_digest_when_the_link_names_it(client, tmp_path):
+    content = b"%PDF-1.4 content"
+    digest = hashlib.sha256(content).hexdigest()
+    (tmp_path / "_blobs" / digest[:2]).mkdir(parents=True)
+    (tmp_path / "_blobs" / digest[:2] / digest).write_bytes(content)
+    (tmp_path / "user" / "email").mkdir(parents=True)
+    os.link(tmp_path / "_blobs" / digest[:2] / digest, tmp_path / "user" / "email" / "a.pdf")
+    (tmp_path / "user" / "email" / "copy.pdf").write_bytes(content)
+    fallback = f'"{attachment_server.file_etag((tmp_path / "user" / "email" / "a.pdf").stat())}"'
+
+    assert client.get(f"/attachments/user/email/a.pdf?sha256={digest}").headers["ETag"] == f'"{digest}"'
+    assert client.get(f"/attachments/user/email/a.pdf/download?sha256={digest}").headers["ETag"] == f'"{digest}"'
+    response = client.get(f"/attachments/user/email/a.pdf?sha256={digest}", headers={"If-None-Match": f'"{digest}"'})
+    assert response.status_code == 304
+    # a digest that is not this file's blob, or a plain copy, falls back to the stat ETag
+    assert client.get(f"/attachments/user/email/a.pdf?sha256={'0' * 64}").headers["ETag"] == fallback
+    assert client.get("/attachments/user/email/a.pdf").headers["ETag"] == fallback
+    copy = client.get(f"/attachments/user/email/copy.pdf?sha256={digest}").headers["ETag"]
+    assert copy != f'"{digest}"'
+
+
+def test_search_links_name_the_local_digest():
+    attachment = {"filename": "a.pdf", "filepath": "/store/user/email/a.pdf", "sha256": "ab" * 32}
+    with attachment_server.app.test_request_context():
+        assert search_api.attachment_url(attachment, "user") == f"/attachments/user/email/a.pdf?sha256={'ab' * 32}"
+
+
+class FakeES:
+    def __init__(self, documents):
+        self.documents = documents
+        self.searches = []
+
+    def search(self, **body):
+        self.searches.append(body)
+        ids = body["query"]["ids"]["values"]
+        return {"hits": {"hits": [{"_id": i, "_source": self.documents[i]} for i in ids if i in self.documents]}}
+
+
+def test_manifest_of_object_store_emails_comes_from_their_documents(client, tmp_path, monkeypatch):
+    object_name = f"{DIGEST[:2]}/{DIGEST}.pdf"
+    es = FakeES({
+        "doc1": {"user": "alice", "attachments": [{"filename": "r.pdf", "size": 10, "object_name": object_name}]},
+        "doc2": {"user": "bob", "owners": ["bob", "carol"], "attachments": []},
+    })
+    monkeypatch.setattr(search_api, "get_es", lambda: es)
+    (tmp_path / "dave" / "local1").mkdir(parents=True)
+    (tmp_path / "dave" / "local1" / "n.txt").write_bytes(b"note")
+
+    manifest = client.get("/attachments/alice/doc1").get_json()
+    assert manifest["attachments"] == [{
+        "filename": "r.pdf", "size": 10, "mime_type": "application/pdf", "modified": None, "viewable": True,
+        "url": f"/objects/{object_name}?filename=r.pdf",
+        "download_url": f"/objects/{object_name}?filename=r.pdf&download=1",
+    }]
+    # another user's email is not listed
+    assert client.get("/attachments/mallory/doc1").status_code == 404
+
+    response = client.post("/attachments/manifest", json={"emails": [
+        {"user": "dave", "email_id": "local1"}, {"user": "carol", "email_id": "doc2"},
+        {"user": "alice", "email_id": "missing"},
+    ]}).get_json()
+    attachments = [email["attachments"] for email in response["emails"]]
+    assert [item["filename"] for item in attachments[0]] == ["n.txt"]
+    assert attachments[1:] == [[], None]
+    # the emails not on the local disk are looked up in one search
+    assert es.searches[-1]["query"] == {"ids": {"values": ["doc2", "missing"]}}
@@ -0,0 +1,132 @@
+import threading
+from concurrent.futures import Future
+
+from attachment_chunks import ChunkSplitter
+from bulk_indexer import BulkIndexer
+from extract_pool import resolve_attachment_text
+from spool import SpoolWriter, read_segment
+from upload_stage import resolve_uploads
+
+
+class FakeClient:
+    def __init__(self):
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def bulk(self, operations):
+        items = [{next(iter(op)): {"status": 201}} for op in operations if "index" in op]
+        with self._lock:
+            self.requests.append(operations)
+        return {"errors": False, "items": items}
+
+
+def doc(i):
+    return {"_index": "emails", "_id": f"d{i}", "_source": {"n": i}}
+
+
+def test_queued_documents_are_prepared_together():
+    batches = []
+
+    def prepare(actions):
+        batches.append(len(actions))
+        return actions
+
+    indexer = BulkIndexer(FakeClient(), prepare=prepare, min_docs=10, max_docs=50)
+    # queued before the collector starts, so it finds them waiting
+    for i in range(120):
+        indexer.add(doc(i))
+    indexer.start()
+    indexer.flush()
+    assert indexer.indexed == 120
+    assert max(batches) > 1
+    assert sum(batches) == 120
+
+
+def test_failed_prepare_fails_its_batch_without_preparing_again():
+    calls = []
+
+    def prepare(actions):
+        calls.append(len(actions))
+        if any(action["_id"] == "d7" for action in actions):
+            raise RuntimeError("prepare failed")
+        return actions
+
+    indexer = BulkIndexer(FakeClient(), prepare=prepare)
+    # queued before the collector starts, so they are prepared as one batch
+    for i in range(20):
+        indexer.add(doc(i), tag="inbox")
+    indexer.start()
+    indexer.flush()
+    assert calls == [20]
+    assert (indexer.indexed, indexer.failed) == (0, 20)
+    assert indexer.pop_counts("inbox") == (0, 20)
+
+
+def test_failed_upload_fails_only_its_document_through_the_real_steps(tmp_path):
+    spool = SpoolWriter(str(tmp_path), compression="gzip")
+    steps = [resolve_uploads, resolve_attachment_text, spool, ChunkSplitter(lambda date: "chunks", chunk_chars=10)]
+
+    def prepare(actions):
+        for step in steps:
+            actions = step(actions)
+        return actions
+
+    acknowledged = []
+
+    def on_indexed(tag, actions):
+        spool.acknowledged(actions)
+        acknowledged.extend(actions)
+
+    def email(i, upload):
+        text = Future()
+        text.set_result(f"report number {i} with some text")
+        return {"_index": "emails", "_id": f"d{i}", "_spool": {"store": "a.pst", "index_date": "2024-01-01"},
+                "_source": {"attachments": [{"filename": "r.pdf", "_upload": upload, "text": text}]}}
+
+    uploaded, failed = Future(), Future()
+    uploaded.set_result(None)
+    failed.set_exception(OSError("MinIO unavailable"))
+    client = FakeClient()
+    indexer = BulkIndexer(client, prepare=prepare, on_indexed=on_indexed)
+    for i, upload in enumerate([uploaded, failed, uploaded]):
+        indexer.add(email(i, upload), tag="inbox")
+    indexer.start()
+    indexer.flush()
+    spool.close()
+
+    assert (indexer.indexed, indexer.failed) == (2, 1)
+    assert indexer.pop_counts("inbox") == (2, 1)
+    assert sorted(action["_id"] for action in acknowledged) == ["d0", "d2"]
+    for action in acknowledged:
+        assert action["_source"]["attachments"][0]["text_chunks"] > 0
+    sent = [op["index"]["_id"] for request in client.requests for op in request if "index" in op]
+    assert not any(doc_id.startswith("d1") for doc_id in sent)
+    assert [doc_id for doc_id in sent if ":" in doc_id and doc_id.startswith("d0")]
+    assert [record["_id"] for record in read_segment(spool.path)] == ["d0", "d2"]
+
+
+def test_derived_actions_count_once_with_their_document():
+    def prepare(actions):
+        prepared = []
+        for action in actions:
+            prepared.append(action)
+            prepared += [{"_index": "chunks", "_id": f"{action['_id']}:{n}", "_source": {}} for n in range(3)]
+        return prepared
+
+    client = FakeClient()
+    indexer = BulkIndexer(client, prepare=prepare)
+    for i in range(5):
+        indexer.add(doc(i))
+    indexer.start()
+    indexer.flush()
+    assert indexer.indexed == 5
+    assert sum(len(r) for r in client.requests) == 5 * 4 * 2
+
+
+def test_dropped_document_fails_instead_of_hanging():
+    indexer = BulkIndexer(FakeClient(), prepare=lambda actions: [a for a in actions if a["_id"] != "d1"])
+    for i in range(3):
+        indexer.add(doc(i))
+    indexer.start()
+    indexer.flush()
+    assert (indexer.indexed, indexer.failed) == (2, 1)
@@ -0,0 +1,102 @@
+import sqlite3
+
+from checkpoint import CheckpointStore, SourceProgress, record_indexed
+
+SOURCE = "archive/user/mailbox.pst"
+
+
+def read_folder(progress, folder_path, doc_ids, acknowledged):
+    # what ingest.read_items does for one folder: skip what was acknowledged, send the rest
+    sent = [doc_id for doc_id in doc_ids if not progress.is_indexed(doc_id, folder_path)]
+    progress.folder_read(folder_path, len(doc_ids))
+    tag = progress.tag(folder_path)
+    record_indexed(progress.store, tag, [{"_id": doc_id} for doc_id in sent if doc_id in acknowledged])
+    progress.record_folders()
+    return sent
+
+
+def test_folder_done_after_every_item_acknowledged(tmp_path):
+    store = CheckpointStore(str(tmp_path / "checkpoint.db"))
+    progress = SourceProgress(store, SOURCE)
+
+    read_folder(progress, "/Inbox", ["a", "b", "c"], acknowledged={"a", "b"})
+    assert not progress.is_folder_done("/Inbox")
+
+    # resume: only the unacknowledged message is sent again
+    progress = SourceProgress(store, SOURCE)
+    assert read_folder(progress, "/Inbox", ["a", "b", "c"], acknowledged={"c"}) == ["c"]
+    assert progress.is_folder_done("/Inbox")
+
+
+def test_cross_folder_duplicate_finishes_both_folders(tmp_path):
+    # with dedup one message in Inbox and Deleted Items of the same store has a single _id
+    store = CheckpointStore(str(tmp_path / "checkpoint.db"))
+    progress = SourceProgress(store, SOURCE)
+    read_folder(progress, "/Inbox", ["shared", "a"], acknowledged={"shared", "a"})
+    read_folder(progress, "/Deleted Items", ["shared", "b"], acknowledged={"shared"})
+    assert progress.is_folder_done("/Inbox")
+    assert not progress.is_folder_done("/Deleted Items")
+
+    # the re-run skips the copy acknowledged under Inbox and still finishes Deleted Items
+    progress = SourceProgress(store, SOURCE)
+    assert read_folder(progress, "/Deleted Items", ["shared", "b"], acknowledged={"b"}) == ["b"]
+    assert progress.is_folder_done("/Deleted Items")
+
+
+def test_copy_skipped_by_a_later_run_counts_for_its_folder(tmp_path):
+    store = CheckpointStore(str(tmp_path / "checkpoint.db"))
+    read_folder(SourceProgress(store, SOURCE), "/Inbox", ["shared"], acknowledged={"shared"})
+
+    progress = SourceProgress(store, SOURCE)
+    assert read_folder(progress, "/Sent Items", ["shared"], acknowledged=set()) == []
+    assert progress.is_folder_done("/Sent Items")
+
+
+def test_cross_folder_duplicate_acknowledged_in_both(tmp_path):
+    # both copies in flight at once: each folder records its own acknowledgement
+    store = CheckpointStore(str(tmp_path / "checkpoint.db"))
+    for folder_path in ("/Inbox", "/Sent Items"):
+        store.mark_folder_read(SOURCE, folder_path, 1)
+        store.mark_indexed(SOURCE, folder_path, ["shared"])
+
+    assert store.is_folder_done(SOURCE, "/Inbox")
+    assert store.is_folder_done(SOURCE, "/Sent Items")
+    assert list(store.iter_indexed(SOURCE)) == ["shared"]
+
+
+def test_folder_recorded_after_the_indexer_is_flushed(tmp_path):
+    store = CheckpointStore(str(tmp_path / "checkpoint.db"))
+    progress = SourceProgress(store, SOURCE)
+    progress.folder_read("/Inbox", 0)
+    # an empty folder would count as done right away
+    assert not progress.is_folder_done("/Inbox")
+    progress.record_folders()
+    assert progress.is_folder_done("/Inbox")
+
+
+def test_source_done(tmp_path):
+    store = CheckpointStore(str(tmp_path / "checkpoint.db"))
+    progress = SourceProgress(store, SOURCE)
+    progress.complete(False)
+    assert not store.is_source_done(SOURCE)
+    progress.complete(True)
+    assert store.is_source_done(SOURCE)
+
+
+def test_legacy_checkpoint_is_migrated(tmp_path):
+    path = str(tmp_path / "checkpoint.db")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE indexed (source TEXT NOT NULL, doc_id TEXT NOT NULL, folder_path TEXT NOT NULL DEFAULT '', "
+        "PRIMARY KEY (source, doc_id)) WITHOUT ROWID"
+    )
+    conn.execute("CREATE INDEX indexed_folder ON indexed (source, folder_path)")
+    conn.execute("INSERT INTO indexed VALUES (?, 'a', '/Inbox')", (SOURCE,))
+    conn.commit()
+    conn.close()
+
+    store = CheckpointStore(path)
+    assert store.is_indexed(SOURCE, "a")
+    assert store.is_indexed(SOURCE, "a", "/Inbox")
+    store.mark_indexed(SOURCE, "/Sent Items", ["a"])
+    assert store.indexed_count(SOURCE) == 2
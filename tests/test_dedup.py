@@ -0,0 +1,51 @@
+from types import SimpleNamespace
+
+from dedup import DedupStore, dedup_document_id, dedup_key, simhash, to_upserts, MERGE_SCRIPT_ID
+
+
+def test_key_from_message_id_ignores_brackets_and_case():
+    a = SimpleNamespace(InternetMessageID="<ABC@example.com>")
+    b = SimpleNamespace(InternetMessageID="abc@example.com")
+    assert dedup_key(a) == dedup_key(b) == "mid:abc@example.com"
+
+
+def test_key_without_message_id_hashes_normalized_fields():
+    a = SimpleNamespace(InternetMessageID="", SenderEmailAddress="A@x", SentOn="2024-01-02T03:04:05+0100",
+                        Subject="Hello  world", Body="Body\r\ntext")
+    b = SimpleNamespace(InternetMessageID="", SenderEmailAddress="a@x", SentOn="2024-01-02T03:04:05",
+                        Subject="hello world", Body="body text")
+    assert dedup_key(a) == dedup_key(b)
+    assert dedup_key(a).startswith("hash:")
+
+
+def test_first_claim_wins(tmp_path):
+    store = DedupStore(str(tmp_path / "dedup.db"))
+    doc_id = dedup_document_id("mid:abc@example.com")
+    assert store.claim(doc_id, "alice.pst")
+    assert not store.claim(doc_id, "bob.pst")
+    # the claimer stays the claimer on a re-run
+    assert store.claim(doc_id, "alice.pst")
+
+
+def test_near_duplicate(tmp_path):
+    store = DedupStore(str(tmp_path / "dedup.db"))
+    body = " ".join(f"word{i}" for i in range(60))
+    original = simhash(body)
+    assert store.near_duplicate("first", original) is None
+    assert store.near_duplicate("second", original ^ 0b101) == "first"
+    assert store.near_duplicate("third", original ^ 0xFFFF) is None
+    assert simhash("too short") is None
+
+
+def test_upserts_merge_owner_and_folder():
+    actions = to_upserts([
+        {"_index": "emails", "_id": "d", "_source": {"subject": "s"},
+         "_dedup": {"owner": "bob", "folder": "inbox", "full": False}},
+        {"_index": "chunks", "_id": "d#0", "_source": {"text": "t"}},
+    ])
+    upsert, chunk = actions
+    assert upsert["_op_type"] == "update"
+    assert upsert["_source"]["scripted_upsert"]
+    assert upsert["_source"]["script"] == {"id": MERGE_SCRIPT_ID, "params": {
+        "doc": {"subject": "s"}, "replace": False, "owner": "bob", "folder": "inbox"}}
+    assert chunk == {"_index": "chunks", "_id": "d#0", "_source": {"text": "t"}}
@@ -0,0 +1,63 @@
+import io
+import zipfile
+
+import extractors
+from extractors import extract_text_from_file
+
+
+def zip_bytes(members, compression=zipfile.ZIP_DEFLATED):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression) as archive:
+        for name, data in members:
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def test_member_compressed_above_ratio_is_skipped():
+    data = zip_bytes([("bomb.txt", b"a" * 1024 * 1024), ("note.txt", b"quarterly figures attached")])
+    text = extract_text_from_file("mail.zip", data)
+    assert "quarterly figures attached" in text
+    assert "bomb.txt" not in text
+    assert "aaaa" not in text
+
+
+def test_member_above_declared_size_limit_is_skipped(monkeypatch):
+    monkeypatch.setattr(extractors, "EXTRACT_MAX_MEMBER_BYTES", 100)
+    data = zip_bytes([("big.txt", b"x" * 200), ("small.txt", b"kept")], zipfile.ZIP_STORED)
+    text = extract_text_from_file("mail.zip", data)
+    assert "kept" in text
+    assert "big.txt" not in text
+
+
+def test_archive_budget_stops_reading_members(monkeypatch):
+    monkeypatch.setattr(extractors, "EXTRACT_MAX_ARCHIVE_BYTES", 150)
+    data = zip_bytes([("one.txt", b"1" * 100), ("two.txt", b"2" * 100)], zipfile.ZIP_STORED)
+    text = extract_text_from_file("mail.zip", data)
+    assert "1" * 100 in text
+    assert "two.txt" not in text
+
+
+class LyingArchive:
+    # a member whose stream expands past the size its header declares
+    def __init__(self, declared, content):
+        self.info = zipfile.ZipInfo("report.txt")
+        self.info.file_size = self.info.compress_size = declared
+        self.content = content
+
+    def infolist(self):
+        return [self.info]
+
+    def open(self, info):
+        return io.BytesIO(self.content)
+
+
+def test_member_read_stops_at_declared_size():
+    archive = LyingArchive(10, b"0123456789" + b"z" * 10000)
+    text = "".join(extractors._iter_archive(archive, 0, set()))
+    assert "0123456789" in text
+    assert "z" not in text
+
+
+def test_same_member_content_is_read_once():
+    data = zip_bytes([("a.txt", b"same report"), ("copy/a.txt", b"same report")])
+    assert extract_text_from_file("mail.zip", data).count("same report") == 1
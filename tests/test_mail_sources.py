@@ -0,0 +1,83 @@
+from datetime import datetime
+from email import message_from_string, policy
+from types import SimpleNamespace
+
+from dedup import dedup_key, message_date
+from mail_sources import ItemCollection, MailFolder, MailMessage, PffSource, message_from_email
+
+SENT = datetime(2023, 12, 31, 23, 50, 0)
+
+
+def pff_message(delivered):
+    return SimpleNamespace(number_of_record_sets=0, number_of_attachments=0, identifier=7, subject="Year end",
+                           sender_name="Ann", plain_text_body=b"See you next year", delivery_time=delivered,
+                           client_submit_time=SENT)
+
+
+def test_pff_copies_share_the_send_time_across_a_year_boundary():
+    source = PffSource("alice.pst")
+    early = source._message(pff_message(datetime(2023, 12, 31, 23, 55)))
+    late = source._message(pff_message(datetime(2024, 1, 1, 0, 5)))
+    assert early.SentOn == late.SentOn == SENT
+    assert message_date(early) == message_date(late) == SENT
+    assert dedup_key(early) == dedup_key(late)
+
+
+def test_eml_send_time_from_the_date_header_agrees_with_the_pst_copy():
+    msg = message_from_string(
+        "From: Ann <ann@example.com>\nSubject: Year end\nDate: Mon, 01 Jan 2024 03:20:00 +0330\n\nSee you next year\n",
+        policy=policy.default,
+    )
+    message = message_from_email(msg, "1.eml")
+    assert message.SentOn.utcoffset().total_seconds() == 3.5 * 3600
+    assert message_date(message) == SENT
+    pst_copy = PffSource("alice.pst")._message(pff_message(datetime(2024, 1, 1, 0, 5)))
+    pst_copy.SenderEmailAddress = "ann@example.com"
+    assert dedup_key(message) == dedup_key(pst_copy)
+
+
+def messages(count, unreadable=()):
+    def get(i):
+        if i in unreadable:
+            raise OSError("corrupt item")
+        return MailMessage(f"e{i}", subject=f"s{i}", sender_email="a@example.com", body="b")
+    return ItemCollection(count, get)
+
+
+def test_unreadable_item_is_logged_and_counted(caplog):
+    items = messages(4, unreadable={1})
+    assert [m.EntryID for m in items.slice(0, 3)] == ["e0", "e2"]
+    assert items.unreadable == 1
+    assert "Item 2 of 4 could not be read" in caplog.text
+
+
+class Pipeline:
+    def __init__(self):
+        self.records = []
+
+    def put(self, record, size=0):
+        self.records.append(record)
+
+
+def read(tmp_path, monkeypatch, items):
+    import ingest
+    from checkpoint import CheckpointStore, SourceProgress
+    monkeypatch.setattr(ingest, "options", SimpleNamespace(dedup="off", backend="mbox"))
+    progress = SourceProgress(CheckpointStore(str(tmp_path / "checkpoint.db")), "a.mbox")
+    pipeline = Pipeline()
+    ingest.read_items(pipeline, MailFolder("Inbox", items), "alice", progress, "/Inbox")
+    return pipeline, progress
+
+
+def test_folder_with_an_unreadable_item_is_not_recorded_as_read(tmp_path, monkeypatch):
+    pipeline, progress = read(tmp_path, monkeypatch, messages(3, unreadable={1}))
+    assert len(pipeline.records) == 2
+    assert progress.errors == 1
+    assert progress.folders_read == []
+
+
+def test_folder_read_in_full_is_recorded(tmp_path, monkeypatch):
+    pipeline, progress = read(tmp_path, monkeypatch, messages(3))
+    assert len(pipeline.records) == 3
+    assert progress.errors == 0
+    assert progress.folders_read == [("/Inbox", 3)]
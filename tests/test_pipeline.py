@@ -0,0 +1,77 @@
+import threading
+
+from mail_sources import SpooledAttachment
+from pipeline import Pipeline, Stage
+
+
+def test_items_pass_every_stage_in_turn():
+    seen = []
+    lock = threading.Lock()
+
+    def collect(item):
+        with lock:
+            seen.append(item)
+        return item
+
+    with Pipeline([Stage("double", lambda x: x * 2, 3), Stage("collect", collect)]) as pipeline:
+        for i in range(100):
+            pipeline.put(i, 1)
+    assert pipeline.count == 100
+    assert sorted(seen) == [i * 2 for i in range(100)]
+
+
+def test_failed_item_goes_to_on_error_and_is_dropped():
+    errors = []
+    reached = []
+
+    def check(item):
+        if item % 10 == 3:
+            raise ValueError(f"bad {item}")
+        return item
+
+    def on_error(item, stage, error):
+        errors.append((item, stage, str(error)))
+
+    stages = [Stage("check", check, 2), Stage("last", lambda item: reached.append(item) or item)]
+    with Pipeline(stages, on_error=on_error, max_bytes=10) as pipeline:
+        for i in range(50):
+            # the byte budget of a failed item is released, or put() would block for good
+            pipeline.put(i, 5)
+    assert sorted(errors) == [(i, "check", f"bad {i}") for i in range(3, 50, 10)]
+    assert pipeline.count == 45
+    assert sorted(reached) == [i for i in range(50) if i % 10 != 3]
+
+
+def test_failing_error_handler_does_not_stop_the_stage():
+    def on_error(item, stage, error):
+        raise RuntimeError("handler")
+
+    def fail(item):
+        raise ValueError(item)
+
+    with Pipeline([Stage("fail", fail)], on_error=on_error) as pipeline:
+        for i in range(5):
+            pipeline.put(i)
+    assert pipeline.count == 0
+
+
+def test_item_dropped_by_a_stage_is_not_counted():
+    stages = [Stage("filter", lambda item: item if item % 2 else None), Stage("last", lambda item: item)]
+    with Pipeline(stages) as pipeline:
+        for i in range(10):
+            pipeline.put(i, 1)
+    assert pipeline.count == 5
+
+
+def test_spooled_attachment_discard(tmp_path):
+    path = tmp_path / "spooled.bin"
+    path.write_bytes(b"content")
+    SpooledAttachment("a.bin", str(path)).discard()
+    assert not path.exists()
+
+    # moved by the save stage: nothing left to remove
+    path.write_bytes(b"content")
+    attachment = SpooledAttachment("a.bin", str(path))
+    attachment.SaveAsFile(str(tmp_path / "saved.bin"))
+    attachment.discard()
+    assert (tmp_path / "saved.bin").read_bytes() == b"content"
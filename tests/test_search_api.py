@@ -0,0 +1,152 @@
+import pytest
+from flask import Flask
+
+import search_api
+from search_api import SEARCH_MAX_SIZE, decode_cursor, encode_cursor, normalize_query, SearchError
+
+
+class FakeES:
+    def __init__(self, chunk_hits=()):
+        self.searches = []
+        self.chunk_searches = []
+        # email ids whose attachment chunks match
+        self.chunk_hits = list(chunk_hits)
+        self.total = 1000
+        self.pits = []
+        self.closed = []
+
+    def open_point_in_time(self, **kwargs):
+        self.pits.append(f"pit-{len(self.pits) + 1}")
+        return {"id": self.pits[-1]}
+
+    def close_point_in_time(self, id):
+        self.closed.append(id)
+
+    def search(self, **body):
+        if body.get("index") == search_api.SEARCH_CHUNK_INDEX:
+            self.chunk_searches.append(body)
+            filters = body["query"]["bool"]["filter"]
+            wanted = [f["terms"]["email_id"] for f in filters if "email_id" in f.get("terms", {})]
+            email_ids = [e for e in self.chunk_hits if not wanted or e in wanted[0]][:body["size"]]
+            return {"hits": {"hits": [{"_source": {"email_id": e}, "highlight": {"text": [f"<em>{e}</em>"]}}
+                                      for e in email_ids]}}
+        self.searches.append(body)
+        start = body["search_after"][-1] + 1 if "search_after" in body else 0
+        hits = [{"_id": f"e{i}", "_index": "email_exchange-2024", "_score": 1.0, "_source": {}, "sort": [1.0, i]}
+                for i in range(start, min(start + body["size"], self.total))]
+        return {"pit_id": body["pit"]["id"], "hits": {"hits": hits, "total": {"value": self.total}}}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    es = FakeES()
+    monkeypatch.setattr(search_api, "get_es", lambda: es)
+    search_api.result_cache = search_api.TTLCache()
+    app = Flask(__name__)
+    app.register_blueprint(search_api.search_api)
+    test_client = app.test_client()
+    test_client.es = es
+    return test_client
+
+
+def test_cursor_round_trip():
+    state = {"pit": "p", "after": [1.5, 3], "query": normalize_query({"q": "x"}), "chunks": ["e1"]}
+    assert decode_cursor(encode_cursor(state)) == state
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64 !",
+    encode_cursor(["pit", "after", "query"]),
+    encode_cursor({"pit": "p", "after": [1]}),
+    encode_cursor({"pit": "p", "after": "1", "query": {}}),
+    encode_cursor({"pit": "p", "after": [1], "query": "q=x"}),
+    encode_cursor({"pit": {"id": "p"}, "after": [1], "query": {}}),
+    encode_cursor({"pit": "p", "after": [1], "query": {}, "chunks": "e1"}),
+    encode_cursor({"pit": "p", "after": [1], "query": {}, "chunks": [{"id": "e1"}]}),
+])
+def test_tampered_cursor_is_rejected(cursor, client):
+    with pytest.raises(SearchError):
+        decode_cursor(cursor)
+    response = client.get("/search", query_string={"cursor": cursor})
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "invalid cursor"}
+    assert client.es.searches == []
+
+
+def test_cursor_query_is_normalized_again(client):
+    cursor = encode_cursor({"pit": "p", "after": [1.0, 5],
+                            "query": {"q": "  budget   report ", "size": 100000, "user": "b, a"}})
+    response = client.get("/search", query_string={"cursor": cursor})
+    assert response.status_code == 200
+    body = client.es.searches[-1]
+    assert body["size"] == SEARCH_MAX_SIZE
+    assert body["query"]["bool"]["must"][0]["simple_query_string"]["query"] == "budget report"
+
+
+def test_bad_size_in_cursor_is_rejected(client):
+    cursor = encode_cursor({"pit": "p", "after": [1], "query": {"q": "x", "size": "many"}})
+    response = client.get("/search", query_string={"cursor": cursor})
+    assert response.status_code == 400
+
+
+def test_chunk_matches_are_carried_in_the_cursor(client):
+    client.es.chunk_hits = ["e1", "e3", "other"]
+    first = client.get("/search", query_string={"q": "invoice", "size": 2}).get_json()
+    assert len(client.es.chunk_searches) == 1
+    assert first["hits"][1]["highlight"]["attachments.text"] == ["<em>e1</em>"]
+
+    client.es.chunk_hits = ["e0", "e1", "e2", "e3"]
+    second = client.get("/search", query_string={"cursor": first["cursor"]}).get_json()
+    # the same ids rank the second page; only the snippets of its chunk matched hits are fetched
+    should = client.es.searches[-1]["query"]["bool"]["must"][0]["bool"]["should"]
+    assert should[1] == {"ids": {"values": ["e1", "e3", "other"]}}
+    assert len(client.es.chunk_searches) == 2
+    assert client.es.chunk_searches[-1]["size"] == 1
+    assert [hit["id"] for hit in second["hits"]] == ["e2", "e3"]
+    assert second["hits"][0]["highlight"] == {}
+    assert second["hits"][1]["highlight"]["attachments.text"] == ["<em>e3</em>"]
+
+
+def test_truncated_chunk_matches_are_reported(client, monkeypatch):
+    monkeypatch.setattr(search_api, "SEARCH_CHUNK_MATCHES", 3)
+    client.es.chunk_hits = ["c1", "c2", "c3"]
+    first = client.get("/search", query_string={"q": "invoice", "size": 2}).get_json()
+    assert first["attachment_matches_truncated"] is False
+
+    client.es.chunk_hits = ["c1", "c2", "c3", "c4"]
+    first = client.get("/search", query_string={"q": "report", "size": 2}).get_json()
+    assert first["attachment_matches_truncated"] is True
+    should = client.es.searches[-1]["query"]["bool"]["must"][0]["bool"]["should"]
+    assert should[1] == {"ids": {"values": ["c1", "c2", "c3"]}}
+
+
+def test_search_without_cursor_closes_its_pit(client):
+    client.es.total = 3
+    response = client.get("/search", query_string={"q": "invoice", "size": 5}).get_json()
+    assert response["cursor"] is None
+    assert client.es.closed == client.es.pits == ["pit-1"]
+
+
+def test_last_page_closes_the_pit(client):
+    client.es.total = 3
+    first = client.get("/search", query_string={"q": "invoice", "size": 2}).get_json()
+    assert client.es.closed == []
+    last = client.get("/search", query_string={"cursor": first["cursor"]}).get_json()
+    assert last["cursor"] is None
+    assert client.es.closed == ["pit-1"]
+
+
+def test_first_page_with_cursor_is_not_shared(client):
+    first = client.get("/search", query_string={"q": "invoice", "size": 2}).get_json()
+    again = client.get("/search", query_string={"q": "invoice", "size": 2}).get_json()
+    assert client.es.pits == ["pit-1", "pit-2"]
+    assert decode_cursor(first["cursor"])["pit"] != decode_cursor(again["cursor"])["pit"]
+    assert client.delete("/search/cursor", query_string={"cursor": first["cursor"]}).status_code == 200
+    assert client.es.closed == ["pit-1"]
+
+
+def test_complete_first_page_is_cached(client):
+    client.es.total = 1
+    client.get("/search", query_string={"q": "invoice"})
+    client.get("/search", query_string={"q": "invoice"})
+    assert len(client.es.searches) == 1
@@ -0,0 +1,90 @@
+import os
+
+from spool import SpoolWriter, read_segment, segments
+
+
+def email(doc_id, store="alice.pst"):
+    return {"_index": "email_exchange-2024", "_id": doc_id,
+            "_source": {"subject": f"subject {doc_id}", "attachments": [{"filename": "a.txt", "text": "t"}]},
+            "_spool": {"store": store, "index_date": "2024-05-01T10:00:00"}}
+
+
+def test_round_trip_over_several_frames(tmp_path):
+    writer = SpoolWriter(str(tmp_path), compression="gzip")
+    writer.write({"_id": "a", "doc": {"subject": "é"}})
+    writer.flush()
+    writer.write({"_id": "b", "doc": {}})
+    writer.close()
+    assert [record["_id"] for record in read_segment(writer.path)] == ["a", "b"]
+    assert list(read_segment(writer.path))[0]["doc"]["subject"] == "é"
+    assert segments(str(tmp_path)) == [writer.path]
+
+
+def test_only_acknowledged_emails_are_spooled(tmp_path):
+    writer = SpoolWriter(str(tmp_path), compression="gzip")
+    actions = writer([email("a"), email("b")])
+    # later prepare steps change the email; the record keeps it as it was
+    for action in actions:
+        action["_source"]["attachments"][0].pop("text")
+        action["_source"]["attachments"][0]["text_chunks"] = 1
+    writer.acknowledged([actions[1]])
+    writer.close()
+
+    records = list(read_segment(writer.path))
+    assert [record["_id"] for record in records] == ["b"]
+    assert records[0]["store"] == "alice.pst"
+    assert records[0]["doc"]["attachments"] == [{"filename": "a.txt", "text": "t"}]
+    assert "_spool" not in actions[0]
+
+
+def test_dedup_owner_is_kept(tmp_path):
+    writer = SpoolWriter(str(tmp_path), compression="gzip")
+    action = email("a")
+    action["_dedup"] = {"owner": "bob", "folder": "inbox", "full": False}
+    writer.acknowledged(writer([action]))
+    writer.close()
+    assert next(read_segment(writer.path))["dedup"] == {"owner": "bob", "folder": "inbox", "full": False}
+
+
+
+def test_torn_last_frame_is_skipped(tmp_path):
+    writer = SpoolWriter(str(tmp_path), compression="gzip")
+    for i in range(50):
+        writer.write({"_id": str(i), "doc": {"body": "x" * 100}})
+    writer.flush()
+    for i in range(50, 100):
+        writer.write({"_id": str(i), "doc": {"body": "x" * 100}})
+    writer.close()
+    size = os.path.getsize(writer.path)
+    with open(writer.path, "r+b") as f:
+        f.truncate(size - 20)
+    ids = [record["_id"] for record in read_segment(writer.path)]
+    assert ids[:50] == [str(i) for i in range(50)]
+    assert len(ids) < 100
+
+
+def test_reindex_window_keeps_segments_in_order(monkeypatch):
+    import time
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    import ingest
+
+    events = []
+    lock = threading.Lock()
+
+    def reindex_segment(path):
+        with lock:
+            events.append(("start", path))
+        # the older segments take longer, the window must still wait for them
+        time.sleep(0.05 if path % 3 == 0 else 0.01)
+        with lock:
+            events.append(("end", path))
+        return path, path, 0
+
+    monkeypatch.setattr(ingest, "reindex_segment", reindex_segment)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(ingest.reindex_in_order(executor, list(range(8)), 2))
+    assert [result[0] for result in results] == list(range(8))
+    for path in range(2, 8):
+        assert events.index(("end", path - 2)) < events.index(("start", path))
@@ -0,0 +1,105 @@
+import os
+from argparse import Namespace
+
+import pytest
+
+import work_queue
+from work_queue import SQLiteWorkQueue, directory_lock
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return SQLiteWorkQueue(str(tmp_path / "queue.db"))
+
+
+def test_largest_store_is_claimed_first(queue):
+    assert queue.add([("a.pst", 10), ("b.pst", 30), ("c.pst", 20)]) == 3
+    assert queue.add([("a.pst", 10)]) == 0
+    assert [queue.claim("node").source for _ in range(3)] == ["b.pst", "c.pst", "a.pst"]
+    assert queue.claim("node") is None
+
+
+def test_expired_lease_goes_to_another_node(queue):
+    queue.add([("a.pst", 10)])
+    lost = queue.claim("node-1", lease=-1)
+    job = queue.claim("node-2")
+    assert (job.source, job.node, job.attempts) == ("a.pst", "node-2", 2)
+
+    # the node that lost the lease can neither renew nor complete the job
+    assert not queue.heartbeat(lost)
+    assert not queue.complete(lost, True)
+    assert queue.heartbeat(job, messages=5, expected=10)
+    assert queue.complete(job, True, 10, 10, 0)
+    assert queue.status()["states"]["done"]["jobs"] == 1
+
+
+def test_job_fails_after_max_attempts(queue, monkeypatch):
+    monkeypatch.setattr(work_queue, "WORK_QUEUE_MAX_ATTEMPTS", 2)
+    queue.add([("a.pst", 10)])
+    queue.claim("node-1", lease=-1)
+    job = queue.claim("node-2", lease=-1)
+    assert job.attempts == 2
+    assert queue.claim("node-3") is None
+    failed = queue.status()["failures"]
+    assert [(f["source"], f["state"], f["error"]) for f in failed] == [("a.pst", "failed", "lease expired on node-2")]
+
+    assert queue.requeue() == 1
+    assert queue.claim("node-3").attempts == 1
+
+
+def test_failed_job_is_retried(queue):
+    queue.add([("a.pst", 10)])
+    job = queue.claim("node-1")
+    assert queue.complete(job, False, error="boom")
+    assert queue.status()["states"]["pending"]["jobs"] == 1
+
+
+def test_finish_waits_for_the_queue_to_drain(queue, monkeypatch):
+    import ingest
+    import index_template
+
+    finished = []
+    monkeypatch.setattr(ingest, "get_work_queue", lambda: queue)
+    monkeypatch.setattr(ingest, "get_es", lambda: None)
+    monkeypatch.setattr(index_template, "finish_bulk_load",
+                        lambda client, forcemerge: finished.append(forcemerge) or ["email_exchange-2024"])
+    opts = Namespace(forcemerge=False)
+
+    queue.add([("a.pst", 10)])
+    job = queue.claim("node-1")
+    assert not ingest.finish_queue(opts)
+    queue.complete(job, True)
+    assert ingest.finish_queue(opts)
+    assert finished == [False]
+
+
+def test_stale_lock_is_taken_over(tmp_path):
+    lock = tmp_path / "queue.db.lock"
+    lock.mkdir()
+    with directory_lock(str(lock), timeout=5, stale=0.2):
+        assert lock.is_dir()
+    assert os.listdir(tmp_path) == []
+
+
+def test_old_mtime_alone_does_not_make_a_lock_stale(tmp_path):
+    # a file server clock far behind the node's: the lock is only stale once it was seen unchanged
+    lock = tmp_path / "queue.db.lock"
+    lock.mkdir()
+    os.utime(lock, (1, 1))
+    with pytest.raises(TimeoutError):
+        with directory_lock(str(lock), timeout=0.3, stale=60):
+            pass
+    assert lock.is_dir()
+
+
+def test_lock_taken_since_it_was_found_stale_is_put_back(tmp_path):
+    lock = tmp_path / "queue.db.lock"
+    lock.mkdir()
+    stale = work_queue._lock_identity(str(lock))
+    # another node broke the stale lock and holds a new one
+    lock.rmdir()
+    lock.mkdir()
+    os.utime(lock, ns=(stale[1] + 10 ** 9, stale[1] + 10 ** 9))
+    work_queue._break_lock(str(lock), stale)
+    assert os.listdir(tmp_path) == ["queue.db.lock"]
+    assert work_queue._lock_identity(str(lock)) != stale
@@ -0,0 +1,109 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import urllib3
+from minio import Minio
+
+import metrics
+
+# Attachment uploads run on a pool of uploader threads, so message reading does not
+# wait on MinIO round trips. The HTTP connection pool is sized to the number of
+# uploaders, and at most UPLOAD_QUEUE_LIMIT uploads may be pending before readers block.
+
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "8"))
+UPLOAD_QUEUE_LIMIT = int(os.getenv("UPLOAD_QUEUE_LIMIT", "32"))
+UPLOAD_MAX_RETRIES = int(os.getenv("UPLOAD_MAX_RETRIES", "5"))
+UPLOAD_INITIAL_BACKOFF = float(os.getenv("UPLOAD_INITIAL_BACKOFF", "1.0"))
+
+
+def create_minio_client(endpoint, access_key, secret_key, secure=False, pool_size=UPLOAD_WORKERS, region=None):
+    # region avoids the bucket location lookup, e.g. for a client that only presigns URLs
+    http_client = urllib3.PoolManager(
+        maxsize=pool_size,
+        block=True,
+        timeout=urllib3.Timeout(connect=10, read=300),
+        retries=urllib3.Retry(total=3, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504]),
+    )
+    return Minio(endpoint, access_key=access_key, secret_key=secret_key, secure=secure, region=region,
+                 http_client=http_client)
+
+
+class UploadStage:
+    def __init__(self, workers=UPLOAD_WORKERS, queue_limit=UPLOAD_QUEUE_LIMIT, max_retries=UPLOAD_MAX_RETRIES):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="minio-upload")
+        self._slots = threading.BoundedSemaphore(max(1, queue_limit))
+        self.max_retries = max_retries
+
+    def submit(self, upload, *args):
+        # Runs upload(*args) with retries; blocks while UPLOAD_QUEUE_LIMIT uploads are pending
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._run, upload, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def _run(self, upload, *args):
+        backoff = UPLOAD_INITIAL_BACKOFF
+        started = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            try:
+                result = upload(*args)
+                metrics.inc("ingest_upload_attempts_total", result="ok")
+                metrics.observe("ingest_upload_seconds", time.perf_counter() - started)
+                return result
+            except Exception as e:
+                if attempt == self.max_retries:
+                    metrics.inc("ingest_upload_attempts_total", result="failed")
+                    logging.error(f"Upload failed after {attempt + 1} attempts: {e}")
+                    raise
+                metrics.inc("ingest_upload_attempts_total", result="retried")
+                logging.warning(f"Upload failed ({e}), retrying in {backoff:.1f}s")
+                time.sleep(backoff)
+                backoff *= 2
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def when_all_done(futures, callback):
+    # Calls callback() once every future has finished, e.g. to remove a temp file that
+    # both the uploader and the extractor read
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            callback()
+
+    for future in futures:
+        future.add_done_callback(done)
+
+
+def resolve_uploads(actions):
+    # Indexer prepare step: a document is only emitted once its attachment uploads are
+    # confirmed. A document whose upload failed is left out, which fails it, so it is not
+    # checkpointed and is read again on the next run; the rest of the batch goes on.
+    resolved = []
+    for action in actions:
+        attachments = action.get("_source", {}).get("attachments", [])
+        try:
+            for attachment in attachments:
+                upload = attachment.get("_upload")
+                if isinstance(upload, Future):
+                    upload.result()
+        except Exception as e:
+            logging.error(f"Document {action.get('_id')} not indexed, an attachment upload failed: {e}")
+            continue
+        for attachment in attachments:
+            attachment.pop("_upload", None)
+        resolved.append(action)
+    return resolved
@@ -0,0 +1,513 @@
+import os
+import time
+import socket
+import uuid
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+from sqlite_store import SQLiteStore
+
+# Leased PST jobs shared by several ingest nodes (`mailsearch queue` / `mailsearch ingest --queue`).
+# The coordinator adds the stores found under a source directory; every ingest worker claims one
+# job at a time (the largest store still pending first), holds it under a lease it renews with
+# heartbeats and completes it. A job whose lease runs out (its node crashed or lost the network)
+# goes back to pending, until it has been tried WORK_QUEUE_MAX_ATTEMPTS times.
+#
+# Jobs are keyed by the store's path relative to the source directory (with / separators), so
+# nodes may mount the archive at different places and resolve it against their own --source.
+# Checkpoints and dedup claims stay local to each node: a job moved to another node is read
+# again from the start, which deterministic _ids make harmless.
+#
+# Backends: "sqlite", a database file on the shared storage next to the archive, and
+# "elasticsearch", an index on the cluster being loaded, for fleets too large for one file.
+# Lease times come from the nodes' clocks, which should be kept in sync.
+
+WORK_QUEUE_BACKENDS = ("sqlite", "elasticsearch")
+WORK_QUEUE_BACKEND = os.getenv("WORK_QUEUE_BACKEND", "sqlite")
+WORK_QUEUE_PATH = os.getenv("WORK_QUEUE_PATH", "ingest_queue.db")
+WORK_QUEUE_INDEX = os.getenv("WORK_QUEUE_INDEX", "ingest_jobs")
+WORK_QUEUE_LEASE = float(os.getenv("WORK_QUEUE_LEASE", "300"))
+WORK_QUEUE_MAX_ATTEMPTS = int(os.getenv("WORK_QUEUE_MAX_ATTEMPTS", "3"))
+# a lock directory a node sees unchanged for this long belongs to a process that died holding it
+WORK_QUEUE_LOCK_STALE = float(os.getenv("WORK_QUEUE_LOCK_STALE", "60"))
+
+JOB_STATES = ("pending", "leased", "done", "failed")
+# messages/expected are reported with the heartbeats while a job is leased, then hold the totals
+JOB_FIELDS = ("source", "state", "node", "attempts", "size", "enqueued", "lease_expires", "heartbeat",
+              "started", "finished", "messages", "expected", "indexed", "failed", "error")
+
+
+def node_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def job_key(base_dir, path):
+    return os.path.relpath(path, base_dir).replace(os.sep, "/")
+
+
+class Job:
+    # One row of the queue; path is the store on this node once resolve() was called
+    __slots__ = JOB_FIELDS + ("path", "version")
+
+    def __init__(self, **fields):
+        for name in JOB_FIELDS:
+            setattr(self, name, fields.get(name))
+        self.attempts = self.attempts or 0
+        self.path = None
+        # backend specific token for conditional updates
+        self.version = fields.get("version")
+
+    def resolve(self, base_dir):
+        self.path = os.path.join(base_dir, *self.source.split("/"))
+        return self
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in JOB_FIELDS}
+
+
+class WorkQueue:
+    def add(self, sources):
+        # sources: (key, size) pairs; returns the number of jobs that were not queued yet
+        raise NotImplementedError
+
+    def claim(self, node, lease=WORK_QUEUE_LEASE):
+        # The next pending job leased to node, None when nothing is pending
+        raise NotImplementedError
+
+    def heartbeat(self, job, lease=WORK_QUEUE_LEASE, messages=None, expected=None):
+        # Extends the lease and records the progress; False when the job is no longer leased to its node
+        raise NotImplementedError
+
+    def complete(self, job, ok, messages=0, indexed=0, failed=0, error=None):
+        # done, or back to pending (failed after WORK_QUEUE_MAX_ATTEMPTS) when not ok
+        raise NotImplementedError
+
+    def requeue(self, states=("failed",), expired=True):
+        # Jobs in states, and leased jobs whose lease ran out, go back to pending with a fresh
+        # attempt count; returns how many
+        raise NotImplementedError
+
+    def jobs(self):
+        raise NotImplementedError
+
+    def status(self, now=None):
+        # Counts and bytes per state, and per node the jobs it holds
+        now = now or time.time()
+        states = {state: {"jobs": 0, "bytes": 0} for state in JOB_STATES}
+        totals = {"messages": 0, "indexed": 0, "failed": 0}
+        leased, failures = [], []
+        for job in self.jobs():
+            states[job.state]["jobs"] += 1
+            states[job.state]["bytes"] += job.size or 0
+            for name in totals:
+                totals[name] += getattr(job, name) or 0
+            if job.state == "leased":
+                eta = None
+                elapsed = (job.heartbeat or now) - (job.started or now)
+                if job.messages and job.expected and elapsed > 0:
+                    eta = round(max(0, job.expected - job.messages) / (job.messages / elapsed))
+                leased.append(dict(job.to_dict(), lease_left=round(job.lease_expires - now),
+                                   heartbeat_age=round(now - (job.heartbeat or job.started or now)), eta=eta))
+            elif job.state == "failed" or job.error:
+                failures.append(job.to_dict())
+        return {"states": states, "totals": totals, "leased": leased, "failures": failures}
+
+    def next_state(self, job, ok):
+        if ok:
+            return "done"
+        return "failed" if job.attempts >= WORK_QUEUE_MAX_ATTEMPTS else "pending"
+
+
+def _lock_identity(path):
+    # tells a lock directory from a later one at the same path; a rename keeps both
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def _break_lock(path, identity):
+    # The stale lock is renamed to a unique name before it is removed: of the nodes that found it
+    # stale only one gets to rename it, and one that renamed a newer lock (taken since it last
+    # looked) puts it back
+    tomb = f"{path}.stale-{uuid.uuid4().hex}"
+    try:
+        os.rename(path, tomb)
+    except OSError:
+        # released by its holder, or broken by another node
+        return
+    try:
+        renamed = _lock_identity(tomb)
+    except OSError:
+        renamed = identity
+    if renamed != identity:
+        try:
+            os.rename(tomb, path)
+        except OSError as e:
+            logging.error(f"Failed to restore queue lock {path}: {e}")
+        return
+    logging.warning(f"Removed stale queue lock {path}")
+    try:
+        os.rmdir(tomb)
+    except OSError as e:
+        logging.error(f"Failed to remove stale queue lock {tomb}: {e}")
+
+
+@contextmanager
+def directory_lock(path, timeout=120, stale=WORK_QUEUE_LOCK_STALE):
+    # mkdir is atomic on SMB and NFS shares, where SQLite's own byte range locks are not
+    # always honoured. A lock is stale once this node has seen the same lock directory for
+    # `stale` seconds, timed on its own monotonic clock: the clocks of the file server and of the
+    # other nodes play no part
+    deadline = time.monotonic() + timeout
+    seen, seen_since = None, None
+    while True:
+        try:
+            os.mkdir(path)
+            break
+        except FileExistsError:
+            pass
+        try:
+            identity = _lock_identity(path)
+        except OSError:
+            # released in between
+            continue
+        now = time.monotonic()
+        if identity != seen:
+            seen, seen_since = identity, now
+        elif now - seen_since > stale:
+            _break_lock(path, identity)
+            seen = None
+            continue
+        if now > deadline:
+            raise TimeoutError(f"Queue lock {path} not acquired in {timeout}s")
+        time.sleep(0.05)
+    try:
+        yield
+    finally:
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            logging.error(f"Failed to release queue lock {path}: {e}")
+
+
+class SQLiteWorkQueue(SQLiteStore, WorkQueue):
+    # rollback journal instead of WAL, and every write under a lock directory next to the file
+    journal_mode = "DELETE"
+
+    def __init__(self, path=WORK_QUEUE_PATH):
+        super().__init__(path)
+        self.lock_path = path + ".lock"
+        with self._transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "source TEXT PRIMARY KEY, state TEXT NOT NULL DEFAULT 'pending', node TEXT, "
+                "attempts INTEGER NOT NULL DEFAULT 0, size INTEGER NOT NULL DEFAULT 0, enqueued REAL NOT NULL, "
+                "lease_expires REAL, heartbeat REAL, started REAL, finished REAL, "
+                "messages INTEGER, expected INTEGER, indexed INTEGER, failed INTEGER, error TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, enqueued)")
+
+    @contextmanager
+    def _transaction(self):
+        with directory_lock(self.lock_path):
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def add(self, sources):
+        now = time.time()
+        with self._transaction() as conn:
+            before = conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+            conn.executemany("INSERT OR IGNORE INTO jobs (source, size, enqueued) VALUES (?, ?, ?)",
+                             ((key, size, now) for key, size in sources))
+            return conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0] - before
+
+    def _expire(self, conn, now):
+        conn.execute(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, node = NULL, "
+            "error = 'lease expired on ' || node WHERE state = 'leased' AND lease_expires < ?",
+            (WORK_QUEUE_MAX_ATTEMPTS, now),
+        )
+
+    def claim(self, node, lease=WORK_QUEUE_LEASE):
+        now = time.time()
+        with self._transaction() as conn:
+            self._expire(conn, now)
+            row = conn.execute(
+                "SELECT source FROM jobs WHERE state = 'pending' ORDER BY size DESC, enqueued, rowid LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET state = 'leased', node = ?, attempts = attempts + 1, lease_expires = ?, "
+                "heartbeat = ?, started = ?, finished = NULL, messages = NULL, expected = NULL WHERE source = ?",
+                (node, now + lease, now, now, row[0]),
+            )
+            return self._job(conn, row[0])
+
+    def heartbeat(self, job, lease=WORK_QUEUE_LEASE, messages=None, expected=None):
+        now = time.time()
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE jobs SET lease_expires = ?, heartbeat = ?, messages = COALESCE(?, messages), "
+                "expected = COALESCE(?, expected) WHERE source = ? AND node = ? AND state = 'leased'",
+                (now + lease, now, messages, expected, job.source, job.node),
+            ).rowcount
+        return updated == 1
+
+    def complete(self, job, ok, messages=0, indexed=0, failed=0, error=None):
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE jobs SET state = ?, node = CASE WHEN ? = 'pending' THEN NULL ELSE node END, finished = ?, "
+                "messages = ?, indexed = ?, failed = ?, error = ? WHERE source = ? AND node = ? AND state = 'leased'",
+                (self.next_state(job, ok), self.next_state(job, ok), time.time(), messages, indexed, failed, error,
+                 job.source, job.node),
+            ).rowcount
+        if not updated:
+            logging.warning(f"Job {job.source} was no longer leased to {job.node} when it finished")
+        return updated == 1
+
+    def requeue(self, states=("failed",), expired=True):
+        now = time.time()
+        with self._transaction() as conn:
+            count = 0
+            if expired:
+                count += conn.execute(
+                    "UPDATE jobs SET state = 'pending', node = NULL, attempts = 0 "
+                    "WHERE state = 'leased' AND lease_expires < ?", (now,)
+                ).rowcount
+            for state in states:
+                count += conn.execute(
+                    "UPDATE jobs SET state = 'pending', node = NULL, attempts = 0 WHERE state = ?", (state,)
+                ).rowcount
+        return count
+
+    def _job(self, conn, source):
+        row = conn.execute(f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE source = ?", (source,)).fetchone()
+        return Job(**dict(zip(JOB_FIELDS, row))) if row else None
+
+    def jobs(self):
+        for row in self._connect().execute(f"SELECT {', '.join(JOB_FIELDS)} FROM jobs ORDER BY enqueued, rowid"):
+            yield Job(**dict(zip(JOB_FIELDS, row)))
+
+
+class ElasticsearchWorkQueue(WorkQueue):
+    # One document per job; claims and lease updates are conditional on the document's
+    # sequence number, so two nodes never hold the same job
+    def __init__(self, client, index=WORK_QUEUE_INDEX):
+        self.client = client
+        self.index = index
+        if not self.client.indices.exists(index=index):
+            try:
+                self.client.indices.create(index=index, settings={"number_of_shards": 1}, mappings={
+                    "dynamic": False,
+                    "properties": {
+                        "source": {"type": "keyword"},
+                        "state": {"type": "keyword"},
+                        "node": {"type": "keyword"},
+                        "size": {"type": "long"},
+                        "enqueued": {"type": "double"},
+                        "lease_expires": {"type": "double"},
+                    },
+                })
+            except Exception as e:
+                # created by another node in the meantime
+                if not self.client.indices.exists(index=index):
+                    raise
+                logging.info(f"Queue index {index} already created: {e}")
+
+    @staticmethod
+    def _id(source):
+        return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+    def _job(self, hit):
+        return Job(**hit["_source"], version=(hit["_seq_no"], hit["_primary_term"]))
+
+    def _search(self, query, size=10, sort=None):
+        response = self.client.search(index=self.index, query=query, size=size, sort=sort,
+                                      seq_no_primary_term=True)
+        return [self._job(hit) for hit in response["hits"]["hits"]]
+
+    def _write(self, job):
+        # False when another node changed the job since it was read
+        from elasticsearch import ConflictError
+        try:
+            response = self.client.index(index=self.index, id=self._id(job.source), document=job.to_dict(),
+                                         if_seq_no=job.version[0], if_primary_term=job.version[1],
+                                         refresh=True)
+        except ConflictError:
+            return False
+        job.version = (response["_seq_no"], response["_primary_term"])
+        return True
+
+    def add(self, sources):
+        from elasticsearch.helpers import streaming_bulk
+        now = time.time()
+        actions = (
+            {"_op_type": "create", "_index": self.index, "_id": self._id(key),
+             "_source": Job(source=key, state="pending", size=size, enqueued=now).to_dict()}
+            for key, size in sources
+        )
+        added = 0
+        for ok, item in streaming_bulk(self.client, actions, raise_on_error=False, refresh=True):
+            if ok:
+                added += 1
+            elif item.get("create", {}).get("status") != 409:
+                logging.error(f"Failed to queue job: {item}")
+        return added
+
+    def _expire(self, now):
+        for job in self._search({"bool": {"filter": [{"term": {"state": "leased"}},
+                                                     {"range": {"lease_expires": {"lt": now}}}]}}, size=100):
+            job.error = f"lease expired on {job.node}"
+            job.state = "failed" if job.attempts >= WORK_QUEUE_MAX_ATTEMPTS else "pending"
+            job.node = None
+            self._write(job)
+
+    def claim(self, node, lease=WORK_QUEUE_LEASE):
+        now = time.time()
+        self._expire(now)
+        while True:
+            candidates = self._search({"term": {"state": "pending"}}, size=10,
+                                      sort=[{"size": {"order": "desc", "unmapped_type": "long"}}, {"enqueued": "asc"}])
+            if not candidates:
+                return None
+            for job in candidates:
+                job.state, job.node = "leased", node
+                job.attempts += 1
+                job.lease_expires, job.heartbeat, job.started, job.finished = now + lease, now, now, None
+                job.messages = job.expected = None
+                if self._write(job):
+                    return job
+            # every candidate was taken by other nodes meanwhile, look again
+
+    def _current(self, job):
+        # the job as stored now (a realtime get), None when its node no longer holds it
+        from elasticsearch import NotFoundError
+        try:
+            current = self._job(self.client.get(index=self.index, id=self._id(job.source)))
+        except NotFoundError:
+            return None
+        if current.state != "leased" or current.node != job.node:
+            return None
+        return current
+
+    def heartbeat(self, job, lease=WORK_QUEUE_LEASE, messages=None, expected=None):
+        current = self._current(job)
+        if current is None:
+            return False
+        current.heartbeat = time.time()
+        current.lease_expires = current.heartbeat + lease
+        if messages is not None:
+            current.messages = messages
+        if expected is not None:
+            current.expected = expected
+        return self._write(current)
+
+    def complete(self, job, ok, messages=0, indexed=0, failed=0, error=None):
+        current = self._current(job)
+        if current is None:
+            logging.warning(f"Job {job.source} was no longer leased to {job.node} when it finished")
+            return False
+        current.state = self.next_state(current, ok)
+        if current.state == "pending":
+            current.node = None
+        current.finished = time.time()
+        current.messages, current.indexed, current.failed, current.error = messages, indexed, failed, error
+        return self._write(current)
+
+    def requeue(self, states=("failed",), expired=True):
+        now = time.time()
+        count = 0
+        for job in self.jobs():
+            if job.state in states or (expired and job.state == "leased" and job.lease_expires < now):
+                job.state, job.node, job.attempts = "pending", None, 0
+                count += self._write(job)
+        return count
+
+    def jobs(self):
+        from elasticsearch.helpers import scan
+        for hit in scan(self.client, index=self.index, query={"query": {"match_all": {}}, "sort": ["enqueued"]},
+                        preserve_order=True, seq_no_primary_term=True):
+            yield self._job(hit)
+
+
+def open_work_queue(backend=WORK_QUEUE_BACKEND, path=WORK_QUEUE_PATH, client=None):
+    # client: the Elasticsearch client, for the elasticsearch backend
+    if backend == "sqlite":
+        return SQLiteWorkQueue(path)
+    if backend == "elasticsearch":
+        return ElasticsearchWorkQueue(client)
+    raise ValueError(f"Unknown work queue backend: {backend}")
+
+
+class Heartbeat:
+    # Renews the lease of a job in the background while it is being processed;
+    # progress() returns (messages read, messages expected) for the coordinator, or None
+    def __init__(self, queue, job, lease=WORK_QUEUE_LEASE, progress=None):
+        self.queue = queue
+        self.job = job
+        self.lease = lease
+        self.progress = progress
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="queue-heartbeat", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.lease / 3):
+            try:
+                messages, expected = (self.progress() if self.progress else None) or (None, None)
+                if not self.queue.heartbeat(self.job, self.lease, messages, expected):
+                    self.lost = True
+                    logging.error(f"Lost the lease on {self.job.source}, another node may be reading it")
+                    return
+            except Exception as e:
+                # the next beat may get through before the lease runs out
+                logging.warning(f"Heartbeat for {self.job.source} failed: {e}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+
+
+def _size(value):
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if value < 1024 or unit == "TB":
+            return f"{value:.1f} {unit}" if unit != "B" else f"{value} B"
+        value /= 1024
+
+
+def format_status(status, failures=20):
+    # Text of `mailsearch queue status`
+    lines = []
+    for state, counts in status["states"].items():
+        lines.append(f"{state:<8} {counts['jobs']:>7} jobs {_size(counts['bytes']):>12}")
+    totals = status["totals"]
+    lines.append(f"messages {totals['messages']}, indexed {totals['indexed']}, failed {totals['failed']}")
+    if status["leased"]:
+        lines.append("")
+        lines.append("leased by:")
+        for job in sorted(status["leased"], key=lambda j: j["node"] or ""):
+            progress = f"{job['messages'] or 0}/{job['expected'] if job['expected'] is not None else '?'}"
+            eta = f"eta {job['eta']}s" if job["eta"] is not None else "eta ?"
+            stale = "  NO HEARTBEAT" if job["lease_left"] < 0 else ""
+            lines.append(f"  {job['node']}  {job['source']}  attempt {job['attempts']}  {progress} messages  {eta}  "
+                         f"heartbeat {job['heartbeat_age']}s ago{stale}")
+    if status["failures"]:
+        lines.append("")
+        lines.append("failures:")
+        for job in status["failures"][:failures]:
+            lines.append(f"  [{job['state']}] {job['source']}  attempts {job['attempts']}: {job['error']}")
+        if len(status["failures"]) > failures:
+            lines.append(f"  ... {len(status['failures']) - failures} more")
+    return "\n".join(lines)